@@ -0,0 +1,162 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from os import environ as env
+
+# connect and read timeouts for every call to Auth0, in seconds
+CONNECT_TIMEOUT = float(env.get("AUTH0_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(env.get("AUTH0_READ_TIMEOUT", "10"))
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# size of the keep-alive connection pool shared by all request threads
+POOL_SIZE = int(env.get("AUTH0_POOL_SIZE", "10"))
+
+# users requested per Management API call (Auth0 allows at most 100)
+USERS_PAGE_SIZE = 100
+
+# Auth0 only lists the first 1000 users through page and per_page, and
+# the users endpoint has no checkpoint pagination to go further
+USERS_LIST_LIMIT = 1000
+
+# refresh the management token this many seconds before it expires
+TOKEN_EXPIRY_MARGIN = 60
+
+
+def make_session(pool_size=POOL_SIZE):
+    """
+    Creates a keep-alive session with a connection pool sized for the
+    number of request threads
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# every outbound call to Auth0 goes through this session
+session = make_session()
+
+# runs Management API page fetches in parallel, one per pooled connection
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+
+
+def post(url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return session.post(url, **kwargs)
+
+
+def get(url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return session.get(url, **kwargs)
+
+
+class ManagementTokenCache(object):
+    """
+    Keeps the client_credentials token for the Auth0 Management API until
+    shortly before it expires. Only one thread fetches a new token at a
+    time, the others wait for it and reuse the result.
+    """
+
+    def __init__(self, token_url, client_id, client_secret, audience,
+                 margin=TOKEN_EXPIRY_MARGIN):
+        self.token_url = token_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.audience = audience
+        self.margin = margin
+
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+        self.stats = {"hits": 0, "fetches": 0}
+
+    def _valid(self):
+        return self._token is not None and time.monotonic() < self._expires_at
+
+    def get_token(self):
+        """
+        Returns a management API access token, fetching one if needed
+        """
+        if self._valid():
+            self.stats["hits"] += 1
+            return self._token
+
+        with self._lock:
+            # another thread may have refreshed it while we waited
+            if self._valid():
+                self.stats["hits"] += 1
+                return self._token
+
+            payload = {
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'audience': self.audience
+            }
+            response = post(self.token_url, data=payload)
+            response.raise_for_status()
+            oauth = response.json()
+
+            self.stats["fetches"] += 1
+            self._token = oauth.get('access_token')
+            expires_in = int(oauth.get('expires_in', 0))
+            self._expires_at = time.monotonic() + max(expires_in - self.margin, 0)
+            return self._token
+
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+            self._expires_at = 0
+
+
+def fetch_users_page(url, access_token, page, per_page, fields):
+    """
+    Fetches one page of the Auth0 user list, projected to the given fields
+    """
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+    params = {
+        'page': page,
+        'per_page': per_page,
+        'include_totals': 'true',
+        'fields': ','.join(fields),
+        'include_fields': 'true'
+    }
+    r = get(url, headers=headers, params=params)
+    r.raise_for_status()
+    return r.json()
+
+
+def users_window(url, access_token, offset, limit, fields, per_page=USERS_PAGE_SIZE):
+    """
+    Returns the total number of users and the projected users in
+    [offset, offset + limit).
+
+    Every Auth0 page overlapping the window is requested at once, and all
+    of them are awaited here, so an error on any page surfaces before the
+    response starts instead of cutting it short.
+    """
+    first = offset // per_page
+    last = (offset + limit - 1) // per_page
+    futures = [executor.submit(fetch_users_page, url, access_token, page, per_page, fields)
+               for page in range(first, last + 1)]
+    try:
+        pages = [f.result() for f in futures]
+    finally:
+        for f in futures:
+            f.cancel()
+
+    total = pages[0].get('total', 0)
+    users = list(itertools.chain.from_iterable(page.get('users', []) for page in pages))
+    skip = offset - first * per_page
+    return total, [{key: x[key] for key in fields if key in x}
+                   for x in users[skip:skip + limit]]
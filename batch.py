@@ -0,0 +1,33 @@
+# most objects accepted by one batch create request
+MAX_BATCH_SIZE = 250
+
+# most mutations (entities put or deleted) one commit accepts
+MAX_MUTATIONS = 500
+
+# objects written per put_multi. Credit cards write a second entity for
+# their card number, so a chunk stays well below MAX_MUTATIONS
+WRITE_CHUNK = 100
+
+
+def read_batch(content):
+    """
+    Returns the list of objects in a batch request body. Raises ValueError
+    if the body is not a JSON array of 1 to MAX_BATCH_SIZE items
+    """
+    if not isinstance(content, list):
+        raise ValueError("The request body must be a JSON array")
+    if not content or len(content) > MAX_BATCH_SIZE:
+        raise ValueError("A batch must contain between 1 and " + str(MAX_BATCH_SIZE) + " objects")
+    return content
+
+
+def chunks(items, size=WRITE_CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def item_error(index, error, status_code):
+    """
+    Returns the per-item result of an object that was not created
+    """
+    return {"index": index, "status": status_code, "error": error}
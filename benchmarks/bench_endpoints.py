@@ -0,0 +1,297 @@
+"""
+Benchmark for every route of the API at growing collection sizes.
+
+Seeds credit_cards, orders and relationships up to each size, then sends
+a sample of requests to every route of credit_card.bp, order.bp,
+card_order.bp and /users, once through the Flask test client and once
+over HTTP to a real WSGI server. Tokens come from a local JWT issuer and
+/users is served by a local Management API stand-in. The NDJSON exports
+read whole collections, so they are sent EXPORT_REQUESTS times per size.
+
+The in-memory storage backend is used by default. With
+--backend datastore everything is written to the Datastore emulator.
+Throughput and p50/p95/p99 latency are printed per route and size, and
+written as JSON to --output so runs can be compared.
+
+    python benchmarks/bench_endpoints.py [sizes...] [--backend memory|datastore]
+        [--requests N] [--servers test_client wsgi] [--output FILE]
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import threading
+import time
+
+from common import (BENCH_USER, LocalIssuer, make_auth0_stub, require_emulator,
+                    summarize)
+
+# seeded cards with orders on them, and how many orders each one gets
+CARDS_WITH_ORDERS = 0.1
+ORDERS_PER_CARD = 5
+
+# new credit_cards or orders per POST .../batch request
+BATCH_SIZE = 10
+
+# requests to each export route per size
+EXPORT_REQUESTS = 5
+
+
+class TestClientTarget(object):
+    """
+    Sends requests through the Flask test client, without any network
+    """
+
+    name = "test_client"
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers, body=None):
+        r = self.client.open(path, method=method, headers=headers, json=body)
+        r.get_data()
+        # like a WSGI server, so streamed responses finish their reporting
+        r.close()
+        return r.status_code
+
+    def close(self):
+        pass
+
+
+class WSGITarget(object):
+    """
+    Serves the app with a threaded WSGI server on a local port and sends
+    requests over keep-alive HTTP connections
+    """
+
+    name = "wsgi"
+
+    def __init__(self, app):
+        import requests
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_request(self, *args):
+                pass
+
+        self.server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_port
+        self.session = requests.Session()
+
+    def request(self, method, path, headers, body=None):
+        r = self.session.request(method, self.base_url + path, headers=headers, json=body)
+        return r.status_code
+
+    def close(self):
+        self.session.close()
+        self.server.shutdown()
+
+
+class Dataset(object):
+    """
+    The seeded entities, grown size by size through the storage backend
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.card_ids = []
+        self.order_ids = []
+        self.card_orders = {}
+        self.serial = 0
+
+    def card_number(self):
+        self.serial += 1
+        return "bench-%d" % self.serial
+
+    def new_cards(self, count):
+        cards = self.store.cards.create_many([
+            {"card_number": self.card_number(), "type": "visa", "expiration": "01/30",
+             "cvv_code": "123", "owner": BENCH_USER} for _ in range(count)])
+        return [e.key.id for e in cards]
+
+    def new_orders(self, count):
+        orders = self.store.orders.create_many([
+            {"date_created": "2026-01-01", "order_total": i, "status": "pending"}
+            for i in range(count)])
+        return [e.key.id for e in orders]
+
+    def grow(self, size):
+        count = size - len(self.card_ids)
+        if count <= 0:
+            return
+        card_ids = self.new_cards(count)
+        order_ids = self.new_orders(count)
+
+        # put ORDERS_PER_CARD of the new orders on a share of the new cards
+        with_orders = int(count * CARDS_WITH_ORDERS)
+        for i, card_id in enumerate(card_ids[:with_orders]):
+            orders = order_ids[i * ORDERS_PER_CARD:(i + 1) * ORDERS_PER_CARD]
+            if not orders:
+                break
+            self.store.relationships.change_card_orders(card_id, orders, [])
+            self.card_orders[card_id] = orders
+
+        self.card_ids += card_ids
+        self.order_ids += order_ids
+
+
+def card_body(number):
+    return {"card_number": number, "type": "visa", "expiration": "01/30", "cvv_code": "123"}
+
+
+def order_body(total=1):
+    return {"date_created": "2026-01-01", "order_total": total, "status": "pending"}
+
+
+def scenarios(data, n):
+    """
+    Returns (route, expected status, requests) for every route. Requests
+    are (method, path, body) tuples; entities that a request deletes or
+    attaches are created up front so only the request itself is timed
+    """
+    cards = random.sample(data.card_ids, min(n, len(data.card_ids)))
+    orders = random.sample(data.order_ids, min(n, len(data.order_ids)))
+    related = random.sample(sorted(data.card_orders), min(n, len(data.card_orders)))
+    doomed_cards = data.new_cards(n)
+    doomed_orders = data.new_orders(n)
+    free_orders = data.new_orders(n)
+    card = data.card_ids[0]
+
+    patch_card_orders = []
+    for order_id in free_orders:
+        patch_card_orders.append(("PATCH", "/credit_cards/%d/orders" % card, {"add": [order_id]}))
+        patch_card_orders.append(("PATCH", "/credit_cards/%d/orders" % card, {"remove": [order_id]}))
+
+    return [
+        ("GET /credit_cards", 200,
+         [("GET", "/credit_cards", None)] * n),
+        ("POST /credit_cards", 201,
+         [("POST", "/credit_cards", card_body(data.card_number())) for _ in range(n)]),
+        ("POST /credit_cards/batch", 200,
+         [("POST", "/credit_cards/batch", [card_body(data.card_number()) for _ in range(BATCH_SIZE)])
+          for _ in range(n)]),
+        ("GET /credit_cards/<id>", 200,
+         [("GET", "/credit_cards/%d" % i, None) for i in cards]),
+        ("PATCH /credit_cards/<id>", 200,
+         [("PATCH", "/credit_cards/%d" % i, {"type": "mastercard"}) for i in cards]),
+        ("PUT /credit_cards/<id>", 200,
+         [("PUT", "/credit_cards/%d" % i, card_body(data.card_number())) for i in cards]),
+        ("DELETE /credit_cards/<id>", 204,
+         [("DELETE", "/credit_cards/%d" % i, None) for i in doomed_cards]),
+        ("GET /orders", 200,
+         [("GET", "/orders", None)] * n),
+        ("POST /orders", 201,
+         [("POST", "/orders", order_body()) for _ in range(n)]),
+        ("POST /orders/batch", 200,
+         [("POST", "/orders/batch", [order_body() for _ in range(BATCH_SIZE)]) for _ in range(n)]),
+        ("GET /orders/<id>", 200,
+         [("GET", "/orders/%d" % i, None) for i in orders]),
+        ("PATCH /orders/<id>", 200,
+         [("PATCH", "/orders/%d" % i, {"status": "shipped"}) for i in orders]),
+        ("PUT /orders/<id>", 200,
+         [("PUT", "/orders/%d" % i, order_body(2)) for i in orders]),
+        ("DELETE /orders/<id>", 204,
+         [("DELETE", "/orders/%d" % i, None) for i in doomed_orders]),
+        ("GET /credit_cards/<id>/orders", 200,
+         [("GET", "/credit_cards/%d/orders" % i, None) for i in related]),
+        ("PATCH /credit_cards/<id>/orders", 200, patch_card_orders),
+        ("PUT /credit_cards/<id>/orders/<order_id>", 200,
+         [("PUT", "/credit_cards/%d/orders/%d" % (card, i), None) for i in free_orders]),
+        ("GET /credit_cards/<id>/orders/<order_id>", 200,
+         [("GET", "/credit_cards/%d/orders/%d" % (card, i), None) for i in free_orders]),
+        ("DELETE /credit_cards/<id>/orders/<order_id>", 204,
+         [("DELETE", "/credit_cards/%d/orders/%d" % (card, i), None) for i in free_orders]),
+        ("GET /users", 200,
+         [("GET", "/users", None)] * n),
+        ("GET /credit_cards/export", 200,
+         [("GET", "/credit_cards/export", None)] * EXPORT_REQUESTS),
+        ("GET /orders/export", 200,
+         [("GET", "/orders/export", None)] * EXPORT_REQUESTS),
+    ]
+
+
+def run_route(target, headers, expected, requests):
+    samples = []
+    errors = 0
+    start = time.perf_counter()
+    for method, path, body in requests:
+        request_start = time.perf_counter()
+        status = target.request(method, path, headers, body)
+        samples.append(time.perf_counter() - request_start)
+        if status != expected:
+            errors += 1
+    elapsed = time.perf_counter() - start
+
+    stats = summarize(samples)
+    stats["errors"] = errors
+    stats["throughput_rps"] = len(samples) / elapsed if elapsed else 0.0
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sizes", nargs="*", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--backend", choices=["memory", "datastore"], default="memory")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--servers", nargs="+", choices=["test_client", "wsgi"],
+                        default=["test_client", "wsgi"])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--users-latency", type=float, default=0,
+                        help="artificial latency of the Auth0 stand-in, in ms")
+    parser.add_argument("--output", default="bench_endpoints.json")
+    args = parser.parse_args()
+
+    started = datetime.datetime.utcnow().isoformat() + "Z"
+    if args.backend == "datastore":
+        require_emulator()
+    os.environ["STORAGE_BACKEND"] = args.backend
+
+    auth0_stub = make_auth0_stub(args.users, args.users_latency / 1000)
+    os.environ["AUTH0_BASE_URL"] = "http://127.0.0.1:%d" % auth0_stub.server_address[1]
+
+    import credit_card
+    import main as app_main
+
+    app = app_main.app
+    issuer = LocalIssuer()
+    issuer.install(credit_card)
+    headers = {"Authorization": "Bearer " + issuer.token(),
+               "Accept": "application/json, application/x-ndjson"}
+
+    data = Dataset(app.extensions["storage"])
+    targets = [{"test_client": TestClientTarget, "wsgi": WSGITarget}[name](app)
+               for name in args.servers]
+
+    results = []
+    for size in sorted(args.sizes):
+        data.grow(size)
+        for target in targets:
+            for route, expected, requests in scenarios(data, args.requests):
+                stats = run_route(target, headers, expected, requests)
+                stats.update({"server": target.name, "size": size, "route": route})
+                results.append(stats)
+                print("%-11s n=%-7d %-44s %8.1f req/s  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms%s"
+                      % (target.name, size, route, stats["throughput_rps"], stats["p50_ms"],
+                         stats["p95_ms"], stats["p99_ms"],
+                         "  errors %d" % stats["errors"] if stats["errors"] else ""))
+
+    for target in targets:
+        target.close()
+    auth0_stub.shutdown()
+
+    with open(args.output, "w") as f:
+        json.dump({"started": started,
+                   "backend": args.backend,
+                   "requests_per_route": args.requests,
+                   "results": results}, f, indent=2)
+    print("results written to " + args.output)
+
+
+if __name__ == '__main__':
+    main()
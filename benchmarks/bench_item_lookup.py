@@ -0,0 +1,69 @@
+"""
+Benchmark for single-item reads: GET /credit_cards/<id> and
+GET /orders/<id> as the collections grow.
+
+Requires the Datastore emulator. Cards and orders are added until each
+size is reached, then a sample of ids is requested through the Flask
+test client. Latency should stay flat as the collection grows.
+
+    python benchmarks/bench_item_lookup.py [sizes...] [--requests N]
+"""
+import argparse
+import random
+import time
+
+from common import (BENCH_USER, LocalIssuer, put_in_batches, require_emulator,
+                    summarize)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sizes", nargs="*", type=int, default=[100, 1000, 10000, 100000])
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    require_emulator()
+
+    from google.cloud import datastore
+
+    import constants
+    import credit_card
+    import main as app_main
+
+    client = datastore.Client()
+    issuer = LocalIssuer()
+    issuer.install(credit_card)
+    headers = {"Authorization": "Bearer " + issuer.token(), "Accept": "application/json"}
+    test_client = app_main.app.test_client()
+
+    card_ids, order_ids = [], []
+    for size in sorted(args.sizes):
+        cards, orders = [], []
+        for i in range(len(card_ids), size):
+            card = datastore.Entity(key=client.key(constants.credit_cards))
+            card.update({"card_number": "bench-%d" % i, "type": "visa",
+                         "expiration": "01/30", "cvv_code": "123", "owner": BENCH_USER})
+            cards.append(card)
+            order = datastore.Entity(key=client.key(constants.orders))
+            order.update({"date_created": "2026-01-01", "order_total": i, "status": "pending"})
+            orders.append(order)
+        put_in_batches(client, cards)
+        put_in_batches(client, orders)
+        card_ids += [e.key.id for e in cards]
+        order_ids += [e.key.id for e in orders]
+
+        for label, prefix, ids in (("GET /credit_cards/<id>", "/credit_cards/", card_ids),
+                                   ("GET /orders/<id>", "/orders/", order_ids)):
+            samples = []
+            for entity_id in random.sample(ids, min(args.requests, len(ids))):
+                start = time.perf_counter()
+                r = test_client.get(prefix + str(entity_id), headers=headers)
+                samples.append(time.perf_counter() - start)
+                assert r.status_code == 200, r.get_data()
+            stats = summarize(samples)
+            print("%-24s n=%-7d p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms"
+                  % (label, size, stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]))
+
+
+if __name__ == '__main__':
+    main()
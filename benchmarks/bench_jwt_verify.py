@@ -0,0 +1,90 @@
+"""
+Micro-benchmark for JWT signature verification.
+
+Compares the original approach (scan the JWKS and hand python-jose a JWK
+dict on every call) with keys prepared once per JWKS version for each
+backend in jwt_verifier.
+
+    python benchmarks/bench_jwt_verify.py [iterations]
+"""
+import sys
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+from common import _b64
+
+import jwt_verifier
+
+AUDIENCE = "bench-audience"
+ISSUER = "https://bench.example.com/"
+
+
+def make_jwks_and_token():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(serialization.Encoding.PEM,
+                                    serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    numbers = private_key.public_key().public_numbers()
+
+    # a few decoy keys so the linear scan has something to scan
+    keys = [{"kid": "old-" + str(i), "kty": "RSA", "use": "sig",
+             "n": _b64(numbers.n), "e": _b64(numbers.e)} for i in range(3)]
+    keys.append({"kid": "bench", "kty": "RSA", "use": "sig",
+                 "n": _b64(numbers.n), "e": _b64(numbers.e)})
+
+    claims = {"sub": "auth0|bench", "aud": AUDIENCE, "iss": ISSUER,
+              "exp": int(time.time()) + 3600}
+    token = jwt.encode(claims, pem, algorithm="RS256", headers={"kid": "bench"})
+    return {"keys": keys}, token
+
+
+def baseline(jwks, token):
+    unverified_header = jwt.get_unverified_header(token)
+    rsa_key = {}
+    for key in jwks["keys"]:
+        if key["kid"] == unverified_header["kid"]:
+            rsa_key = {"kty": key["kty"], "kid": key["kid"], "use": key["use"],
+                       "n": key["n"], "e": key["e"]}
+    return jwt.decode(token, rsa_key, algorithms=jwt_verifier.ALGORITHMS,
+                      audience=AUDIENCE, issuer=ISSUER)
+
+
+def prepared(verifier, jwks):
+    keys = {}
+    for key in jwks["keys"]:
+        keys[key["kid"]] = verifier.prepare_key(key)
+
+    def run(token):
+        kid = jwt.get_unverified_header(token)["kid"]
+        return verifier.decode(token, keys[kid], audience=AUDIENCE, issuer=ISSUER)
+    return run
+
+
+def measure(fn, token, iterations):
+    fn(token)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(token)
+    elapsed = time.perf_counter() - start
+    return iterations / elapsed
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    jwks, token = make_jwks_and_token()
+
+    results = [("baseline (jwk dict per call)", measure(lambda t: baseline(jwks, t), token, iterations))]
+    for name in sorted(jwt_verifier.VERIFIERS):
+        verifier = jwt_verifier.get_verifier(name)
+        results.append(("prepared " + name, measure(prepared(verifier, jwks), token, iterations)))
+
+    base = results[0][1]
+    for name, rate in results:
+        print("%-32s %10.0f verifications/s  (%.2fx)" % (name, rate, rate / base))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark for deep pagination of GET /orders: the cost of page N with
+the signed cursor in the next link versus the legacy offset mode.
+
+Requires the Datastore emulator. Seeds the orders collection, walks it
+with cursors recording the next link of every page, then requests a
+sample of those pages again, once by cursor and once by offset.
+
+    python benchmarks/bench_pagination.py [--orders N] [--limit N] [--repeat N]
+"""
+import argparse
+import time
+
+from common import LocalIssuer, put_in_batches, require_emulator, summarize
+
+
+def timed_get(test_client, url, headers, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        r = test_client.get(url, headers=headers)
+        samples.append(time.perf_counter() - start)
+        assert r.status_code == 200, r.get_data()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=20000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    require_emulator()
+
+    from google.cloud import datastore
+
+    import constants
+    import credit_card
+    import main as app_main
+
+    client = datastore.Client()
+    issuer = LocalIssuer()
+    issuer.install(credit_card)
+    headers = {"Authorization": "Bearer " + issuer.token(), "Accept": "application/json"}
+    test_client = app_main.app.test_client()
+
+    orders = []
+    for i in range(args.orders):
+        order = datastore.Entity(key=client.key(constants.orders))
+        order.update({"date_created": "2026-01-01", "order_total": i, "status": "pending"})
+        orders.append(order)
+    put_in_batches(client, orders)
+
+    # walk the whole collection once to collect the cursor of every page
+    cursor_urls = ["/orders?count=false&limit=%d" % args.limit]
+    while True:
+        body = test_client.get(cursor_urls[-1], headers=headers).get_json()
+        if "next" not in body:
+            break
+        cursor_urls.append(body["next"].split("localhost", 1)[-1])
+
+    pages = len(cursor_urls)
+    for page in sorted(set([0, pages // 4, pages // 2, pages - 1])):
+        offset_url = "/orders?count=false&limit=%d&offset=%d" % (args.limit, page * args.limit)
+        by_cursor = summarize(timed_get(test_client, cursor_urls[page], headers, args.repeat))
+        by_offset = summarize(timed_get(test_client, offset_url, headers, args.repeat))
+        print("page %-5d cursor p50 %7.2f ms p95 %7.2f ms   offset p50 %7.2f ms p95 %7.2f ms"
+              % (page + 1, by_cursor["p50_ms"], by_cursor["p95_ms"],
+                 by_offset["p50_ms"], by_offset["p95_ms"]))
+
+
+if __name__ == '__main__':
+    main()
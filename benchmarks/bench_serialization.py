@@ -0,0 +1,138 @@
+"""
+Micro-benchmark for building list responses: GET /credit_cards with the
+order ids of every card, and GET /orders.
+
+Pages of Datastore entities are turned into response bodies three ways:
+the old handler code (setting id, self and orders on the entities and
+calling json.dumps), the serialization layer with the json backend, and
+the serialization layer with orjson when it is installed. Fresh entities
+are built for every round outside the timed part. No Datastore or
+network is needed.
+
+    python benchmarks/bench_serialization.py [page sizes...] [--rounds N]
+        [--output FILE]
+"""
+import argparse
+import json
+import time
+
+from common import BENCH_USER, summarize
+
+import serialization
+
+ORDERS_PER_CARD = 3
+
+
+def make_cards(count):
+    from google.cloud import datastore
+
+    cards = []
+    for i in range(count):
+        card = datastore.Entity(key=datastore.Key("credit_cards", 1000 + i, project="bench"))
+        card.update({"card_number": "bench-%d" % i, "type": "visa", "expiration": "01/30",
+                     "cvv_code": "123", "owner": BENCH_USER, "version": 1700000000000000 + i})
+        cards.append(card)
+    return cards
+
+
+def make_orders(count):
+    from google.cloud import datastore
+
+    orders = []
+    for i in range(count):
+        order = datastore.Entity(key=datastore.Key("orders", 5000 + i, project="bench"))
+        order.update({"date_created": "2026-01-01", "order_total": i, "status": "pending",
+                      "version": 1700000000000000 + i})
+        orders.append(order)
+    return orders
+
+
+def card_orders(cards):
+    return {e.key.id: list(range(e.key.id * 10, e.key.id * 10 + ORDERS_PER_CARD)) for e in cards}
+
+
+def legacy_cards(cards, host, orders):
+    for e in cards:
+        e.pop("version", None)
+        e["id"] = e.key.id
+        e["self"] = "https://" + host + "/credit_cards/" + str(e.key.id)
+        e["orders"] = orders[e.key.id]
+    return json.dumps({"credit_cards": cards, "items_in_collection": len(cards)})
+
+
+def layer_cards(cards, host, orders):
+    return serialization.dumps({"credit_cards": serialization.credit_cards(cards, orders),
+                                "items_in_collection": len(cards)})
+
+
+def legacy_orders(orders, host, cards):
+    for e in orders:
+        e.pop("version", None)
+        e["id"] = e.key.id
+        e["self"] = "https://" + host + "/orders/" + str(e.key.id)
+        e["credit_card_id"] = cards.get(e.key.id)
+    return json.dumps({"orders": orders, "items_in_collection": len(orders)})
+
+
+def layer_orders(orders, host, cards):
+    return serialization.dumps({"orders": serialization.orders(orders, cards),
+                                "items_in_collection": len(orders)})
+
+
+def measure(build, make, related, size, rounds, host):
+    samples = []
+    for _ in range(rounds):
+        entities = make(size)
+        start = time.perf_counter()
+        build(entities, host, related)
+        samples.append(time.perf_counter() - start)
+    stats = summarize(samples)
+    stats["mean_us"] = sum(samples) / len(samples) * 1000000
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sizes", nargs="*", type=int, default=[5, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--output", default="bench_serialization.json")
+    args = parser.parse_args()
+
+    from flask import Flask
+
+    app = Flask(__name__)
+    host = "bench.example.com"
+    variants = [("legacy+json", None)] + [("layer+" + name, name)
+                                          for name in sorted(serialization.BACKENDS)]
+
+    results = []
+    with app.test_request_context("/", base_url="https://" + host):
+        for size in sorted(args.sizes):
+            sample_cards = make_cards(size)
+            routes = (("GET /credit_cards", legacy_cards, layer_cards, make_cards,
+                       card_orders(sample_cards)),
+                      ("GET /orders", legacy_orders, layer_orders, make_orders,
+                       {e.key.id: 1000 + i for i, e in enumerate(make_orders(size)) if i % 2}))
+            for route, legacy, layer, make, related in routes:
+                baseline = None
+                for variant, backend in variants:
+                    if backend is not None:
+                        serialization.use_backend(backend)
+                    build = legacy if backend is None else layer
+                    stats = measure(build, make, related, size, args.rounds, host)
+                    baseline = baseline or stats["mean_us"]
+                    stats.update({"route": route, "size": size, "variant": variant,
+                                  "speedup": baseline / stats["mean_us"]})
+                    results.append(stats)
+                    print("%-18s n=%-5d %-14s mean %9.1f us  p50 %7.3f ms  p99 %7.3f ms  x%.2f"
+                          % (route, size, variant, stats["mean_us"], stats["p50_ms"],
+                             stats["p99_ms"], stats["speedup"]))
+    serialization.use_backend(serialization.JSON_BACKEND)
+
+    with open(args.output, "w") as f:
+        json.dump({"rounds": args.rounds, "results": results}, f, indent=2)
+    print("results written to " + args.output)
+
+
+if __name__ == '__main__':
+    main()
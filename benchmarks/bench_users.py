@@ -0,0 +1,60 @@
+"""
+Benchmark for GET /users against a local stand-in for the Auth0
+Management API.
+
+The stub serves /oauth/token and a paginated /api/v2/users with a fixed
+artificial latency per call, which is what dominates against the real
+tenant. Each window size is measured with page fetches run one at a time
+and with the shared executor.
+
+    python benchmarks/bench_users.py [users] [latency_ms]
+"""
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import make_auth0_stub
+
+
+def main():
+    total_users = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.05
+
+    server = make_auth0_stub(total_users, latency)
+    os.environ["AUTH0_BASE_URL"] = "http://127.0.0.1:%d" % server.server_address[1]
+    # main creates Datastore clients at import time; /users never uses them
+    os.environ.setdefault("DATASTORE_EMULATOR_HOST", "localhost:8081")
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "bench")
+
+    import auth0_client
+    import main as app_main
+
+    client = app_main.app.test_client()
+    headers = {"Accept": "application/json"}
+    concurrent_executor = auth0_client.executor
+    serial_executor = ThreadPoolExecutor(max_workers=1)
+
+    # warm up the token cache and the connection pool
+    client.get("/users", headers=headers)
+
+    for limit in (5, 50, 100):
+        row = []
+        for label, executor in (("serial", serial_executor), ("concurrent", concurrent_executor)):
+            auth0_client.executor = executor
+            start = time.perf_counter()
+            # an offset inside the first Auth0 page makes the window span two
+            r = client.get("/users?limit=%d&offset=50" % limit, headers=headers)
+            body = json.loads(r.get_data())
+            elapsed = time.perf_counter() - start
+            assert len(body["Users"]) == min(limit, total_users - 50)
+            row.append("%s %7.1f ms" % (label, elapsed * 1000))
+        print("limit=%-5d %s" % (limit, "   ".join(row)))
+
+    auth0_client.executor = concurrent_executor
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+Helpers shared by the endpoint benchmarks: environment checks, a local
+JWT issuer and Management API standing in for Auth0, seeding and
+latency statistics.
+"""
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the app refuses to start without a cursor signing key
+os.environ.setdefault("CURSOR_SIGNING_KEY", "bench")
+
+# users and owners used by the seeded data
+BENCH_USER = "auth0|bench-user"
+BENCH_ISSUER = "https://benitema-final.us.auth0.com/"
+
+# Datastore accepts at most 500 mutations per commit
+SEED_BATCH = 500
+
+
+def require_emulator():
+    """
+    Exits unless the Datastore emulator is configured, so a benchmark can
+    never write its fixtures into a real project
+    """
+    if not os.environ.get("DATASTORE_EMULATOR_HOST"):
+        sys.exit("Start the Datastore emulator and set DATASTORE_EMULATOR_HOST "
+                 "(gcloud beta emulators datastore start; "
+                 "$(gcloud beta emulators datastore env-init)).")
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", os.environ.get("DATASTORE_PROJECT_ID", "bench"))
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+class LocalIssuer(object):
+    """
+    Signs RS256 access tokens with a throwaway key and serves the matching
+    JWKS to verify_jwt instead of Auth0
+    """
+
+    def __init__(self, kid="bench"):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        self.kid = kid
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.pem = private_key.private_bytes(serialization.Encoding.PEM,
+                                             serialization.PrivateFormat.PKCS8,
+                                             serialization.NoEncryption())
+        numbers = private_key.public_key().public_numbers()
+        self.jwks = {"keys": [{"kid": kid, "kty": "RSA", "use": "sig",
+                               "n": _b64(numbers.n), "e": _b64(numbers.e)}]}
+
+    def token(self, sub=BENCH_USER, audience="", lifetime=3600):
+        from jose import jwt
+
+        claims = {"sub": sub, "aud": audience, "iss": BENCH_ISSUER,
+                  "exp": int(time.time()) + lifetime}
+        return jwt.encode(claims, self.pem, algorithm="RS256", headers={"kid": self.kid})
+
+    def install(self, credit_card_module):
+        """
+        Points the app's JWKS store at this issuer
+        """
+        credit_card_module.jwks_store.fetch = lambda url: self.jwks
+        credit_card_module.jwks_store._keys = None
+        credit_card_module.token_store.clear()
+
+
+def make_auth0_stub(total_users, latency):
+    """
+    Starts a local stand-in for the Auth0 Management API serving
+    /oauth/token and a paginated /api/v2/users, each call delayed by a
+    fixed artificial latency
+    """
+    users = [{"user_id": "auth0|%06d" % i, "name": "user %d" % i,
+              "email": "user%d@example.com" % i, "picture": "x" * 100}
+             for i in range(total_users)]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately; without this every
+        # response waits for a delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, body, status=200):
+            data = json.dumps(body).encode("utf-8")
+            time.sleep(latency)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self._send({"access_token": "stub", "expires_in": 86400})
+
+        def do_GET(self):
+            args = parse_qs(urlparse(self.path).query)
+            page = int(args.get("page", ["0"])[0])
+            per_page = int(args.get("per_page", ["50"])[0])
+            fields = args.get("fields", [""])[0].split(",")
+            if (page + 1) * per_page > 1000:
+                # like Auth0, which only lists the first 1000 users
+                self._send({"statusCode": 400, "error": "Bad Request"}, 400)
+                return
+            chunk = users[page * per_page:(page + 1) * per_page]
+            chunk = [{k: u[k] for k in fields if k in u} for u in chunk]
+            self._send({"start": page * per_page, "limit": per_page,
+                        "length": len(chunk), "total": total_users, "users": chunk})
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def put_in_batches(client, entities):
+    for i in range(0, len(entities), SEED_BATCH):
+        client.put_multi(entities[i:i + SEED_BATCH])
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    """
+    Returns p50/p95/p99 in milliseconds for a list of durations in seconds
+    """
+    return {"p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+            "n": len(samples)}
@@ -0,0 +1,116 @@
+import hashlib
+
+import constants
+
+# number of credit_cards indexed per commit by backfill()
+BACKFILL_BATCH = 250
+
+
+def normalize(card_number):
+    """
+    Returns the form of a card number that uniqueness is checked on, by
+    every storage backend, so "1234" and 1234 are the same number
+    """
+    return str(card_number)
+
+
+def index_key(client, card_number):
+    """
+    Returns the key of the uniqueness entry for a card number. The number
+    is hashed so it does not appear in key names or logs
+    """
+    digest = hashlib.sha256(normalize(card_number).encode("utf-8")).hexdigest()
+    return client.key(constants.card_numbers, digest)
+
+
+def claim(client, card_number, card_id):
+    """
+    Reserves a card number for the given credit_card. Must be called inside
+    a transaction together with the put of the card. Returns False if the
+    number already belongs to another credit_card
+    """
+    from google.cloud import datastore
+
+    key = index_key(client, card_number)
+    entry = client.get(key)
+    if entry is not None and entry["card_id"] != card_id:
+        return False
+    if entry is None:
+        entry = datastore.Entity(key=key)
+        entry.update({"card_id": card_id})
+        client.put(entry)
+    return True
+
+
+def release(client, card_number, card_id):
+    """
+    Frees a card number held by the given credit_card. Must be called
+    inside the transaction that changes or deletes the card
+    """
+    key = index_key(client, card_number)
+    entry = client.get(key)
+    if entry is not None and entry["card_id"] == card_id:
+        client.delete(key)
+
+
+def claim_many(client, claims):
+    """
+    Reserves several card numbers with a single lookup. claims is a list of
+    (card_number, card_id) pairs. Must be called inside a transaction
+    together with the put of the cards. Returns the ids of the cards whose
+    number already belongs to another credit_card; those are not reserved
+    """
+    from google.cloud import datastore
+
+    keys = [index_key(client, card_number) for card_number, card_id in claims]
+    owners = {}
+    for entry in client.get_multi(keys):
+        owners[entry.key.name] = entry["card_id"]
+
+    entries = []
+    rejected = set()
+    for (card_number, card_id), key in zip(claims, keys):
+        owner = owners.get(key.name)
+        if owner is None:
+            owners[key.name] = card_id
+            entry = datastore.Entity(key=key)
+            entry.update({"card_id": card_id})
+            entries.append(entry)
+        elif owner != card_id:
+            rejected.add(card_id)
+    client.put_multi(entries)
+    return rejected
+
+
+def backfill(client, batch_size=BACKFILL_BATCH):
+    """
+    Creates the uniqueness entries for credit_cards stored before the index
+    existed. Safe to run more than once. Returns the card numbers that are
+    already used by more than one credit_card so they can be fixed by hand
+    """
+    conflicts = []
+    cursor = None
+    while True:
+        query = client.query(kind=constants.credit_cards)
+        iterator = query.fetch(limit=batch_size, start_cursor=cursor)
+        cards = list(next(iterator.pages))
+        if not cards:
+            break
+
+        with client.transaction():
+            rejected = claim_many(client, [(card["card_number"], card.key.id) for card in cards])
+        for card in cards:
+            if card.key.id in rejected:
+                conflicts.append(card["card_number"])
+
+        cursor = iterator.next_page_token
+        if cursor is None:
+            break
+    return conflicts
+
+
+if __name__ == '__main__':
+    from google.cloud import datastore
+
+    for card_number in backfill(datastore.Client()):
+        print("duplicate card number: " + str(card_number))
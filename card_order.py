@@ -1,12 +1,17 @@
 from flask import Blueprint, request, jsonify, make_response
-from google.cloud import datastore
 import json
-import constants
-
-client = datastore.Client()
+import conditional
+import entity_cache
+import serialization
+import storage
 
 bp = Blueprint('card_order', __name__, url_prefix='/credit_cards/<card_id>/orders')
 
+# most orders added and removed by one PATCH, so the change fits in a
+# single commit (at most 500 mutations: the relationship and the new
+# version of each order, plus the new version of the card)
+MAX_ORDERS_PER_CHANGE = 249
+
 class AuthError(Exception):
     def __init__(self, error, status_code):
         self.error = error
@@ -18,46 +23,61 @@ def handle_auth_error(ex):
     response.status_code = ex.status_code
     return response
 
-@bp.route('', methods=['GET'])
+def get_credit_card(card_id, fresh=False):
+    """
+    Returns the credit_card with the given id, or None. fresh skips the
+    entity cache
+    """
+    if not str(card_id).isdigit():
+        return None
+    return storage.current().cards.get(card_id, fresh=fresh)
+
+def get_order(order_id, fresh=False):
+    """
+    Returns the order with the given id, or None. fresh skips the entity
+    cache
+    """
+    if not str(order_id).isdigit():
+        return None
+    return storage.current().orders.get(order_id, fresh=fresh)
+
+@bp.route('', methods=['GET','PATCH'])
 def cards_cards_get(card_id):
     """
-    An API endpoint for getting all the credit cards on a given order
+    An API endpoint for getting all the orders on a given credit card, or
+    for adding and removing many orders at once
     """
+    if request.method == 'PATCH':
+        return cards_cards_patch(card_id)
+
     if request.accept_mimetypes['application/json']:
-        card_found = False
 
-        # do a query for all the cards in the credit cards collection 
-        # add an 'id' attribute to each card
         # check if the card exists in the collection
-        credit_cards_query = client.query(kind=constants.credit_cards)
-        credit_cards_results = list(credit_cards_query.fetch())
-        for e in credit_cards_results:
-            e["id"] = e.key.id
-            if card_id == json.dumps(e["id"]):
-                card_found = True
-
         # if card not found, return 404 error
-        if card_found == False:
+        credit_card = get_credit_card(card_id)
+        if credit_card is None:
             raise AuthError({"code": "Not Found",
                             "description":
                             "Credit card not found. "
                             "No credit_card with this credit_card_id exists"}, 404)
 
-        # otherwise do a query for all the relationships in the 
-        # card_order collection
-        # add a 'self' attribute to each relationship
-        # check if the order exists in the card_order collection (that is, if
-        # the order currently has a credit card on file)
-        relationship_query = client.query(kind=constants.card_order)
-        relationship_results = list(relationship_query.fetch())
-        for f in relationship_results:
-            f["self"] = "https://" + request.host + "/credit_cards/" \
-                + card_id + "/orders"
-            if int(card_id) == f["card_id"] and f["orders"] != []:
-                res = make_response(json.dumps(f))
-                res.mimetype = 'application/json'
-                res.status_code = 200
-                return res
+        # the version of the card changes whenever an order is put on or
+        # taken off it
+        etag = conditional.entity_etag("card_orders", credit_card)
+        res = conditional.not_modified(etag)
+        if res is not None:
+            return res
+
+        # otherwise look up the orders on this card through the card_id
+        # index of the card_order relationships
+        orders = storage.current().relationships.orders_for_card(card_id)
+        if orders != []:
+            relationship = serialization.relationship(card_id, orders)
+            res = make_response(serialization.dumps(relationship))
+            res.mimetype = 'application/json'
+            res.status_code = 200
+            res.set_etag(etag)
+            return res
 
         raise AuthError({"code": "OK",
                         "description":
@@ -69,6 +89,115 @@ def cards_cards_get(card_id):
             "Not acceptable. "
             "Only application/json content type supported"}, 406)
 
+def read_order_ids(content, name):
+    """
+    Returns the list of order ids under the given attribute of a request
+    body, raising a 400 AuthError if it is not a list of ids
+    """
+    order_ids = content.get(name, [])
+    if not isinstance(order_ids, list):
+        order_ids = None
+    else:
+        try:
+            order_ids = [int(order_id) for order_id in order_ids]
+        except (TypeError, ValueError):
+            order_ids = None
+    if order_ids is None:
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. "
+                        "'" + name + "' must be a list of order ids"}, 400)
+    return order_ids
+
+def cards_cards_patch(card_id):
+    """
+    Adds the orders listed in "add" to a credit card and removes the ones
+    listed in "remove", all in one transaction
+    """
+    if request.content_type != 'application/json':
+        raise AuthError({"code": "Unsupported Media Type",
+                        "description":
+                        "Unsupported media type. "
+                        "Please use application/json with your request"}, 415)
+
+    if not request.accept_mimetypes['application/json']:
+        raise AuthError({"code": "Not Acceptable",
+            "description":
+            "Not acceptable. "
+            "Only application/json content type supported"}, 406)
+
+    if not str(card_id).isdigit():
+        raise AuthError({"code": "Not Found",
+                        "description":
+                        "Credit card not found. "
+                        "No credit_card with this credit_card_id exists"}, 404)
+
+    # get JSON data from the request body
+    content = request.get_json()
+    if not isinstance(content, dict) or set(content.keys()) - {"add", "remove"}:
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Invalid attribute. "
+                        "Only 'add' and 'remove' lists of order ids are accepted"}, 400)
+
+    add = read_order_ids(content, "add")
+    remove = read_order_ids(content, "remove")
+
+    # nothing to change, or the same order listed twice
+    if not add and not remove:
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. "
+                        "No orders to add or remove"}, 400)
+    if len(set(add + remove)) != len(add + remove):
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. "
+                        "Each order may only be listed once"}, 400)
+    if len(add) + len(remove) > MAX_ORDERS_PER_CHANGE:
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. "
+                        "At most " + str(MAX_ORDERS_PER_CHANGE) + " orders can be changed at once"}, 400)
+
+    problems = storage.current().relationships.change_card_orders(card_id, add, remove)
+    if problems is None:
+        entity_cache.current().invalidate_card(card_id)
+        for order_id in add + remove:
+            entity_cache.current().invalidate_order(order_id)
+
+    if problems is not None:
+        if problems["card_missing"]:
+            raise AuthError({"code": "Not Found",
+                            "description":
+                            "Credit card not found. "
+                            "No credit_card with this credit_card_id exists"}, 404)
+        if problems["missing"]:
+            raise AuthError({"code": "Not Found",
+                            "description":
+                            "Not found. "
+                            "The specified order/s do not exist",
+                            "orders": problems["missing"]}, 404)
+        if problems["taken"]:
+            raise AuthError({"code": "Forbidden",
+                            "description":
+                            "Forbidden. "
+                            "These orders have already been added to an existing credit card",
+                            "orders": problems["taken"]}, 403)
+        raise AuthError({"code": "Not Found",
+                        "description":
+                        "Relationship not found. "
+                        "These orders are not associated with a credit card with this card_id",
+                        "orders": problems["not_on_card"]}, 404)
+
+    relationship = serialization.relationship(
+        card_id, storage.current().relationships.orders_for_card(card_id))
+
+    res = make_response(serialization.dumps(relationship))
+    res.mimetype = 'application/json'
+    res.status_code = 200
+    return res
+
 @bp.route('/<order_id>', methods=['PUT','DELETE','GET'])
 def cards_cards_post_patch(card_id, order_id):
     """
@@ -76,39 +205,17 @@ def cards_cards_post_patch(card_id, order_id):
     between an order and a credit card
     """
 
-    order_found = False
-    card_found = False
-    relationship_found = False
-    card = None
+    # check if the card and the order exist with one key lookup each.
+    # Writes skip the entity cache so they are checked against storage
+    fresh = request.method != 'GET'
+    card_found = get_credit_card(card_id, fresh) is not None
+    order_found = get_order(order_id, fresh) is not None
 
-    # do a query for all the cards in the credit cards collection 
-    # add an 'id' attribute to each card
-    # check if the card exists in the collection
-    credit_cards_query = client.query(kind=constants.credit_cards)
-    credit_cards_results = list(credit_cards_query.fetch())
-    for e in credit_cards_results:
-        e["id"] = e.key.id
-        if card_id == json.dumps(e["id"]):
-            card_found = True
-
-    # do a query for all the orders in the orders collection 
-    # add an 'id' attribute to each order
-    # check if the order exists in the collection    
-    orders_query = client.query(kind=constants.orders)
-    orders_results = list(orders_query.fetch())
-    for f in orders_results:
-        f["id"] = f.key.id
-        if order_id == json.dumps(f["id"]):
-            order_found = True
-    
-    # do a query for all the relationships in the card_order collection 
-    # check if a relationship exists between the credit card and an order     
-    relationship_query = client.query(kind=constants.card_order)
-    relationship_results = list(relationship_query.fetch())
-    for g in relationship_results:
-        if order_id in json.dumps(g["orders"]):
-            relationship_found = True
-            card = g["card_id"]
+    # the relationship is keyed by order id, so finding the card that
+    # holds this order is a key lookup as well
+    card = None
+    if order_found:
+        card = storage.current().relationships.card_for_order(order_id, fresh=fresh)
     
     # creates a new relationship between an order and a credit card
     if request.method == 'PUT':
@@ -125,51 +232,32 @@ def cards_cards_post_patch(card_id, order_id):
                             "Not found. "
                             "The specified credit card and/or order does not exist"}, 404)
 
-        # an array for storing the orders associated with a credit card
-        orders = []
-
-        # stores the relationship id of a given credit card and order
-        r_id = None
-
-        # get relationship id and orders
-        relationship_query = client.query(kind=constants.card_order)
-        relationship_results = list(relationship_query.fetch())
-        for e in relationship_results:
-            if card_id == e["card_id"]:
-                r_id = e.key.id
-                if e["orders"] != []:
-                    orders = e["orders"]
-
         # if the order has already been added to an existing card,
         # return 403
-        if relationship_found == True:
+        if card is not None:
             raise AuthError({"code": "Forbidden",
                             "description":
                             "Forbidden. "
                             "This order has already been added to an existing credit card"}, 403)
 
-        # if credit card does not yet have an order, 
-        # create an card_order relationship
-        if orders == []:
-            relationship = datastore.entity.Entity(key=client.key(constants.card_order))
-
-        # otherwise, pull up the existing relationship
-        else:
-            relationship_key = client.key(constants.card_order, int(r_id))
-            relationship = client.get(key=relationship_key)
-        
-        # append new order ro orders array of the card_order relationship
-        orders.append(int(order_id))
-        relationship.update({"card_id": int(card_id), "orders": orders})
-        client.put(relationship)
+        # create the card_order relationship for this order. The check
+        # above is repeated in the transaction, so of two concurrent
+        # requests for the same order only one succeeds
+        if not storage.current().relationships.attach(card_id, order_id):
+            raise AuthError({"code": "Forbidden",
+                            "description":
+                            "Forbidden. "
+                            "This order has already been added to an existing credit card"}, 403)
+        entity_cache.current().invalidate_card(card_id)
+        entity_cache.current().invalidate_order(order_id)
 
         # add self attribute to relationship with direct URL
-        relationship["relationship_id"] = relationship.key.id
-        relationship["self"] = "https://" + request.host + "/credit_cards/" \
-            + str(card_id) + "/orders/" + str(order_id)
+        relationship = serialization.relationship(
+            card_id, storage.current().relationships.orders_for_card(card_id), order_id)
+        relationship["relationship_id"] = int(order_id)
         
         # return newly created relationship
-        res = make_response(json.dumps(relationship))
+        res = make_response(serialization.dumps(relationship))
         res.mimetype = 'application/json'
         res.status_code = 200
         return res
@@ -177,37 +265,16 @@ def cards_cards_post_patch(card_id, order_id):
     elif request.method == 'DELETE':
 
         # if card_order relationship does not exist, return 404
-        if card != int(card_id):
+        if card_found == False or card != int(card_id):
             raise AuthError({"code": "Not Found",
                             "description":
                             "Relationship not found. "
                             "No order with this order_id is associated with a credit card with this card_id"}, 404)
-        
-        # stores relationship id
-        r_id = None
-
-        # an array for storing the orders associated with a credit card
-        orders = []
-
-        # do a query for all the relationships in the card_order 
-        # collection
-        # store the relationship id and orders of the credit card with the
-        # given card_id
-        relationship_query = client.query(kind=constants.card_order)
-        relationship_results = list(relationship_query.fetch())
-        for e in relationship_results:
-            if int(card_id) == e["card_id"] and int(order_id) in e["orders"]:
-                r_id = e.key.id
-                orders = e["orders"]
-
-        # pull up the card_order relationship and remove the order
-        # from the existing orders array
-        print(orders)
-        relationship_key = client.key(constants.card_order, int(r_id))
-        relationship = client.get(key=relationship_key)
-        orders.remove(int(order_id))
-        relationship.update({"orders": orders})
-        client.put(relationship)
+
+        # remove the card_order relationship of this order
+        storage.current().relationships.detach(order_id)
+        entity_cache.current().invalidate_card(card_id)
+        entity_cache.current().invalidate_order(order_id)
         return ('',204)
     
     # a method for returning the created card_order relationship after
@@ -224,31 +291,20 @@ def cards_cards_post_patch(card_id, order_id):
                             "description":
                             "Not found. "
                             "The specified credit card and/or order does not exist"}, 404)
-        
-        r_id = None
-
-        base_url = '/credit_cards/' + str(card_id) + '/orders/' + str(order_id)
 
-        # do a query for all the relationships in the card_order 
-        # collection
-        # store the relationship id and orders of the credit card with the
-        # given card_id
-        relationship_query = client.query(kind=constants.card_order)
-        relationship_results = list(relationship_query.fetch())
-        for e in relationship_results:
-            if int(card_id)== e["card_id"]:
-                r_id = e.key.id
-
-        # pull up the relationship
-        relationship_key = client.key(constants.card_order, int(r_id))
-        relationship = client.get(key=relationship_key)
+        if card != int(card_id):
+            raise AuthError({"code": "Not Found",
+                            "description":
+                            "Relationship not found. "
+                            "No order with this order_id is associated with a credit card with this card_id"}, 404)
 
         # add 'self' attribute to the card_order relationship
-        relationship["self"] = "https://" + request.host + base_url
+        relationship = serialization.relationship(
+            card_id, storage.current().relationships.orders_for_card(card_id), order_id)
         
         # return card_order relationship with card_id and 
         # associated orders 
-        res = make_response(json.dumps(relationship))
+        res = make_response(serialization.dumps(relationship))
         res.mimetype = 'application/json'
         res.status_code = 200
         return res
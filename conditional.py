@@ -0,0 +1,58 @@
+"""
+Strong ETags for single resources and If-None-Match handling.
+
+Credit cards and orders carry a "version" property that storage bumps on
+every write, including when an order is put on or taken off a card (the
+card lists its orders and the order names its card). The ETag of a
+resource is built from its id and version, so a poll can be answered with
+a 304 after reading the entity itself, before any relationship lookup or
+serialization.
+
+The version is not part of the JSON representation; serialization.py
+leaves it out.
+"""
+import hashlib
+import time
+
+from flask import make_response, request
+
+VERSION = "version"
+
+
+def bump_version(entity):
+    """
+    Gives an entity a new version before it is written. Versions only
+    grow and follow the clock, so two writers that read the same version
+    concurrently are very unlikely to pick the same new one
+    """
+    entity[VERSION] = max((entity.get(VERSION) or 0) + 1, int(time.time() * 1000000))
+
+
+def entity_etag(resource, entity):
+    """
+    Returns the ETag of an entity, without quotes. resource tells apart
+    representations built from the same entity
+    """
+    return "%s-%s-v%d" % (resource, entity.key.id, entity.get(VERSION, 0) or 0)
+
+
+def combined_etag(etag, entities):
+    """
+    Extends an ETag with the ids and versions of embedded entities
+    """
+    digest = hashlib.sha1()
+    for e in entities:
+        digest.update(("%s:%d;" % (e.key.id, e.get(VERSION, 0) or 0)).encode("ascii"))
+    return etag + "-" + digest.hexdigest()[:16]
+
+
+def not_modified(etag):
+    """
+    Returns a 304 response if the client already has this version of the
+    resource, or None
+    """
+    if request.if_none_match.contains_weak(etag):
+        res = make_response('', 304)
+        res.set_etag(etag)
+        return res
+    return None
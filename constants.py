@@ -1,3 +1,5 @@
 credit_cards = "credit_cards"
 orders = "orders"
 card_order = "card_order"
+card_numbers = "card_number_index"
+card_order_edges = "card_order_edge"
@@ -1,5 +1,4 @@
 from flask import Blueprint, request, make_response, render_template, jsonify, _request_ctx_stack
-from google.cloud import datastore
 import json
 import constants
 import requests
@@ -21,7 +20,18 @@ from flask import url_for
 from authlib.integrations.flask_client import OAuth
 from six.moves.urllib.parse import urlencode
 
-client = datastore.Client()
+import batch
+import conditional
+import entity_cache
+import export
+import filtering
+from jwks_cache import JWKSCache
+from jwt_verifier import get_verifier
+import metrics
+import pagination
+import serialization
+import storage
+from token_cache import TokenCache
 
 bp = Blueprint('credit_card', __name__, url_prefix='/credit_cards')
 
@@ -31,6 +41,14 @@ DOMAIN = 'benitema-final.us.auth0.com'
 
 ALGORITHMS = ["RS256"]
 
+# signature backend, picked once at startup ("jose" or "cryptography")
+verifier = get_verifier(env.get("JWT_VERIFIER", "jose"))
+
+# shared by every request handled by this process
+jwks_store = JWKSCache("https://"+ DOMAIN+"/.well-known/jwks.json",
+                       prepare_key=verifier.prepare_key)
+token_store = TokenCache()
+
 class AuthError(Exception):
     def __init__(self, error, status_code):
         self.error = error
@@ -42,12 +60,33 @@ def handle_auth_error(ex):
     response.status_code = ex.status_code
     return response
     
+@metrics.timed("auth")
 def verify_jwt(request):
     auth_header = request.headers['Authorization'].split();
     token = auth_header[1]
-    
-    jsonurl = urlopen("https://"+ DOMAIN+"/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+
+    # tokens are reused for many calls, so only verify the signature the
+    # first time we see one
+    cached = token_store.get(token)
+    if cached is not None:
+        status, value = cached
+        if status == "ok":
+            return value
+        raise AuthError(value[0], value[1])
+
+    try:
+        payload = decode_jwt(token)
+    except AuthError as ex:
+        # a missing key may show up after Auth0 rotates its keys, so only
+        # remember rejections of the token itself
+        if ex.error["code"] != "no_rsa_key":
+            token_store.add_rejected(token, ex.error, ex.status_code)
+        raise
+
+    token_store.add_verified(token, payload)
+    return payload
+
+def decode_jwt(token):
     try:
         unverified_header = jwt.get_unverified_header(token)
     except jwt.JWTError:
@@ -60,22 +99,12 @@ def verify_jwt(request):
                         "description":
                             "Invalid header. "
                             "Use an RS256 signed JWT Access Token"}, 401)
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
-    if rsa_key:
+    rsa_key = jwks_store.get_key(unverified_header.get("kid"))
+    if rsa_key is not None:
         try:
-            payload = jwt.decode(
+            payload = verifier.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
                 audience=CLIENT_ID,
                 issuer="https://"+ DOMAIN+"/"
             )
@@ -99,6 +128,66 @@ def verify_jwt(request):
                             "description":
                                 "No RSA key in JWKS"}, 401)
 
+def validate_new_credit_card(content):
+    """
+    Checks the attributes of a credit_card to be created, raising a 400
+    AuthError if one is missing or not recognized
+    """
+    if not isinstance(content, dict):
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. "
+                        "The request object must be a JSON object"}, 400)
+
+    # do not create if an attribute is missing
+    if "card_number" not in content.keys() or "type" not in content.keys() \
+        or "expiration" not in content.keys() or "cvv_code" not in content.keys():
+            raise AuthError({"code": "Bad Request",
+                            "description":
+                            "Missing attribute. "
+                            "The request object is missing at least one of the required attributes"}, 400)
+
+    # do not accept invalid attribute/s
+    for key in content.keys():
+        if key == "card_number" or key == "type" or key == "expiration" or key == "cvv_code":
+            continue
+        else:
+            raise AuthError({"code": "Bad Request",
+                            "description":
+                            "Invalid attribute. "
+                            "The request contains an invalid attribute"}, 400)
+
+def requested_fields():
+    """
+    Returns the credit_card attributes named by the fields parameter, or
+    None for all of them
+    """
+    try:
+        return serialization.requested_fields(serialization.CREDIT_CARD_FIELDS)
+    except ValueError:
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. "
+                        "The fields parameter names an invalid attribute"}, 400)
+
+
+def expand_orders(credit_cards):
+    """
+    Replaces the order ids in the "orders" attribute of each credit_card
+    output with the outputs of the orders themselves, loaded with one
+    batched lookup no matter how many cards there are. Returns the
+    embedded order entities
+    """
+    order_ids = [order_id for output in credit_cards for order_id in output["orders"]]
+
+    found = storage.current().orders.get_multi(order_ids)
+    card_of = {order_id: output["id"] for output in credit_cards for order_id in output["orders"]}
+    outputs = {output["id"]: output for output in serialization.orders(found, card_of)}
+
+    for output in credit_cards:
+        output["orders"] = [outputs[order_id] for order_id in output["orders"] if order_id in outputs]
+    return found
+
 
 @bp.route('', methods=['POST','GET','PUT','PATCH','DELETE'])
 def credit_cards_get_post():
@@ -118,71 +207,46 @@ def credit_cards_get_post():
 
         # get JSON data from the request body
         content = request.get_json()
+        validate_new_credit_card(content)
 
-        # do not create if an attribute is missing
-        if "card_number" not in content.keys() or "type" not in content.keys() \
-            or "expiration" not in content.keys() or "cvv_code" not in content.keys():
-                raise AuthError({"code": "Bad Request",
-                                "description":
-                                "Missing attribute. "
-                                "The request object is missing at least one of the required attributes"}, 400)
+        # if valid, create a new credit card with the given attributes
+        if request.headers.get('Authorization') is None:
+            raise AuthError({"code": "invalid_header",
+                            "description":
+                            "Invalid header. "
+                            "JWT Access Token is missing"}, 401)
+        payload = verify_jwt(request)
 
-        # do not accept invalid attribute/s
-        for key in content.keys():
-            if key == "card_number" or key == "type" or key == "expiration" or key == "cvv_code":
-                continue
-            else:
-                raise AuthError({"code": "Bad Request",
-                                "description":
-                                "Invalid attribute. "
-                                "The request contains an invalid attribute"}, 400)
-        
-        # do a query for all the credit_cards in the credit_cards collection
-        credit_cards_query = client.query(kind=constants.credit_cards)
-        results = list(credit_cards_query.fetch())
-        
-        # make sure card number is unique
-        for e in results:
-            if content["card_number"] == e["card_number"]:
+        if request.accept_mimetypes['application/json']:
+            # the card and its card number entry are written together
+            new_credit_card = storage.current().cards.create({"card_number": content["card_number"],
+            "type": content["type"], "expiration": content["expiration"], "cvv_code": content["cvv_code"],
+            "owner": payload["sub"]})
+
+            # make sure card number is unique
+            if new_credit_card is None:
                 raise AuthError({"code": "Forbidden",
                                 "description":
                                 "Card number not unique. "
                                 "This credit card number already exists. Please enter a different card number"}, 403)
+            entity_cache.current().invalidate_cards_list(payload["sub"])
 
-        # if valid, create a new credit card with the given attributes
-        else:
-            if request.headers.get('Authorization') is None:
-                raise AuthError({"code": "invalid_header",
-                                "description":
-                                "Invalid header. "
-                                "JWT Access Token is missing"}, 401)
-            payload = verify_jwt(request)
-
-            if request.accept_mimetypes['application/json']:
-                new_credit_card = datastore.entity.Entity(key=client.key(constants.credit_cards))
-                new_credit_card.update({"card_number": content["card_number"], "type": content["type"],
-                "expiration": content["expiration"], "cvv_code": content["cvv_code"], "owner": payload["sub"]})
-                client.put(new_credit_card)
-
-                # add id and self attributes
-                new_credit_card["id"] = new_credit_card.key.id
-                new_credit_card["self"] = "https://" + request.host + "/credit_cards/" \
-                    + str(new_credit_card.key.id)
-                new_credit_card["orders"] = []
+            etag = conditional.entity_etag("credit_card", new_credit_card)
 
+            # add id and self attributes
+            res = make_response(serialization.dumps(serialization.credit_card(new_credit_card, [])))
+            res.mimetype = 'application/json'
+            res.status_code = 201
+            res.set_etag(etag)
 
-                res = make_response(json.dumps(new_credit_card))
-                res.mimetype = 'application/json'
-                res.status_code = 201
-
-                # return newly created credit_card
-                return res
+            # return newly created credit_card
+            return res
 
-            else:
-                raise AuthError({"code": "Not Acceptable",
-                    "description":
-                    "Not acceptable. "
-                    "Only application/json content type supported"}, 406)
+        else:
+            raise AuthError({"code": "Not Acceptable",
+                "description":
+                "Not acceptable. "
+                "Only application/json content type supported"}, 406)
 
     elif request.method == 'GET':
 
@@ -195,54 +259,66 @@ def credit_cards_get_post():
 
         if request.accept_mimetypes['application/json']:
 
-            relationship_query = client.query(kind=constants.card_order)
-            relationship_results = list(relationship_query.fetch())
+            # list the credit_cards of this owner
+            cards = storage.current().cards
+            owner = payload['sub']
+            fields = requested_fields()
+            properties = serialization.stored_properties(fields)
+
+            # filters and sort orders run in Datastore, and only if an
+            # index can answer them
+            try:
+                criteria = filtering.parse(request.args, constants.credit_cards,
+                                           serialization.CREDIT_CARD_FIELDS, equality=("owner",))
+            except ValueError as e:
+                raise AuthError({"code": "Bad Request",
+                                "description":
+                                "Bad request. "
+                                "Unsupported filter or sort order: " + str(e)}, 400)
+
+            # set limit of credit_cards per page to 5, walking pages with
+            # signed cursors (or offset for older clients). Sparse,
+            # filtered and sorted pages come from other queries, so their
+            # cursors are scoped apart
+            try:
+                results, next_url = pagination.fetch_page(
+                    lambda limit, **page: cards.page(owner, limit, properties=properties,
+                                                     criteria=criteria, **page),
+                    request, criteria.label(serialization.fields_label(request.path + ':' + owner, fields)))
+            except ValueError:
+                raise AuthError({"code": "Bad Request",
+                                "description":
+                                "Bad request. "
+                                "Invalid limit, offset or cursor"}, 400)
 
-            count = 0
-            
-            # do a query for all the credit_cards in the credit_cards collection
-            query = client.query(kind=constants.credit_cards)
-            query.add_filter('owner', '=', payload['sub'])
-            query_r = list(query.fetch())
-
-            # set limit of credit_cards per page to 5
-            q_limit = int(request.args.get('limit', '5'))
-            q_offset = int(request.args.get('offset', '0'))
-            g_iterator = query.fetch(limit= q_limit, offset=q_offset)
-            pages = g_iterator.pages
-            results = list(next(pages))
-            
-            # build next_url
-            if g_iterator.next_page_token:
-                next_offset = q_offset + q_limit
-                next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
-            else:
-                next_url = None
+            # look up the orders of every credit_card on this page at once,
+            # unless they were left out
+            with_orders = fields is None or "orders" in fields
+            card_orders = {}
+            if with_orders:
+                card_orders = storage.current().relationships.orders_for_cards([e.key.id for e in results])
 
             # add an 'id' and 'self' attribute (not stored in Datastore)
             # to each credit_card
-            for e in results:
-                e["id"] = e.key.id
-                e["self"] = "https://" + request.host + "/credit_cards/" + str(e.key.id)
-                e["orders"] =[]
-
-                for f in relationship_results:
-                    if e["id"] == f["card_id"] and f["orders"] != []:
-                        e["orders"] = f["orders"]
-            
-            for g in query_r:
-                count += 1
+            outputs = serialization.credit_cards(results, card_orders, fields)
 
-            output = {"credit_cards": results}
+            # embed the full orders instead of their ids if requested
+            if with_orders and "orders" in request.args.get('expand', '').split(','):
+                expand_orders(outputs)
+
+            output = {"credit_cards": outputs}
 
             # if there are more credit_cards to be viewed, output next_url
             if next_url:
                 output["next"] = next_url
-            
-            output["items_in_collection"] = count
+
+            # count without reading every entity, unless the client does
+            # not need the total
+            if pagination.wants_count(request):
+                output["items_in_collection"] = cards.count(owner, criteria)
 
             # return the list of credit_cards and their attributes
-            res = make_response(json.dumps(output))             
+            res = make_response(serialization.dumps(output))             
             res.mimetype = 'application/json'
             res.status_code = 200
 
@@ -263,38 +339,146 @@ def credit_cards_get_post():
     else:
         return 'Method not recognized'
 
+@bp.route('/batch', methods=['POST'])
+def credit_cards_batch_post():
+    """
+    An API endpoint for adding up to batch.MAX_BATCH_SIZE credit_cards in
+    one request. Each credit_card is validated and reported on its own
+    """
+
+    if request.content_type != 'application/json':
+        raise AuthError({"code": "Unsupported Media Type",
+                        "description":
+                        "Unsupported media type. "
+                        "Please use application/json with your request"}, 415)
+
+    if request.headers.get('Authorization') is None:
+        raise AuthError({"code": "invalid_header",
+                        "description":
+                        "Invalid header. "
+                        "JWT Access Token is missing"}, 401)
+    payload = verify_jwt(request)
+
+    if not request.accept_mimetypes['application/json']:
+        raise AuthError({"code": "Not Acceptable",
+            "description":
+            "Not acceptable. "
+            "Only application/json content type supported"}, 406)
+
+    try:
+        items = batch.read_batch(request.get_json())
+    except ValueError as ex:
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. " + str(ex)}, 400)
+
+    # validate every credit_card with the same rules as a single POST
+    results = [None] * len(items)
+    valid = []
+    card_numbers = set()
+    for i, content in enumerate(items):
+        try:
+            validate_new_credit_card(content)
+        except AuthError as ex:
+            results[i] = batch.item_error(i, ex.error, ex.status_code)
+            continue
+
+        # make sure card number is unique within the batch
+        if content["card_number"] in card_numbers:
+            results[i] = batch.item_error(i, {"code": "Forbidden",
+                                            "description":
+                                            "Card number not unique. "
+                                            "This credit card number already exists. Please enter a different card number"}, 403)
+            continue
+        card_numbers.add(content["card_number"])
+        valid.append(i)
+
+    # check uniqueness against the collection and write the credit_cards
+    # with their card number entries in as few transactions as possible
+    created = 0
+    new_credit_cards = storage.current().cards.create_many([
+        {"card_number": items[i]["card_number"], "type": items[i]["type"],
+         "expiration": items[i]["expiration"], "cvv_code": items[i]["cvv_code"], "owner": payload["sub"]}
+        for i in valid])
+    if valid:
+        entity_cache.current().invalidate_cards_list(payload["sub"])
+
+    for i, new_credit_card in zip(valid, new_credit_cards):
+        if new_credit_card is None:
+            results[i] = batch.item_error(i, {"code": "Forbidden",
+                                            "description":
+                                            "Card number not unique. "
+                                            "This credit card number already exists. Please enter a different card number"}, 403)
+            continue
+
+        # add id and self attributes
+        results[i] = {"index": i, "status": 201,
+                      "credit_card": serialization.credit_card(new_credit_card, [])}
+        created += 1
+
+    res = make_response(serialization.dumps({"results": results, "created": created}))
+    res.mimetype = 'application/json'
+    res.status_code = 200
+    return res
+
+@bp.route('/export', methods=['GET'])
+def credit_cards_export():
+    """
+    An API endpoint for streaming all the credit_cards of the owner with
+    the ids of their orders, as NDJSON
+    """
+
+    if request.headers.get('Authorization') is None:
+        raise AuthError({"code": "invalid_header",
+                        "description":
+                        "Invalid header. "
+                        "JWT Access Token is missing"}, 401)
+    payload = verify_jwt(request)
+
+    if not request.accept_mimetypes[export.MIMETYPE]:
+        raise AuthError({"code": "Not Acceptable",
+            "description":
+            "Not acceptable. "
+            "Only application/x-ndjson content type supported"}, 406)
+
+    cards = storage.current().cards
+    relationships = storage.current().relationships
+    owner = payload['sub']
+
+    # join the orders of each batch with one lookup, past the entity cache
+    def build(results):
+        card_orders = relationships.orders_for_cards([e.key.id for e in results], fresh=True)
+        return serialization.credit_cards(results, card_orders)
+
+    try:
+        return export.stream(lambda limit, cursor: cards.page(owner, limit, cursor=cursor),
+                             build, request, request.path + ':' + owner)
+    except ValueError:
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. "
+                        "Invalid cursor"}, 400)
+
 @bp.route('/<credit_card_id>', methods=['DELETE','GET','PATCH','PUT'])
 def credit_cards_put_patch_delete(credit_card_id):
     """
     An API endpoint for deleting a credit_card or for getting a specific credit_card
     """
 
-    credit_card_found = False
-
-    # do a query for all the credit_cards in the credit_cards collection
-    credit_cards_query = client.query(kind=constants.credit_cards)
-    results = list(credit_cards_query.fetch())
+    # look the credit_card up by its key instead of scanning the collection.
+    # Writes skip the entity cache so the ownership check runs against the
+    # current owner
+    credit_card = None
+    if credit_card_id.isdigit():
+        credit_card = storage.current().cards.get(credit_card_id, fresh=request.method != 'GET')
 
-    relationship_query = client.query(kind=constants.card_order)
-    relationship_results = list(relationship_query.fetch())
-
-    # add an 'id' attribute to each credit_card
-    # check if the credit_card exists in the collection
-    for e in results:
-        e["id"] = e.key.id
-        if credit_card_id == json.dumps(e["id"]):
-            credit_card_found = True
-    
     # if credit_card not found, return 404 error
-    if credit_card_found == False:
+    if credit_card is None:
         raise AuthError({"code": "Not Found",
                         "description":
                         "Credit card not found. "
                         "No credit_card with this credit_card_id exists"}, 404)
 
-    credit_card_key = client.key(constants.credit_cards, int(credit_card_id))
-    credit_card = client.get(key=credit_card_key)
-
     # deletes an existing credit_card
     if request.method == 'DELETE':
 
@@ -307,17 +491,19 @@ def credit_cards_put_patch_delete(credit_card_id):
         payload = verify_jwt(request)
         
         if credit_card["owner"] == payload['sub']:
-        # delete credit_card from credit_cards collection
-            r_id = None
-            credit_card["id"] = credit_card.key.id
-
-            for e in relationship_results:
-                if credit_card["id"] == e["card_id"] and e["orders"] != []:
-                    r_id = e.key.id
-                    relationship_key = client.key(constants.card_order, int(r_id))
-                    client.delete(relationship_key)
-
-            client.delete(credit_card_key)
+            # delete credit_card from credit_cards collection together with
+            # its relationships and card number entry, so a failure can
+            # not leave orphans behind
+            order_ids = storage.current().cards.delete(credit_card)
+            if order_ids is None:
+                raise AuthError({"code": "Conflict",
+                                "description":
+                                "Too many orders. "
+                                "Remove some of the orders of this credit card before deleting it"}, 409)
+            entity_cache.current().invalidate_card(credit_card.key.id)
+            entity_cache.current().invalidate_cards_list(credit_card["owner"])
+            for order_id in order_ids:
+                entity_cache.current().invalidate_order(order_id)
             return ('',204)
         else:
             raise AuthError({"code": "Forbidden",
@@ -365,61 +551,45 @@ def credit_cards_put_patch_delete(credit_card_id):
                                     "Invalid attribute. "
                                     "The request contains an invalid attribute"}, 400)
 
-            for e in results:
-                
-                # make sure card number is unique
+            # if valid, modify a credit_card with the passed attribute/s
+            if request.accept_mimetypes['application/json']:
+
                 if "card_number" in content.keys():
+                    credit_card.update({"card_number": content["card_number"]})
+                if "type" in content.keys():
+                    credit_card.update({"type": content["type"]})
+                if "expiration" in content.keys():
+                    credit_card.update({"expiration": content["expiration"]})
+                if "cvv_code" in content.keys():
+                    credit_card.update({"cvv_code": content["cvv_code"]})
 
-                    # if current credit card's number matches a credit card number from the
-                    # existing collection
-                    if content["card_number"] == e["card_number"]:
+                # make sure card number is unique
+                if not storage.current().cards.save(credit_card):
+                    # return uniqueness error
+                    raise AuthError({"code": "Forbidden",
+                                    "description":
+                                    "Card number not unique. "
+                                    "This credit card number already exists. Please enter a different card number"}, 403)
+                entity_cache.current().invalidate_card(credit_card.key.id)
+                entity_cache.current().invalidate_cards_list(credit_card["owner"])
 
-                        # if current credit_card's id != to the matching credit_card's id,
-                        # we know that we are not modifying the current credit_card
-                        if credit_card.key.id != e["id"]:
-                            # return uniqueness error
-                            raise AuthError({"code": "Forbidden",
-                                            "description":
-                                            "Card number not unique. "
-                                            "This credit card number already exists. Please enter a different card number"}, 403)
-            
-            # if valid, modify a credit_card with the passed attribute/s
-            else:
-                if request.accept_mimetypes['application/json']:
-
-                    if "card_number" in content.keys():
-                        credit_card.update({"card_number": content["card_number"]})
-                    if "type" in content.keys():
-                        credit_card.update({"type": content["type"]})
-                    if "expiration" in content.keys():
-                        credit_card.update({"expiration": content["expiration"]})
-                    if "cvv_code" in content.keys():
-                        credit_card.update({"cvv_code": content["cvv_code"]})
-
-                    client.put(credit_card)
-
-                    # add 'id' and 'self' attributes to the credit_card
-                    credit_card["id"] = credit_card.key.id
-                    credit_card["self"] = "https://" + request.host + "/credit_cards/" \
-                        + str(credit_card.key.id)
-                    credit_card["orders"] =[]
-
-                    for f in relationship_results:
-                        if credit_card["id"] == f["card_id"] and f["orders"] != []:
-                            credit_card["orders"] = f["orders"]
-                            
-                    res = make_response(json.dumps(credit_card))
-                    res.mimetype = 'application/json'
-                    res.status_code = 200
-
-                    # return modified credit_card
-                    return res
+                etag = conditional.entity_etag("credit_card", credit_card)
 
-                else:
-                    raise AuthError({"code": "Not Acceptable",
-                        "description":
-                        "Not acceptable. "
-                        "Only application/json content type supported"}, 406)
+                # add 'id' and 'self' attributes to the credit_card
+                orders = storage.current().relationships.orders_for_card(credit_card.key.id)
+                res = make_response(serialization.dumps(serialization.credit_card(credit_card, orders)))
+                res.mimetype = 'application/json'
+                res.status_code = 200
+                res.set_etag(etag)
+
+                # return modified credit_card
+                return res
+
+            else:
+                raise AuthError({"code": "Not Acceptable",
+                    "description":
+                    "Not acceptable. "
+                    "Only application/json content type supported"}, 406)
 
         else:
             raise AuthError({"code": "Forbidden",
@@ -466,53 +636,37 @@ def credit_cards_put_patch_delete(credit_card_id):
                                     "Invalid attribute. "
                                     "The request contains an invalid attribute"}, 400)
 
-            for e in results:
-
+            # if valid, modify a credit_card with the passed attribute/s
+            if request.accept_mimetypes['application/json']:
+                credit_card.update({"card_number": content["card_number"], "type": content["type"],
+                "expiration": content["expiration"], "cvv_code": content["cvv_code"]})
                 # make sure card number is unique
-                if "card_number" in content.keys():
+                if not storage.current().cards.save(credit_card):
+                    # return uniqueness error
+                    raise AuthError({"code": "Forbidden",
+                                    "description":
+                                    "Card number not unique. "
+                                    "This credit card number already exists. Please enter a different card number"}, 403)
+                entity_cache.current().invalidate_card(credit_card.key.id)
+                entity_cache.current().invalidate_cards_list(credit_card["owner"])
 
-                    # if current credit card's number matches a credit card number from the
-                    # existing collection
-                    if content["card_number"] == e["card_number"]:
+                etag = conditional.entity_etag("credit_card", credit_card)
 
-                        # if current credit_card's id != to the matching credit_card's id,
-                        # we know that we are not modifying the current credit_card
-                        if credit_card.key.id != e["id"]:
-                            # return uniqueness error
-                            raise AuthError({"code": "Forbidden",
-                                            "description":
-                                            "Card number not unique. "
-                                            "This credit card number already exists. Please enter a different card number"}, 403)
-            
-            # if valid, modify a credit_card with the passed attribute/s
-            else:
-                if request.accept_mimetypes['application/json']:
-                    credit_card.update({"card_number": content["card_number"], "type": content["type"],
-                    "expiration": content["expiration"], "cvv_code": content["cvv_code"]})
-                    client.put(credit_card)
-
-                    # add 'id' and 'self' attributes to the credit_card
-                    credit_card["id"] = credit_card.key.id
-                    credit_card["self"] = "https://" + request.host + "/credit_cards/" \
-                        + str(credit_card.key.id)
-                    credit_card["orders"] =[]
-
-                    for f in relationship_results:
-                        if credit_card["id"] == f["card_id"] and f["orders"] != []:
-                            credit_card["orders"] = f["orders"]
-                    
-                    res = make_response(json.dumps(credit_card))
-                    res.mimetype = 'application/json'
-                    res.status_code = 200
+                # add 'id' and 'self' attributes to the credit_card
+                orders = storage.current().relationships.orders_for_card(credit_card.key.id)
+                res = make_response(serialization.dumps(serialization.credit_card(credit_card, orders)))
+                res.mimetype = 'application/json'
+                res.status_code = 200
+                res.set_etag(etag)
 
-                    # return modified credit_card
-                    return res
+                # return modified credit_card
+                return res
 
-                else:
-                    raise AuthError({"code": "Not Acceptable",
-                        "description":
-                        "Not acceptable. "
-                        "Only application/json content type supported"}, 406)
+            else:
+                raise AuthError({"code": "Not Acceptable",
+                    "description":
+                    "Not acceptable. "
+                    "Only application/json content type supported"}, 406)
 
         else:
             raise AuthError({"code": "Forbidden",
@@ -534,20 +688,37 @@ def credit_cards_put_patch_delete(credit_card_id):
         if credit_card["owner"] == payload['sub']:
 
             if request.accept_mimetypes['application/json']:
-                base_url = '/credit_cards/' + credit_card_id
+                fields = requested_fields()
+                with_orders = fields is None or "orders" in fields
+                expand = with_orders and "orders" in request.args.get('expand', '').split(',')
+
+                # the version of the card changes with its orders, so a
+                # client with the current version needs no further lookups
+                etag = conditional.entity_etag(serialization.fields_label("credit_card", fields),
+                                               credit_card)
+                if not expand:
+                    res = conditional.not_modified(etag)
+                    if res is not None:
+                        return res
 
                 # add 'id' and 'self' attributes to the credit_card
-                credit_card["id"] = credit_card.key.id
-                credit_card["self"] = "https://" + request.host + base_url
-                credit_card["orders"] =[]
-
-                for e in relationship_results:
-                    if credit_card["id"] == e["card_id"] and e["orders"] != []:
-                        credit_card["orders"] = e["orders"]
-
-                res = make_response(json.dumps(credit_card))             
+                orders = []
+                if with_orders:
+                    orders = storage.current().relationships.orders_for_card(credit_card.key.id)
+                output = serialization.credit_card(credit_card, orders, fields)
+
+                # embed the full orders instead of their ids if requested;
+                # their versions become part of the ETag
+                if expand:
+                    etag = conditional.combined_etag(etag, expand_orders([output]))
+                    res = conditional.not_modified(etag)
+                    if res is not None:
+                        return res
+
+                res = make_response(serialization.dumps(output))             
                 res.mimetype = 'application/json'
                 res.status_code = 200
+                res.set_etag(etag)
 
                 # return credit_card and its attributes as JSON
                 return res
@@ -0,0 +1,332 @@
+"""
+Counts the Datastore work done by each request.
+
+CountingClient wraps a datastore.Client and adds every RPC it makes, the
+entities read and written and the time spent waiting for Datastore to the
+current request. When the request finishes the totals are sent back in a
+Server-Timing header, written as one JSON log line, and compared with the
+RPC budget of the route, logging a warning when it is exceeded so a new
+full scan or N+1 lookup shows up at once. Streamed responses, such as
+the exports, are reported once the server closes them, without
+Server-Timing.
+
+Budgets are keyed by "METHOD route template" and can be changed with the
+RPC_BUDGETS setting, which is merged over DEFAULT_RPC_BUDGETS. While
+CARD_ORDER_LEGACY_READS is on, the batched legacy card_order lookups of
+LEGACY_RPC_BUDGETS are added first. RPC_BUDGETS_ENABLED turns the checks
+off.
+"""
+import json
+import logging
+import time
+
+from flask import g, has_request_context, request
+
+import metrics
+import relationships
+
+logger = logging.getLogger("datastore_usage")
+
+# expected Datastore RPCs of each route at the default page size and
+# with full batches, once the card_order migration has finished
+DEFAULT_RPC_BUDGETS = {
+    "GET /credit_cards": 4,
+    "POST /credit_cards": 4,
+    "POST /credit_cards/batch": 10,
+    "GET /credit_cards/<credit_card_id>": 2,
+    "PATCH /credit_cards/<credit_card_id>": 7,
+    "PUT /credit_cards/<credit_card_id>": 7,
+    "DELETE /credit_cards/<credit_card_id>": 6,
+    "GET /orders": 3,
+    "POST /orders": 1,
+    "POST /orders/batch": 3,
+    "GET /orders/<order_id>": 2,
+    "PATCH /orders/<order_id>": 3,
+    "PUT /orders/<order_id>": 3,
+    "DELETE /orders/<order_id>": 5,
+    "GET /credit_cards/<card_id>/orders": 2,
+    "PATCH /credit_cards/<card_id>/orders": 4,
+    "PUT /credit_cards/<card_id>/orders/<order_id>": 7,
+    "GET /credit_cards/<card_id>/orders/<order_id>": 4,
+    "DELETE /credit_cards/<card_id>/orders/<order_id>": 7,
+    # the exports read whole collections and are budgeted per batch
+    "GET /credit_cards/export": 18,
+    "GET /orders/export": 2,
+}
+
+# the most legacy card_order queries each route adds while
+# CARD_ORDER_LEGACY_READS is on: one per IN_FILTER_LIMIT ids of each
+# batched lookup at the default page size and with full batches, and one
+# more for each legacy entity cleaned up
+LEGACY_RPC_BUDGETS = {
+    "GET /credit_cards": 1,
+    "GET /credit_cards/<credit_card_id>": 1,
+    "PATCH /credit_cards/<credit_card_id>": 1,
+    "PUT /credit_cards/<credit_card_id>": 1,
+    "DELETE /credit_cards/<credit_card_id>": 1,
+    "GET /orders": 1,
+    "GET /orders/<order_id>": 1,
+    "PATCH /orders/<order_id>": 1,
+    "PUT /orders/<order_id>": 1,
+    "DELETE /orders/<order_id>": 2,
+    "GET /credit_cards/<card_id>/orders": 1,
+    "PATCH /credit_cards/<card_id>/orders": 10,
+    "PUT /credit_cards/<card_id>/orders/<order_id>": 3,
+    "GET /credit_cards/<card_id>/orders/<order_id>": 2,
+    "DELETE /credit_cards/<card_id>/orders/<order_id>": 3,
+    "GET /credit_cards/export": 17,
+    "GET /orders/export": 17,
+}
+
+
+def _budgets(overrides):
+    budgets = dict(DEFAULT_RPC_BUDGETS)
+    if relationships.LEGACY_READS:
+        for route, extra in LEGACY_RPC_BUDGETS.items():
+            budgets[route] = budgets.get(route, 0) + extra
+    budgets.update(overrides or {})
+    return budgets
+
+
+def _record(rpcs=0, read=0, written=0, seconds=0.0):
+    if not has_request_context():
+        return
+    usage = g.get("datastore_usage")
+    if usage is None:
+        return
+    usage["rpcs"] += rpcs
+    usage["read"] += read
+    usage["written"] += written
+    usage["seconds"] += seconds
+
+
+def add_batch():
+    """
+    Counts a batch of an export in the current request, whose RPC budget
+    is per batch
+    """
+    if has_request_context():
+        usage = g.get("datastore_usage")
+        if usage is not None:
+            usage["batches"] += 1
+
+
+def _in_batch(client):
+    # puts and deletes inside a transaction are sent with its commit
+    return client.current_batch is not None
+
+
+class CountingIterator(object):
+    """
+    Wraps a query iterator, counting one RPC per page it fetches
+    """
+
+    def __init__(self, iterator, count_reads=True):
+        self._iterator = iterator
+        self._count_reads = count_reads
+
+    def __getattr__(self, name):
+        return getattr(self._iterator, name)
+
+    @property
+    def pages(self):
+        pages = iter(self._iterator.pages)
+        while True:
+            start = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            items = list(page)
+            _record(rpcs=1, read=len(items) if self._count_reads else 0,
+                    seconds=time.perf_counter() - start)
+            yield iter(items)
+
+    def __iter__(self):
+        for page in self.pages:
+            for item in page:
+                yield item
+
+
+class CountingQuery(object):
+
+    def __init__(self, query, count_reads=True):
+        self._query = query
+        self._count_reads = count_reads
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if not callable(attr):
+            return attr
+
+        # builder methods such as add_filter and count return the query,
+        # which must stay wrapped
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self._query else result
+        return call
+
+    def __setattr__(self, name, value):
+        # properties such as projection belong to the wrapped query
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._query, name, value)
+
+    def fetch(self, *args, **kwargs):
+        return CountingIterator(self._query.fetch(*args, **kwargs), self._count_reads)
+
+
+class CountingTransaction(object):
+    """
+    Wraps a transaction, counting its begin and its commit or rollback
+    """
+
+    def __init__(self, transaction):
+        self._transaction = transaction
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self._transaction.__enter__()
+        _record(rpcs=1, seconds=time.perf_counter() - start)
+        return self
+
+    def __exit__(self, *exc):
+        start = time.perf_counter()
+        try:
+            return self._transaction.__exit__(*exc)
+        finally:
+            _record(rpcs=1, seconds=time.perf_counter() - start)
+
+
+class CountingClient(object):
+    """
+    A datastore.Client that accounts every RPC to the current request
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def _timed(self, f, *args, **kwargs):
+        start = time.perf_counter()
+        result = f(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+    def get(self, key, **kwargs):
+        entity, seconds = self._timed(self._client.get, key, **kwargs)
+        _record(rpcs=1, read=int(entity is not None), seconds=seconds)
+        return entity
+
+    def get_multi(self, keys, **kwargs):
+        if not keys:
+            return []
+        entities, seconds = self._timed(self._client.get_multi, keys, **kwargs)
+        _record(rpcs=1, read=len(entities), seconds=seconds)
+        return entities
+
+    def _write(self, f, arg, count, **kwargs):
+        rpc = not _in_batch(self._client)
+        result, seconds = self._timed(f, arg, **kwargs)
+        if count:
+            _record(rpcs=int(rpc), written=count, seconds=seconds)
+        return result
+
+    def put(self, entity, **kwargs):
+        return self._write(self._client.put, entity, 1, **kwargs)
+
+    def put_multi(self, entities, **kwargs):
+        return self._write(self._client.put_multi, entities, len(entities), **kwargs)
+
+    def delete(self, key, **kwargs):
+        return self._write(self._client.delete, key, 1, **kwargs)
+
+    def delete_multi(self, keys, **kwargs):
+        return self._write(self._client.delete_multi, keys, len(keys), **kwargs)
+
+    def allocate_ids(self, incomplete_key, num_ids, **kwargs):
+        keys, seconds = self._timed(self._client.allocate_ids, incomplete_key, num_ids, **kwargs)
+        _record(rpcs=1, seconds=seconds)
+        return keys
+
+    def query(self, **kwargs):
+        return CountingQuery(self._client.query(**kwargs))
+
+    def aggregation_query(self, query, **kwargs):
+        if isinstance(query, CountingQuery):
+            query = query._query
+        return CountingQuery(self._client.aggregation_query(query, **kwargs), count_reads=False)
+
+    def transaction(self, **kwargs):
+        return CountingTransaction(self._client.transaction(**kwargs))
+
+
+def _route():
+    rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    return request.method + " " + rule
+
+
+def server_timing(usage, phases):
+    """
+    Returns the Server-Timing header value for the Datastore totals and
+    the phases recorded by metrics
+    """
+    entries = ['datastore;dur=%.3f;desc="rpcs=%d read=%d written=%d"'
+               % (usage["seconds"] * 1000, usage["rpcs"], usage["read"], usage["written"])]
+    for name in metrics.PHASES:
+        if name in phases:
+            entries.append('%s;dur=%.3f' % (name, phases[name] * 1000))
+    return ", ".join(entries)
+
+
+def init_app(app):
+    """
+    Reports the Datastore usage of every request of the app
+    """
+    budgets = _budgets(app.config.get("RPC_BUDGETS"))
+    if not app.config.get("RPC_BUDGETS_ENABLED", True):
+        budgets = {}
+
+    @app.before_request
+    def start_usage():
+        g.datastore_usage = {"rpcs": 0, "read": 0, "written": 0, "seconds": 0.0, "batches": 0}
+
+    def report(route, status, usage):
+        line = {"event": "datastore_usage", "route": route, "status": status,
+                "rpcs": usage["rpcs"], "entities_read": usage["read"],
+                "entities_written": usage["written"],
+                "datastore_ms": round(usage["seconds"] * 1000, 3)}
+        logger.info(json.dumps(line))
+
+        budget = budgets.get(route)
+        if budget is not None:
+            budget *= max(usage["batches"], 1)
+        if budget is not None and usage["rpcs"] > budget:
+            line["event"] = "rpc_budget_exceeded"
+            line["budget"] = budget
+            logger.warning(json.dumps(line))
+
+    @app.after_request
+    def report_usage(response):
+        if response.is_streamed:
+            # a streamed body does its Datastore work after this hook, so
+            # it is reported when the server closes the response. The
+            # headers are gone by then, so there is no Server-Timing
+            usage = g.get("datastore_usage")
+            if usage is not None:
+                route = _route()
+                response.call_on_close(lambda: report(route, response.status_code, usage))
+            return response
+
+        usage = g.pop("datastore_usage", None)
+        if usage is None:
+            return response
+
+        response.headers["Server-Timing"] = server_timing(usage, g.get("metrics_phases") or {})
+        report(_route(), response.status_code, usage)
+        return response
@@ -0,0 +1,395 @@
+"""
+In-process read-through cache for key lookups of credit_cards, orders and
+their card_order relationships, and for the first page of the
+credit_cards and orders lists at the default limit, with its count.
+Sparse, filtered and sorted pages are always read from storage.
+
+Each kind has its own bounded LRU whose entries expire after a TTL, so
+writes made by other instances show up within ENTITY_CACHE_TTL seconds.
+Writes made by this process are dropped from the cache right away by the
+blueprints, through the invalidate_* methods. Entities are copied on the
+way in and out, so callers can modify what they get. With
+SHARED_CACHE_URL set, misses are looked up in a tier shared by all
+instances first, and invalidations reach the other instances through it
+(see shared_cache.py). Hits and misses per kind and tier are exposed on
+/metrics.
+
+    ENTITY_CACHE_SIZE      entries kept per kind
+    ENTITY_CACHE_TTL       seconds an entry is served for
+    ENTITY_CACHE_DISABLED  kinds that are always read from storage
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+import constants
+import metrics
+import pagination
+import shared_cache
+
+ENTITY_CACHE_SIZE = 10000
+
+ENTITY_CACHE_TTL = 30
+
+KINDS = (constants.credit_cards, constants.orders, constants.card_order)
+
+# returned by LRUCache.get for keys that are not cached, since None is a
+# valid value for relationships
+MISSING = object()
+
+
+def _copy(value):
+    # entities are copied, and so are the lists and pages holding them
+    if isinstance(value, tuple):
+        return tuple(_copy(v) for v in value)
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return copy.copy(value)
+
+
+def current():
+    """
+    Returns the entity cache of the app handling the current request
+    """
+    return current_app.extensions["entity_cache"]
+
+
+class LRUCache(object):
+    """
+    A thread-safe LRU mapping whose entries expire after a TTL. Every
+    invalidation starts a new generation, and values loaded during an
+    older one are not stored, so a slow read can not put back what a
+    write has just dropped
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > now:
+                    self._items.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return value
+                del self._items[key]
+            self.stats["misses"] += 1
+            return MISSING
+
+    def set(self, key, value, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._items[key] = (value, time.time() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class EntityCache(object):
+    """
+    One LRUCache per kind, skipping the disabled kinds, optionally backed
+    by a SharedCache
+    """
+
+    def __init__(self, max_size=ENTITY_CACHE_SIZE, ttl=ENTITY_CACHE_TTL, disabled=()):
+        unknown = set(disabled) - set(KINDS)
+        if unknown:
+            raise ValueError("Unknown entity cache kinds: " + ", ".join(sorted(unknown)))
+        self.caches = {kind: LRUCache(max_size, ttl) for kind in KINDS if kind not in disabled}
+        self.shared = None
+
+    def lookup(self, kind, key, load, negative=False):
+        """
+        Returns the cached value of a key, or loads and caches it. None is
+        only cached if negative is set
+        """
+        cache = self.caches.get(kind)
+        if cache is None:
+            return load()
+        value = cache.get(key)
+        if value is MISSING:
+            generation = cache.generation
+            if self.shared is not None:
+                value = self.shared.lookup(kind, key, load, negative)
+            else:
+                value = load()
+            if value is not None or negative:
+                cache.set(key, _copy(value), generation)
+            return value
+        return _copy(value)
+
+    def lookup_many(self, kind, keys, load_many, negative=False):
+        """
+        Returns a dict with the values of the keys that are cached or can
+        be loaded. load_many is called once with the missing keys and
+        returns a dict as well
+        """
+        cache = self.caches.get(kind)
+        if cache is None:
+            return load_many(keys)
+        found = {}
+        missing = []
+        for key in keys:
+            value = cache.get(key)
+            if value is MISSING:
+                missing.append(key)
+            else:
+                found[key] = _copy(value)
+        if missing:
+            generation = cache.generation
+            if self.shared is not None:
+                loaded = self.shared.lookup_many(kind, missing, load_many, negative)
+            else:
+                loaded = load_many(missing)
+            for key in missing:
+                value = loaded.get(key)
+                if value is not None or negative:
+                    cache.set(key, _copy(value), generation)
+            found.update(loaded)
+        return found
+
+    def drop(self, kind, keys):
+        """
+        Drops keys from this process only, for invalidations made by other
+        instances
+        """
+        cache = self.caches.get(kind)
+        if cache is not None:
+            cache.invalidate(keys)
+
+    def clear(self):
+        for cache in self.caches.values():
+            cache.clear()
+
+    def _invalidate(self, kind, keys):
+        if kind not in self.caches:
+            return
+        self.drop(kind, keys)
+        if self.shared is not None:
+            self.shared.invalidate(kind, keys)
+
+    def invalidate_card(self, card_id):
+        """
+        Drops a credit_card and the list of its orders
+        """
+        self._invalidate(constants.credit_cards, [int(card_id)])
+        self._invalidate(constants.card_order, [("card", int(card_id))])
+
+    def invalidate_order(self, order_id):
+        """
+        Drops an order and the id of the credit_card holding it
+        """
+        self._invalidate(constants.orders, [int(order_id)])
+        self._invalidate(constants.card_order, [("order", int(order_id))])
+
+    def invalidate_cards_list(self, owner):
+        """
+        Drops the first page and the count of the credit_cards of an owner
+        """
+        self._invalidate(constants.credit_cards, [("page", owner), ("count", owner)])
+
+    def invalidate_orders_list(self):
+        """
+        Drops the first page and the count of the orders
+        """
+        self._invalidate(constants.orders, [("page",), ("count",)])
+
+    def render(self):
+        """
+        Returns the hit and miss counters and the size of every cache in
+        the Prometheus text format
+        """
+        tiers = [("local", {kind: self.caches[kind].stats for kind in self.caches})]
+        if self.shared is not None:
+            tiers.append(("shared", self.shared.stats))
+        lines = ["# HELP entity_cache_requests_total Entity cache lookups, by kind, tier and result.",
+                 "# TYPE entity_cache_requests_total counter"]
+        for tier, tier_stats in tiers:
+            for kind in sorted(tier_stats):
+                for result, name in (("hit", "hits"), ("miss", "misses")):
+                    lines.append('entity_cache_requests_total{kind="%s",tier="%s",result="%s"} %d'
+                                 % (kind, tier, result, tier_stats[kind][name]))
+        if self.shared is not None:
+            lines += ["# HELP entity_cache_shared_errors_total Failed calls to the shared cache tier.",
+                      "# TYPE entity_cache_shared_errors_total counter",
+                      "entity_cache_shared_errors_total %d" % self.shared.errors]
+        lines += ["# HELP entity_cache_entries Entries held by the entity cache, by kind.",
+                  "# TYPE entity_cache_entries gauge"]
+        for kind in sorted(self.caches):
+            lines.append('entity_cache_entries{kind="%s"} %d' % (kind, len(self.caches[kind])))
+        return "\n".join(lines) + "\n"
+
+
+class CachedCards(object):
+    """
+    Serves credit_card lookups of a repository from the cache. Pass
+    fresh=True to read through to storage, e.g. before a write
+    """
+
+    def __init__(self, repository, cache):
+        self._repository = repository
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._repository, name)
+
+    def get(self, card_id, fresh=False):
+        if fresh:
+            return self._repository.get(card_id)
+        return self._cache.lookup(constants.credit_cards, int(card_id),
+                                  lambda: self._repository.get(card_id))
+
+    def page(self, owner, limit, offset=None, cursor=None, properties=None, criteria=None):
+        if (offset is not None or cursor or limit != pagination.DEFAULT_LIMIT
+                or properties is not None or criteria):
+            return self._repository.page(owner, limit, offset=offset, cursor=cursor,
+                                         properties=properties, criteria=criteria)
+        return self._cache.lookup(constants.credit_cards, ("page", owner),
+                                  lambda: tuple(self._repository.page(owner, limit)))
+
+    def count(self, owner, criteria=None):
+        if criteria:
+            return self._repository.count(owner, criteria)
+        return self._cache.lookup(constants.credit_cards, ("count", owner),
+                                  lambda: self._repository.count(owner))
+
+
+class CachedOrders(object):
+    """
+    Serves order lookups of a repository from the cache
+    """
+
+    def __init__(self, repository, cache):
+        self._repository = repository
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._repository, name)
+
+    def get(self, order_id, fresh=False):
+        if fresh:
+            return self._repository.get(order_id)
+        return self._cache.lookup(constants.orders, int(order_id),
+                                  lambda: self._repository.get(order_id))
+
+    def page(self, limit, offset=None, cursor=None, properties=None, criteria=None):
+        if (offset is not None or cursor or limit != pagination.DEFAULT_LIMIT
+                or properties is not None or criteria):
+            return self._repository.page(limit, offset=offset, cursor=cursor,
+                                         properties=properties, criteria=criteria)
+        return self._cache.lookup(constants.orders, ("page",),
+                                  lambda: tuple(self._repository.page(limit)))
+
+    def count(self, criteria=None):
+        if criteria:
+            return self._repository.count(criteria)
+        return self._cache.lookup(constants.orders, ("count",), self._repository.count)
+
+    def get_multi(self, order_ids):
+        def load_many(ids):
+            return {e.key.id: e for e in self._repository.get_multi(ids)}
+        order_ids = [int(order_id) for order_id in order_ids]
+        found = self._cache.lookup_many(constants.orders, order_ids, load_many)
+        return [found[order_id] for order_id in order_ids if order_id in found]
+
+
+class CachedRelationships(object):
+    """
+    Serves relationship lookups of a repository from the cache, including
+    the fact that an order is on no credit_card. Bulk readers pass
+    fresh=True so they do not push everything else out
+    """
+
+    def __init__(self, repository, cache):
+        self._repository = repository
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._repository, name)
+
+    def card_for_order(self, order_id, fresh=False):
+        if fresh:
+            return self._repository.card_for_order(order_id)
+        return self._cache.lookup(constants.card_order, ("order", int(order_id)),
+                                  lambda: self._repository.card_for_order(order_id),
+                                  negative=True)
+
+    def cards_for_orders(self, order_ids, fresh=False):
+        if fresh:
+            return self._repository.cards_for_orders(order_ids)
+
+        def load_many(keys):
+            cards = self._repository.cards_for_orders([order_id for _, order_id in keys])
+            return {("order", order_id): card_id for order_id, card_id in cards.items()}
+        found = self._cache.lookup_many(constants.card_order,
+                                        [("order", int(order_id)) for order_id in order_ids],
+                                        load_many, negative=True)
+        return {order_id: card_id for (_, order_id), card_id in found.items()
+                if card_id is not None}
+
+    def orders_for_card(self, card_id):
+        return self._cache.lookup(constants.card_order, ("card", int(card_id)),
+                                  lambda: self._repository.orders_for_card(card_id))
+
+    def orders_for_cards(self, card_ids, fresh=False):
+        if fresh:
+            return self._repository.orders_for_cards(card_ids)
+
+        def load_many(keys):
+            orders = self._repository.orders_for_cards([card_id for _, card_id in keys])
+            return {("card", card_id): order_ids for card_id, order_ids in orders.items()}
+        found = self._cache.lookup_many(constants.card_order,
+                                        [("card", int(card_id)) for card_id in card_ids],
+                                        load_many)
+        return {card_id: order_ids for (_, card_id), order_ids in found.items()}
+
+
+def init_app(app):
+    """
+    Puts an entity cache in front of the storage backend of the app,
+    configured by ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL and
+    ENTITY_CACHE_DISABLED, and by SHARED_CACHE_URL and SHARED_CACHE_TTL
+    for the shared tier
+    """
+    cache = EntityCache(app.config.get("ENTITY_CACHE_SIZE", ENTITY_CACHE_SIZE),
+                        app.config.get("ENTITY_CACHE_TTL", ENTITY_CACHE_TTL),
+                        app.config.get("ENTITY_CACHE_DISABLED", ()))
+    app.extensions["entity_cache"] = cache
+
+    store = app.extensions["storage"]
+    if app.config.get("SHARED_CACHE_URL"):
+        cache.shared = shared_cache.SharedCache(
+            shared_cache.create_client(app.config["SHARED_CACHE_URL"]), store.entity,
+            app.config.get("SHARED_CACHE_TTL", shared_cache.SHARED_CACHE_TTL))
+        cache.shared.start_listener(cache)
+
+    store.cards = CachedCards(store.cards, cache)
+    store.orders = CachedOrders(store.orders, cache)
+    store.relationships = CachedRelationships(store.relationships, cache)
+    metrics.add_collector(app, cache.render)
@@ -0,0 +1,58 @@
+"""
+Streams whole collections as newline-delimited JSON (NDJSON), for bulk
+consumers such as the nightly reconciliation.
+
+The collection is read in batches of EXPORT_BATCH_SIZE with one query
+each, and the relationships of every batch are joined with one batched
+lookup, so memory stays flat however large the collection is. Nothing is
+counted. Every batch is followed by a checkpoint line
+
+    {"next": "<URL resuming after this batch>"}
+
+and the stream ends with {"next": null, "exported": <entities sent>}, so
+a consumer can tell a complete export from a cut one and continue an
+interrupted export from the last checkpoint it read. Entities sent after
+that checkpoint are sent again. Headers go out before the first batch is
+read and WSGI has no trailers, so the cursors are part of the stream.
+The Datastore usage of an export is reported when the stream is closed,
+against an RPC budget per batch.
+"""
+from flask import Response, stream_with_context
+
+import datastore_usage
+import pagination
+import serialization
+
+EXPORT_BATCH_SIZE = 500
+
+MIMETYPE = "application/x-ndjson"
+
+
+def stream(fetch, build, request, scope):
+    """
+    Returns a response streaming every entity fetch returns, starting at
+    the cursor parameter of the request. fetch(limit, cursor) returns a
+    batch and the next page token like a storage page function, and
+    build(entities) returns the outputs of a batch. Raises ValueError for
+    a bad cursor
+    """
+    token = None
+    if request.args.get("cursor"):
+        token = pagination.decode_cursor(request.args["cursor"], scope)
+
+    def generate(token):
+        exported = 0
+        while True:
+            entities, token = fetch(EXPORT_BATCH_SIZE, cursor=token)
+            datastore_usage.add_batch()
+            if entities:
+                yield serialization.dumps_lines(build(entities))
+                exported += len(entities)
+            # an empty batch ends the export even if storage gave a token
+            if not token or not entities:
+                break
+            next_url = pagination.page_url(request, cursor=pagination.encode_cursor(token, scope))
+            yield serialization.dumps_lines([{"next": next_url}])
+        yield serialization.dumps_lines([{"next": None, "exported": exported}])
+
+    return Response(stream_with_context(generate(token)), mimetype=MIMETYPE)
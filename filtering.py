@@ -0,0 +1,219 @@
+"""
+Filters and sort orders for the list endpoints, read from the query
+string and pushed down to storage:
+
+    status=pending                   equality
+    order_total[gte]=10              range, with gt, gte, lt or lte
+    sort=status,-date_created        ascending, or descending with "-"
+
+FILTERS names the properties of each kind that can be filtered and
+sorted on. Like Datastore, a query can have range filters on one
+property only, and must then be sorted on it first. A query is only
+accepted if Datastore can answer it from its built-in indexes or from a
+composite index in INDEXES, which mirrors index.yaml, so no request
+falls back to reading the whole collection.
+
+Datastore keeps integers and doubles as separate types: a filter only
+matches values of its own type, and doubles sort after strings. So that
+order_total[gte]=10 also finds a total of 10.5, numeric properties are
+stored as doubles by every backend (see store_numbers) and numeric
+filter values are read as doubles. Storage without indexes follows the
+same type rules. Orders stored before that are converted by
+migrate_order_totals.py.
+"""
+import constants
+
+OPERATORS = {"gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+
+
+def _number(value):
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError("not a number: " + value)
+
+
+# properties that can be filtered and sorted on, with the type of their
+# values, by kind
+FILTERS = {
+    constants.credit_cards: {"type": str},
+    constants.orders: {"status": str, "date_created": str, "order_total": _number},
+}
+
+def store_numbers(kind, properties):
+    """
+    Converts the numeric filter properties of an entity of a kind to
+    doubles before it is stored. Values that are not numbers are left
+    alone, and never match a numeric filter
+    """
+    for name, parse in FILTERS[kind].items():
+        value = properties.get(name)
+        if parse is _number and isinstance(value, int) and not isinstance(value, bool):
+            properties[name] = float(value)
+
+
+# composite indexes in index.yaml: the properties with equality filters,
+# then the sort orders as (property, descending)
+INDEXES = {
+    constants.credit_cards: [
+        (("owner",), (("type", False),)),
+        (("owner",), (("type", True),)),
+    ],
+    constants.orders: [
+        (("status",), (("date_created", False),)),
+        (("status",), (("date_created", True),)),
+        (("status",), (("order_total", False),)),
+        (("status",), (("order_total", True),)),
+    ],
+}
+
+# query parameters that are not filters
+RESERVED = ("limit", "offset", "cursor", "count", "fields", "expand", "sort")
+
+
+class Criteria(object):
+    """
+    The filters, as (property, operator, value), and the sort orders, as
+    (property, descending), of a list request
+    """
+
+    def __init__(self, filters=(), orders=()):
+        self.filters = list(filters)
+        self.orders = list(orders)
+
+    def __bool__(self):
+        return bool(self.filters or self.orders)
+
+    def label(self, scope):
+        """
+        Tags a cursor scope with the criteria, since a cursor only works
+        for the query that produced it
+        """
+        if not self:
+            return scope
+        filters = ",".join("%s%s%r" % f for f in self.filters)
+        orders = ",".join(("-" if descending else "") + name for name, descending in self.orders)
+        return scope + "|" + filters + "|" + orders
+
+    def apply(self, query, sort=True):
+        """
+        Adds the filters, and the sort orders if sort is set, to a
+        Datastore query
+        """
+        for name, operator, value in self.filters:
+            query.add_filter(name, operator, value)
+        if sort and self.orders:
+            query.order = [("-" if descending else "") + name for name, descending in self.orders]
+
+    def matches(self, properties):
+        for name, operator, value in self.filters:
+            stored = properties.get(name)
+            # like Datastore, values only compare with values of their
+            # type, and integers and doubles are different types
+            if type(stored) is not type(value):
+                return False
+            if operator == "=" and not stored == value \
+                    or operator == ">" and not stored > value \
+                    or operator == ">=" and not stored >= value \
+                    or operator == "<" and not stored < value \
+                    or operator == "<=" and not stored <= value:
+                return False
+        return True
+
+    def select(self, rows, ids):
+        """
+        Returns the ids whose rows match the filters, in the sort order,
+        for storage without indexes. Like Datastore, rows without a sort
+        property are left out
+        """
+        ids = [i for i in ids if self.matches(rows[i])
+               and all(name in rows[i] for name, _ in self.orders)]
+        for name, descending in reversed(self.orders):
+            # sorts are stable, so ties keep the order of the ids
+            ids.sort(key=lambda i: _sort_key(rows[i].get(name)), reverse=descending)
+        return ids
+
+
+def _sort_key(value):
+    # integers, then strings, then doubles, like Datastore orders values
+    # of mixed types
+    if isinstance(value, float):
+        return (2, value)
+    if isinstance(value, int):
+        return (0, value)
+    return (1, str(value))
+
+
+def _parse_filters(args, kind, attributes):
+    """
+    Returns the filters in the query parameters. Raises ValueError for
+    filters on other attributes or with bad values
+    """
+    types = FILTERS[kind]
+    filters = []
+    for param, values in args.lists():
+        name, operator = param, "="
+        if param.endswith("]") and "[" in param:
+            name, suffix = param[:-1].split("[", 1)
+            if suffix not in OPERATORS:
+                raise ValueError("unknown filter operator: " + suffix)
+            operator = OPERATORS[suffix]
+        elif param in RESERVED or param not in attributes:
+            # other parameters are left to the endpoint
+            continue
+        if name not in types:
+            raise ValueError("can not filter on " + name)
+        if len(values) > 1:
+            raise ValueError("repeated filter: " + param)
+        filters.append((name, operator, types[name](values[0])))
+    return filters
+
+
+def _parse_orders(args, kind):
+    orders = []
+    for item in args.get("sort", "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        descending = item.startswith("-")
+        name = item.lstrip("-")
+        if name not in FILTERS[kind] or name in [n for n, _ in orders]:
+            raise ValueError("can not sort on " + name)
+        orders.append((name, descending))
+    return orders
+
+
+def parse(args, kind, attributes, equality=()):
+    """
+    Returns the Criteria of a list request on a kind from its query
+    parameters. Parameters named like one of the attributes of its outputs
+    are taken as filters, and equality names the properties the endpoint
+    itself filters on, e.g. the owner. Raises ValueError if the parameters
+    are invalid or no index can answer the query
+    """
+    filters = _parse_filters(args, kind, attributes)
+    orders = _parse_orders(args, kind)
+
+    equal = [name for name, operator, _ in filters if operator == "="]
+    ranged = sorted(set(name for name, operator, _ in filters if operator != "="))
+    if len(set(equal)) < len(equal) or set(equal) & set(ranged):
+        raise ValueError("a property can have one equality filter and no range filter with it")
+    if len(ranged) > 1:
+        raise ValueError("range filters are only allowed on one property")
+
+    # sorting on a property with an equality filter changes nothing
+    orders = [(name, descending) for name, descending in orders if name not in equal]
+    if ranged:
+        if not orders:
+            orders = [(ranged[0], False)]
+        elif orders[0][0] != ranged[0]:
+            raise ValueError("the first sort order must be on " + ranged[0])
+
+    equal = set(equal) | set(equality)
+    # built-in indexes answer equality filters alone, and one sort order
+    # with no equality filter; anything else needs a composite index
+    if orders and (equal or len(orders) > 1):
+        if not any(set(index_equal) == equal and tuple(index_orders) == tuple(orders)
+                   for index_equal, index_orders in INDEXES[kind]):
+            raise ValueError("no index for this combination of filters and sort orders")
+    return Criteria(filters, orders)
@@ -0,0 +1,158 @@
+import threading
+import time
+
+import auth0_client
+
+# how long a downloaded JWKS is considered fresh, in seconds
+JWKS_TTL = 600
+
+# minimum number of seconds between two forced re-fetches caused by
+# tokens signed with a kid we have never seen
+UNKNOWN_KID_REFETCH_INTERVAL = 30
+
+
+def fetch_jwks(url):
+    """
+    Downloads and parses a JWKS document over the shared Auth0 session
+    """
+    response = auth0_client.get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+class JWKSCache(object):
+    """
+    A process-wide store for the signing keys published by Auth0.
+
+    Keys are served from memory. Once the TTL has passed the stale keys are
+    still served while a single background thread downloads a fresh copy,
+    and if that download fails the stale keys keep being used until the
+    next attempt, which waits for refetch_interval. On a cold start one
+    request downloads the keys while the others wait for it. A token
+    signed with an unknown kid triggers at most one synchronous re-fetch
+    per UNKNOWN_KID_REFETCH_INTERVAL.
+
+    If prepare_key is given, every key is passed through it once per JWKS
+    version so callers get ready-to-use public key objects indexed by kid.
+    """
+
+    def __init__(self, url, ttl=JWKS_TTL,
+                 refetch_interval=UNKNOWN_KID_REFETCH_INTERVAL, fetch=fetch_jwks,
+                 prepare_key=None):
+        self.url = url
+        self.ttl = ttl
+        self.refetch_interval = refetch_interval
+        self.fetch = fetch
+        self.prepare_key = prepare_key
+
+        # bumped every time a new JWKS is swapped in
+        self.version = 0
+
+        self._keys = None
+        self._fetched_at = 0
+        self._last_attempt = None
+        self._last_forced_refresh = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        # held by the request loading the keys on a cold start
+        self._load_lock = threading.Lock()
+
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0,
+                      "refresh_errors": 0, "stale_served": 0}
+
+    def _refresh(self):
+        """
+        Downloads the JWKS and swaps it in, keeping the old keys on failure
+        """
+        with self._lock:
+            self._last_attempt = time.monotonic()
+        keys = None
+        try:
+            jwks = self.fetch(self.url)
+            keys = {}
+            for key in jwks["keys"]:
+                rsa_key = {
+                    "kty": key["kty"],
+                    "kid": key["kid"],
+                    "use": key["use"],
+                    "n": key["n"],
+                    "e": key["e"]
+                }
+                if self.prepare_key is not None:
+                    rsa_key = self.prepare_key(rsa_key)
+                keys[key["kid"]] = rsa_key
+        except Exception:
+            keys = None
+        finally:
+            # the flag is only cleared once the new keys are in place, so
+            # no other thread starts a refresh in between
+            with self._lock:
+                if keys is None:
+                    self.stats["refresh_errors"] += 1
+                else:
+                    self._keys = keys
+                    self._fetched_at = time.monotonic()
+                    self.version += 1
+                    self.stats["refreshes"] += 1
+                self._refreshing = False
+        return keys is not None
+
+    def _may_retry(self, now):
+        # a failed download is not retried before refetch_interval passes
+        return self._last_attempt is None or now - self._last_attempt >= self.refetch_interval
+
+    def _start_background_refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._refreshing or not self._may_retry(now):
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._refresh, name="jwks-refresh")
+        thread.daemon = True
+        thread.start()
+
+    def _ensure_loaded(self):
+        """
+        Makes sure some keys are available, blocking only on a cold start
+        """
+        if self._keys is None:
+            with self._load_lock:
+                # the request that held the lock may have loaded them, or
+                # failed too recently to try again
+                if self._keys is None and self._may_retry(time.monotonic()):
+                    with self._lock:
+                        self._refreshing = True
+                    self._refresh()
+            return
+
+        if time.monotonic() - self._fetched_at > self.ttl:
+            with self._lock:
+                self.stats["stale_served"] += 1
+            self._start_background_refresh()
+
+    def get_key(self, kid):
+        """
+        Returns the key with the given kid, or None if Auth0 does not
+        publish one
+        """
+        self._ensure_loaded()
+        keys = self._keys or {}
+
+        if kid in keys:
+            with self._lock:
+                self.stats["hits"] += 1
+            return keys[kid]
+
+        # the keys may have been rotated, so re-fetch once but do not
+        # let a stream of bogus kids hammer Auth0
+        now = time.monotonic()
+        with self._lock:
+            self.stats["misses"] += 1
+            if self._refreshing or now - self._last_forced_refresh < self.refetch_interval \
+                    or not self._may_retry(now):
+                return None
+            self._last_forced_refresh = now
+            self._refreshing = True
+        self._refresh()
+
+        return (self._keys or {}).get(kid)
@@ -0,0 +1,141 @@
+import base64
+import json
+import time
+
+from jose import jwk, jwt
+
+ALGORITHMS = ["RS256"]
+
+
+class JoseVerifier(object):
+    """
+    Verifies tokens with python-jose. Keys are constructed once per JWKS
+    version instead of being rebuilt from the JWK dict on every decode.
+    """
+
+    name = "jose"
+
+    def prepare_key(self, key):
+        return jwk.construct(key, ALGORITHMS[0])
+
+    def decode(self, token, key, audience, issuer):
+        return jwt.decode(token, key, algorithms=ALGORITHMS,
+                          audience=audience, issuer=issuer)
+
+
+def _b64_to_int(value):
+    return int.from_bytes(_b64decode(value), "big")
+
+
+def _b64decode(value):
+    if isinstance(value, str):
+        value = value.encode("ascii")
+    return base64.urlsafe_b64decode(value + b"=" * (-len(value) % 4))
+
+
+def _validate_claims(claims, audience, issuer):
+    """
+    Runs the claim checks python-jose's jwt.decode runs with its default
+    options, raising the same exceptions with the same messages
+    """
+    now = int(time.time())
+    for name, message in (("iat", "Issued At claim (iat) must be an integer."),
+                          ("nbf", "Not Before claim (nbf) must be an integer."),
+                          ("exp", "Expiration Time claim (exp) must be an integer.")):
+        if name in claims:
+            try:
+                int(claims[name])
+            except (TypeError, ValueError):
+                raise jwt.JWTClaimsError(message)
+    if "nbf" in claims and int(claims["nbf"]) > now:
+        raise jwt.JWTClaimsError("The token is not yet valid (nbf)")
+    if "exp" in claims and int(claims["exp"]) < now:
+        raise jwt.ExpiredSignatureError("Signature has expired.")
+
+    if "aud" in claims:
+        audience_claims = claims["aud"]
+        if isinstance(audience_claims, str):
+            audience_claims = [audience_claims]
+        if not isinstance(audience_claims, list) \
+                or any(not isinstance(c, str) for c in audience_claims):
+            raise jwt.JWTClaimsError("Invalid claim format in token")
+        if audience not in audience_claims:
+            raise jwt.JWTClaimsError("Invalid audience")
+
+    if issuer is not None:
+        if isinstance(issuer, str):
+            issuer = (issuer,)
+        if claims.get("iss") not in issuer:
+            raise jwt.JWTClaimsError("Invalid issuer")
+
+    if "sub" in claims and not isinstance(claims["sub"], str):
+        raise jwt.JWTClaimsError("Subject must be a string.")
+    if "jti" in claims and not isinstance(claims["jti"], str):
+        raise jwt.JWTClaimsError("JWT ID must be a string.")
+
+
+class CryptographyVerifier(object):
+    """
+    Checks the RS256 signature directly against a pre-built
+    cryptography RSAPublicKey and validates the claims itself, without
+    parsing the token again in python-jose. Errors are raised as the
+    same python-jose exceptions.
+    """
+
+    name = "cryptography"
+
+    def __init__(self):
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+        self._invalid_signature = InvalidSignature
+        self._hash = hashes.SHA256
+        self._padding = padding.PKCS1v15
+        self._public_numbers = rsa.RSAPublicNumbers
+
+    def prepare_key(self, key):
+        numbers = self._public_numbers(_b64_to_int(key["e"]), _b64_to_int(key["n"]))
+        return numbers.public_key()
+
+    def decode(self, token, key, audience, issuer):
+        try:
+            signing_input, signature = token.encode("ascii").rsplit(b".", 1)
+            header_segment, claims_segment = signing_input.split(b".")
+            header = json.loads(_b64decode(header_segment))
+            signature = _b64decode(signature)
+        except (ValueError, UnicodeError, AttributeError) as ex:
+            raise jwt.JWTError(ex)
+
+        if not isinstance(header, dict) or header.get("alg") not in ALGORITHMS:
+            raise jwt.JWTError("The specified alg value is not allowed")
+
+        try:
+            key.verify(signature, signing_input, self._padding(), self._hash())
+        except self._invalid_signature:
+            raise jwt.JWTError("Signature verification failed.")
+
+        try:
+            claims = json.loads(_b64decode(claims_segment))
+        except (ValueError, UnicodeError) as ex:
+            raise jwt.JWTError("Invalid payload string: %s" % ex)
+        if not isinstance(claims, dict):
+            raise jwt.JWTError("Invalid payload string: must be a json object")
+
+        _validate_claims(claims, audience, issuer)
+        return claims
+
+
+VERIFIERS = {
+    JoseVerifier.name: JoseVerifier,
+    CryptographyVerifier.name: CryptographyVerifier,
+}
+
+
+def get_verifier(name):
+    """
+    Returns the verifier backend registered under the given name
+    """
+    if name not in VERIFIERS:
+        raise ValueError("Unknown JWT verifier backend: " + str(name))
+    return VERIFIERS[name]()
@@ -1,5 +1,4 @@
-from google.cloud import datastore
-from flask import Flask, request, make_response, render_template, jsonify, _request_ctx_stack
+from flask import Flask, Blueprint, current_app, request, make_response, render_template, jsonify, _request_ctx_stack
 import json
 import requests
 
@@ -21,18 +20,19 @@ from six.moves.urllib.parse import urlencode
 
 import http.client
 
+import auth0_client
 import constants
 # import user
 import credit_card
 import order
 # import user_card
 import card_order
-
-
-app = Flask(__name__)
-app.secret_key = 'SECRET_KEY'
-
-client = datastore.Client()
+import datastore_usage
+import entity_cache
+import metrics
+import pagination
+import serialization
+import storage
 
 CLIENT_ID = ''
 CLIENT_SECRET = ''
@@ -40,12 +40,22 @@ DOMAIN = 'benitema-final.us.auth0.com'
 AUDIENCE = f'https://{DOMAIN}/api/v2/'
 GRANT_TYPE = "client_credentials"
 
+# lets the Management API be pointed at a local stand-in
+AUTH0_BASE_URL = env.get('AUTH0_BASE_URL', f'https://{DOMAIN}')
+
+# reused by every GET /users until shortly before it expires
+management_token = auth0_client.ManagementTokenCache(
+    f'{AUTH0_BASE_URL}/oauth/token', CLIENT_ID, CLIENT_SECRET, AUDIENCE)
+
+# most users returned by one GET /users page
+MAX_USERS_LIMIT = 100
+
 CALLBACK_URL = 'https://final-project-benitema.wl.r.appspot.com/callback'
 
 ALGORITHMS = ["RS256"]
 
-# initialize Authlib
-oauth = OAuth(app)
+# initialize Authlib, bound to the app in create_app()
+oauth = OAuth()
 
 auth0 = oauth.register(
     'auth0',
@@ -59,31 +69,26 @@ auth0 = oauth.register(
     },
 )
 
-app.register_blueprint(credit_card.bp)
-app.register_blueprint(order.bp)
-app.register_blueprint(card_order.bp)
+bp = Blueprint('main', __name__)
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
         self.error = error
         self.status_code = status_code
 
-@app.errorhandler(AuthError)
+@bp.errorhandler(AuthError)
 def handle_auth_error(ex):
     response = jsonify(ex.error)
     response.status_code = ex.status_code
     return response
 
-@app.route('/')
+@bp.route('/')
 def index():
     return render_template('home.html')
 
-@app.route('/users', methods=['GET'])
+@bp.route('/users', methods=['GET'])
 def get_users():
 
-    client_id = ''
-    client_secret = ''
-
     if request.method == 'GET':
 
         if not request.accept_mimetypes['application/json']:
@@ -92,42 +97,73 @@ def get_users():
                 "Not acceptable. "
                 "Only application/json content type supported"}, 406)
 
-        base_url = f"https://{DOMAIN}"
-        payload =   {
-                    'grant_type': GRANT_TYPE,
-                    'client_id': client_id,
-                    'client_secret': client_secret,
-                    'audience': AUDIENCE
-                    }
-        response = requests.post(f'{base_url}/oauth/token', data=payload)
-        oauth = response.json()
-        access_token = oauth.get('access_token')
-
-        # Add the token to the Authorization header of the request
-        headers =   {
-                    'Authorization': f'Bearer {access_token}',
-                    'Content-Type': 'application/json'
-                    }
-        # url = 'https://' + DOMAIN + '/api/v2/users'
-        r = requests.get(f'{base_url}/api/v2/users', headers=headers)
-        user_item = []
-
+        # set limit of users per page to 5, like the other collections
+        try:
+            q_limit = int(request.args.get('limit', '5'))
+            q_offset = int(request.args.get('offset', '0'))
+        except ValueError:
+            q_limit = q_offset = -1
+        if q_limit < 1 or q_offset < 0:
+            raise AuthError({"code": "Bad Request",
+                            "description":
+                            "Bad request. "
+                            "limit and offset must be non-negative integers"}, 400)
+
+        # Auth0 only lists the first USERS_LIST_LIMIT users
+        if q_offset >= auth0_client.USERS_LIST_LIMIT:
+            raise AuthError({"code": "Bad Request",
+                            "description":
+                            "Bad request. "
+                            "Only the first " + str(auth0_client.USERS_LIST_LIMIT) +
+                            " users can be listed"}, 400)
+
+        # at most MAX_USERS_LIMIT users per page, so one request can not
+        # fan out into many Management API calls
+        q_limit = min(q_limit, MAX_USERS_LIMIT, auth0_client.USERS_LIST_LIMIT - q_offset)
+
+        # every page is read before responding rather than streamed, so a
+        # failed page turns into a 502 instead of a cut 200; MAX_USERS_LIMIT
+        # keeps the buffered response small
+        url = f'{AUTH0_BASE_URL}/api/v2/users'
         keys = ('name', 'user_id')
 
-        data = json.loads(r.text)
-        resp = jsonify(data)
-        for x in resp.json[:]:
-            user_item.append({key: x[key] for key in keys if key in x})
-
-        users = {'Users': user_item}
-        
-        return(users, 200)
+        try:
+            try:
+                total, user_items = auth0_client.users_window(
+                    url, management_token.get_token(), q_offset, q_limit, keys)
+            except requests.HTTPError as ex:
+                # the token may have been revoked before its expiry, so
+                # fetch a new one and try once more
+                if ex.response is None or ex.response.status_code != 401:
+                    raise
+                management_token.invalidate()
+                total, user_items = auth0_client.users_window(
+                    url, management_token.get_token(), q_offset, q_limit, keys)
+        except requests.RequestException:
+            # also covers Auth0 being unreachable or timing out
+            raise AuthError({"code": "Bad Gateway",
+                            "description":
+                            "Bad gateway. "
+                            "The user directory could not be read"}, 502)
+
+        # build next_url
+        if q_offset + q_limit < min(total, auth0_client.USERS_LIST_LIMIT):
+            next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(q_offset + q_limit)
+        else:
+            next_url = None
+
+        output = {"Users": user_items}
+        if next_url:
+            output["next"] = next_url
+        output["items_in_collection"] = total
+
+        return current_app.response_class(serialization.dumps(output), status=200, mimetype='application/json')
 
     else:
         return 'Method not recognized'
 
 
-@app.route('/login', methods=['POST'])
+@bp.route('/login', methods=['POST'])
 def login_user():
     content = request.get_json()
     username = content["username"]
@@ -138,13 +174,13 @@ def login_user():
             'client_secret':CLIENT_SECRET
             }
     headers = { 'content-type': 'application/json' }
-    url = 'https://' + DOMAIN + '/oauth/token'
-    r = requests.post(url, json=body, headers=headers)
+    url = AUTH0_BASE_URL + '/oauth/token'
+    r = auth0_client.post(url, json=body, headers=headers)
     return r.text, 200, {'Content-Type':'application/json'}
             
 
 # exchange code for access token and id token
-@app.route('/callback')
+@bp.route('/callback')
 def callback_handling():
     # Handles response from token endpoint
     # Store user JWT in flask session.
@@ -160,26 +196,63 @@ def callback_handling():
     return redirect('/dashboard')
         
 
-@app.route('/ui_login')
+@bp.route('/ui_login')
 def ui_login():
     return auth0.authorize_redirect(redirect_uri=CALLBACK_URL)
     
 
-@app.route('/dashboard')
+@bp.route('/dashboard')
 #@requires_auth
 def dashboard():
     return render_template('info.html', jwt=session['jwt'], avatar=session['avatar'], username=session['username'], user_id=session['user_id'])
 
 # handles user logout
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     # Clear session stored data
     session.clear()
     # user is redirected to logout endpoint
     # after successful logout, user is brought back to welcome page
-    params = {'returnTo': url_for('index', _external=True), 'client_id': CLIENT_ID}
+    params = {'returnTo': url_for('main.index', _external=True), 'client_id': CLIENT_ID}
     return redirect(auth0.api_base_url + '/v2/logout?' + urlencode(params))
 
+
+def create_app(config=None):
+    """
+    Creates the app with every blueprint registered. STORAGE_BACKEND picks
+    where credit cards and orders are kept ("datastore" or "memory") and
+    defaults to the environment variable of the same name, and so do
+    ENTITY_CACHE_DISABLED, a comma separated list of kinds to read without
+    the entity cache, SHARED_CACHE_URL, the server of the cache tier
+    shared by all instances (none by default), and CURSOR_SIGNING_KEY,
+    the secret signing pagination cursors, which must be set
+    """
+    app = Flask(__name__)
+    app.secret_key = 'SECRET_KEY'
+    app.config["STORAGE_BACKEND"] = env.get("STORAGE_BACKEND", "datastore")
+    app.config["ENTITY_CACHE_DISABLED"] = [kind for kind in
+                                           env.get("ENTITY_CACHE_DISABLED", "").split(",") if kind]
+    app.config["SHARED_CACHE_URL"] = env.get("SHARED_CACHE_URL", "")
+    app.config["CURSOR_SIGNING_KEY"] = env.get("CURSOR_SIGNING_KEY", "")
+    app.config.update(config or {})
+    pagination.init_app(app)
+
+    app.extensions["storage"] = metrics.instrument_storage(
+        storage.create_storage(app.config["STORAGE_BACKEND"]))
+    oauth.init_app(app)
+    metrics.init_app(app)
+    entity_cache.init_app(app)
+    datastore_usage.init_app(app)
+
+    app.register_blueprint(bp)
+    app.register_blueprint(credit_card.bp)
+    app.register_blueprint(order.bp)
+    app.register_blueprint(card_order.bp)
+    return app
+
+
+app = create_app()
+
 if __name__ == '__main__':
     app.run(host='localhost', port=8080, debug=True)
     app.secret_key = 'SECRET_KEY'
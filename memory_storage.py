@@ -0,0 +1,379 @@
+"""
+In-memory storage backend with the same interface as the Datastore one in
+storage.py. Used for local development, tests and benchmarks, so nothing
+is persisted. Every lookup the blueprints make is served from an index:
+
+    ids in creation order per owner (credit_cards) and overall (orders)
+    card number -> credit_card id
+    order id -> credit_card id, credit_card id -> order ids
+
+Filtered and sorted lists are the exception: they scan the rows, which
+is fine for the data sizes this backend is meant for.
+"""
+import bisect
+import itertools
+import threading
+
+import batch
+import card_number_index
+import conditional
+import constants
+import filtering
+
+
+class MemoryKey(object):
+
+    def __init__(self, kind, id):
+        self.kind = kind
+        self.id = id
+
+
+class MemoryEntity(dict):
+    """
+    A dict with a key, like a Datastore entity
+    """
+
+    def __init__(self, key, properties=()):
+        super(MemoryEntity, self).__init__(properties)
+        self.key = key
+
+
+def _page(ids, limit, offset=None, cursor=None, by_id=True):
+    """
+    Returns one page of an id list and the next page token. For a sorted
+    list tokens hold the last id of the page, so the next page starts at
+    the right place even after entities are added or deleted. Lists in
+    another order (by_id=False) are walked by position
+    """
+    if offset is not None:
+        start = offset
+    elif cursor:
+        if isinstance(cursor, bytes):
+            cursor = cursor.decode('ascii')
+        start = bisect.bisect_right(ids, int(cursor)) if by_id else int(cursor)
+    else:
+        start = 0
+    page = ids[start:start + limit]
+    next_token = None
+    if start + limit < len(ids):
+        next_token = str(page[-1]) if by_id else str(start + limit)
+    return page, next_token
+
+
+def _select(rows, ids, criteria):
+    """
+    Returns the ids matching criteria, if any, and whether they are still
+    sorted by id
+    """
+    if not criteria:
+        return ids, True
+    return criteria.select(rows, ids), not criteria.orders
+
+
+class MemoryTables(object):
+    """
+    The rows and indexes shared by the repositories. Rows are stored as
+    plain dicts and copied on the way in and out, so callers can modify
+    the entities they get without changing what is stored
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._ids = itertools.count(1)
+
+        self.cards = {}
+        self.cards_by_owner = {}
+        self.card_numbers = {}
+        self.orders = {}
+        self.order_ids = []
+        self.order_cards = {}
+        self.card_orders = {}
+
+    def new_id(self):
+        return next(self._ids)
+
+    def entity(self, kind, rows, row_id, selected=None):
+        """
+        Returns a stored row as an entity, with only the selected
+        properties if any are given, like a projection query
+        """
+        properties = rows.get(row_id)
+        if properties is None:
+            return None
+        if selected is not None:
+            properties = {name: properties[name] for name in selected if name in properties}
+        return MemoryEntity(MemoryKey(kind, row_id), properties)
+
+    def touch(self, rows, row_id):
+        """
+        Gives a stored row a new version, if it exists
+        """
+        if row_id in rows:
+            conditional.bump_version(rows[row_id])
+
+    def attach(self, card_id, order_id):
+        if order_id in self.order_cards:
+            return False
+        self.order_cards[order_id] = card_id
+        self.card_orders.setdefault(card_id, []).append(order_id)
+        self.touch(self.cards, card_id)
+        self.touch(self.orders, order_id)
+        return True
+
+    def detach(self, order_id):
+        card_id = self.order_cards.pop(order_id, None)
+        if card_id is not None:
+            self.card_orders[card_id].remove(order_id)
+            self.touch(self.cards, card_id)
+            self.touch(self.orders, order_id)
+        return card_id
+
+    def insert(self, rows, row_id, properties):
+        rows[row_id] = dict(properties)
+        conditional.bump_version(rows[row_id])
+
+    def update(self, rows, entity):
+        """
+        Stores a modified entity under a new version, which the entity
+        gets as well
+        """
+        row = dict(entity)
+        row[conditional.VERSION] = rows.get(entity.key.id, {}).get(conditional.VERSION)
+        conditional.bump_version(row)
+        entity[conditional.VERSION] = row[conditional.VERSION]
+        rows[entity.key.id] = row
+
+
+class MemoryCards(object):
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def get(self, card_id):
+        t = self.tables
+        with t.lock:
+            return t.entity(constants.credit_cards, t.cards, int(card_id))
+
+    def page(self, owner, limit, offset=None, cursor=None, properties=None, criteria=None):
+        t = self.tables
+        with t.lock:
+            ids, by_id = _select(t.cards, t.cards_by_owner.get(owner, []), criteria)
+            ids, next_token = _page(ids, limit, offset, cursor, by_id)
+            return [t.entity(constants.credit_cards, t.cards, i, properties) for i in ids], next_token
+
+    def count(self, owner, criteria=None):
+        t = self.tables
+        with t.lock:
+            return len(_select(t.cards, t.cards_by_owner.get(owner, []), criteria)[0])
+
+    def create(self, properties):
+        """
+        Stores a new credit_card. Returns None if its card number already
+        belongs to another credit_card
+        """
+        return self.create_many([properties])[0]
+
+    def create_many(self, items):
+        t = self.tables
+        created = []
+        with t.lock:
+            for properties in items:
+                number = card_number_index.normalize(properties["card_number"])
+                if number in t.card_numbers:
+                    created.append(None)
+                    continue
+                card_id = t.new_id()
+                t.insert(t.cards, card_id, properties)
+                t.cards_by_owner.setdefault(properties["owner"], []).append(card_id)
+                t.card_numbers[number] = card_id
+                created.append(t.entity(constants.credit_cards, t.cards, card_id))
+        return created
+
+    def save(self, credit_card):
+        """
+        Saves a modified credit_card. Returns False if its new card number
+        already belongs to another credit_card
+        """
+        t = self.tables
+        card_id = credit_card.key.id
+        number = card_number_index.normalize(credit_card["card_number"])
+        with t.lock:
+            stored = t.cards.get(card_id)
+            old_number = None
+            if stored is not None:
+                old_number = card_number_index.normalize(stored["card_number"])
+            if number != old_number:
+                if t.card_numbers.get(number, card_id) != card_id:
+                    return False
+                if old_number is not None and t.card_numbers.get(old_number) == card_id:
+                    del t.card_numbers[old_number]
+                t.card_numbers[number] = card_id
+            t.update(t.cards, credit_card)
+        return True
+
+    def delete(self, credit_card):
+        """
+        Deletes a credit_card together with its relationships and card
+        number entry. Returns the ids of the orders that were on it, or
+        None without deleting anything if Datastore could not change them
+        all in one commit
+        """
+        t = self.tables
+        card_id = credit_card.key.id
+        with t.lock:
+            if 2 * len(t.card_orders.get(card_id, [])) + 2 > batch.MAX_MUTATIONS:
+                return None
+            properties = t.cards.pop(card_id, None)
+            if properties is None:
+                return []
+            owner_ids = t.cards_by_owner[properties["owner"]]
+            del owner_ids[bisect.bisect_left(owner_ids, card_id)]
+            number = card_number_index.normalize(properties["card_number"])
+            if t.card_numbers.get(number) == card_id:
+                del t.card_numbers[number]
+            order_ids = t.card_orders.pop(card_id, [])
+            for order_id in order_ids:
+                del t.order_cards[order_id]
+                t.touch(t.orders, order_id)
+        return order_ids
+
+
+class MemoryOrders(object):
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def get(self, order_id):
+        t = self.tables
+        with t.lock:
+            return t.entity(constants.orders, t.orders, int(order_id))
+
+    def get_multi(self, order_ids):
+        t = self.tables
+        with t.lock:
+            orders = [t.entity(constants.orders, t.orders, int(order_id)) for order_id in order_ids]
+        return [order for order in orders if order is not None]
+
+    def page(self, limit, offset=None, cursor=None, properties=None, criteria=None):
+        t = self.tables
+        with t.lock:
+            ids, by_id = _select(t.orders, t.order_ids, criteria)
+            ids, next_token = _page(ids, limit, offset, cursor, by_id)
+            return [t.entity(constants.orders, t.orders, i, properties) for i in ids], next_token
+
+    def count(self, criteria=None):
+        t = self.tables
+        with t.lock:
+            if not criteria:
+                return len(t.orders)
+            return len(_select(t.orders, t.order_ids, criteria)[0])
+
+    def create(self, properties):
+        return self.create_many([properties])[0]
+
+    def create_many(self, items):
+        t = self.tables
+        created = []
+        with t.lock:
+            for properties in items:
+                order_id = t.new_id()
+                t.insert(t.orders, order_id, properties)
+                filtering.store_numbers(constants.orders, t.orders[order_id])
+                t.order_ids.append(order_id)
+                created.append(t.entity(constants.orders, t.orders, order_id))
+        return created
+
+    def save(self, order):
+        filtering.store_numbers(constants.orders, order)
+        with self.tables.lock:
+            self.tables.update(self.tables.orders, order)
+
+    def delete(self, order):
+        """
+        Deletes an order and takes it off its credit card. Returns the id
+        of that credit card, or None
+        """
+        t = self.tables
+        with t.lock:
+            if t.orders.pop(order.key.id, None) is None:
+                return None
+            del t.order_ids[bisect.bisect_left(t.order_ids, order.key.id)]
+            return t.detach(order.key.id)
+
+
+class MemoryRelationships(object):
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def card_for_order(self, order_id):
+        with self.tables.lock:
+            return self.tables.order_cards.get(int(order_id))
+
+    def cards_for_orders(self, order_ids):
+        t = self.tables
+        with t.lock:
+            return {order_id: t.order_cards[order_id] for order_id in order_ids
+                    if order_id in t.order_cards}
+
+    def orders_for_card(self, card_id):
+        with self.tables.lock:
+            return list(self.tables.card_orders.get(int(card_id), []))
+
+    def orders_for_cards(self, card_ids):
+        t = self.tables
+        with t.lock:
+            return {card_id: list(t.card_orders.get(card_id, [])) for card_id in card_ids}
+
+    def attach(self, card_id, order_id):
+        """
+        Puts an order on a credit_card. Returns False if the order is
+        already on a card
+        """
+        with self.tables.lock:
+            return self.tables.attach(int(card_id), int(order_id))
+
+    def detach(self, order_id):
+        with self.tables.lock:
+            return self.tables.detach(int(order_id))
+
+    def change_card_orders(self, card_id, attach_ids, detach_ids):
+        """
+        Attaches and detaches several orders of a credit_card at once.
+        Returns the same problems dict as relationships.change_card_orders,
+        without changing anything, if some order can not be moved
+        """
+        t = self.tables
+        card_id = int(card_id)
+        with t.lock:
+            order_ids = list(attach_ids) + list(detach_ids)
+            problems = {
+                "card_missing": card_id not in t.cards,
+                "missing": [o for o in order_ids if o not in t.orders],
+                "taken": [o for o in attach_ids if t.order_cards.get(o, card_id) != card_id],
+                "not_on_card": [o for o in detach_ids if t.order_cards.get(o) != card_id],
+            }
+            if any(problems.values()):
+                return problems
+            for order_id in attach_ids:
+                t.attach(card_id, order_id)
+            for order_id in detach_ids:
+                t.detach(order_id)
+        return None
+
+
+class MemoryStorage(object):
+    """
+    Keeps everything in process memory behind one lock
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self.tables = MemoryTables()
+        self.cards = MemoryCards(self.tables)
+        self.orders = MemoryOrders(self.tables)
+        self.relationships = MemoryRelationships(self.tables)
+
+    def entity(self, kind, entity_id, properties):
+        return MemoryEntity(MemoryKey(kind, entity_id), properties)
@@ -0,0 +1,244 @@
+"""
+Request latency histograms, exposed in the Prometheus text format on
+/metrics.
+
+Every request is observed once in http_request_duration_seconds by route
+template, method and status. The time spent in each phase of the request
+(auth, storage, relationship_join, serialization) is added up while the
+request runs and observed in http_request_phase_duration_seconds with
+the same labels when it finishes. Recording a phase costs two
+perf_counter calls and a dict update; the histograms take one lock per
+request.
+"""
+import bisect
+import functools
+import threading
+import time
+
+from flask import Blueprint, Response, current_app, g, has_request_context, request
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+PHASES = ("auth", "storage", "relationship_join", "serialization")
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+class Histogram(object):
+    """
+    A thread-safe histogram with a fixed set of label names
+    """
+
+    def __init__(self, name, documentation, labelnames, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe_many(self, observations):
+        """
+        Records several (label values, seconds) pairs under one lock
+        """
+        with self._lock:
+            for labels, value in observations:
+                series = self._series.get(labels)
+                if series is None:
+                    # one count per bucket plus +Inf, then the sum
+                    series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+                series[bisect.bisect_left(self.buckets, value)] += 1
+                series[-1] += value
+
+    def observe(self, labels, value):
+        self.observe_many([(labels, value)])
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s histogram" % self.name]
+        for labels, values in series:
+            label_text = ",".join('%s="%s"' % (name, _escape(value))
+                                  for name, value in zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_bound(bound)
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label_text, le, cumulative))
+            lines.append("%s_sum{%s} %r" % (self.name, label_text, values[-1]))
+            lines.append("%s_count{%s} %d" % (self.name, label_text, cumulative))
+        return "\n".join(lines) + "\n"
+
+
+request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling a request, by route, method and status.",
+    ("route", "method", "status"))
+
+phase_seconds = Histogram(
+    "http_request_phase_duration_seconds",
+    "Time spent in each phase of a request, by route, method and status.",
+    ("route", "method", "status", "phase"))
+
+
+def add_phase_time(phase, seconds):
+    """
+    Adds time spent in a phase to the current request, if there is one
+    """
+    if has_request_context():
+        phases = g.get("metrics_phases")
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+class phase(object):
+    """
+    Context manager timing a block as part of a phase of the current
+    request
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_phase_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def timed(phase_name):
+    """
+    Decorator timing every call of a function as part of a phase
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                add_phase_time(phase_name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class TimedRepository(object):
+    """
+    Wraps a storage repository so every method call is timed as a phase
+    """
+
+    def __init__(self, repository, phase_name):
+        self._repository = repository
+        self._phase = phase_name
+
+    def __getattr__(self, name):
+        attr = getattr(self._repository, name)
+        if callable(attr):
+            attr = timed(self._phase)(attr)
+            # cache the wrapper so later lookups skip __getattr__
+            setattr(self, name, attr)
+        return attr
+
+
+def instrument_storage(store):
+    """
+    Times the repositories of a storage backend: credit_cards and orders
+    count as storage, relationships as the relationship join
+    """
+    store.cards = TimedRepository(store.cards, "storage")
+    store.orders = TimedRepository(store.orders, "storage")
+    store.relationships = TimedRepository(store.relationships, "relationship_join")
+    return store
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_phases = {}
+
+
+def _labels():
+    if request.url_rule is not None:
+        return request.url_rule.rule, request.method
+    return "unmatched", request.method
+
+
+def _observe(route, method, status, elapsed, phases):
+    status = str(status)
+    request_seconds.observe((route, method, status), elapsed)
+    if phases:
+        phase_seconds.observe_many([((route, method, status, name), seconds)
+                                    for name, seconds in phases.items()])
+
+
+def _finish_request(status):
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return
+    route, method = _labels()
+    _observe(route, method, status, time.perf_counter() - start, g.pop("metrics_phases", {}))
+
+
+def _after_request(response):
+    if response.is_streamed:
+        # a streamed body is only produced after this hook, so the request
+        # is timed when the server closes the response. Its phases keep
+        # adding up in g until then
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            route, method = _labels()
+            phases = g.get("metrics_phases")
+            response.call_on_close(lambda: _observe(
+                route, method, response.status_code, time.perf_counter() - start, phases))
+        return response
+    _finish_request(response.status_code)
+    return response
+
+
+def _teardown_request(exc):
+    # only reached with the timer still set if no response was made
+    if exc is not None:
+        _finish_request(500)
+
+
+bp = Blueprint('metrics', __name__)
+
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_get():
+    """
+    An API endpoint for scraping the latency histograms
+    """
+    body = request_seconds.render() + phase_seconds.render()
+    for collector in current_app.extensions.get("metrics_collectors", []):
+        body += collector()
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+def add_collector(app, collector):
+    """
+    Adds a function returning more metrics in the text format to /metrics
+    """
+    app.extensions.setdefault("metrics_collectors", []).append(collector)
+
+
+def init_app(app):
+    """
+    Times every request of the app and registers /metrics
+    """
+    app.before_request(_start_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.register_blueprint(bp)
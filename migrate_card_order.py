@@ -0,0 +1,154 @@
+"""
+Online migration from the legacy card_order entities (one per credit_card
+holding an "orders" array) to one card_order_edge entity per order.
+
+Each batch is converted in its own transaction: the edges are written and
+the legacy entities deleted, or shrunk when they hold more orders than one
+commit can write, together, so the API, which reads both kinds
+while CARD_ORDER_LEGACY_READS is on, sees every relationship exactly once
+at all times. The tool can be stopped and re-run at any point. When it
+reports nothing left to migrate, set CARD_ORDER_LEGACY_READS=0.
+
+    python migrate_card_order.py [--batch-size N] [--dry-run]
+"""
+import argparse
+
+from google.cloud import datastore
+
+import constants
+import relationships
+
+# legacy entities read per page
+MIGRATION_BATCH = 50
+
+# most mutations per commit: the edges written plus the legacy entities
+# deleted or shrunk, below the 500 a commit accepts. This also keeps each
+# lookup under the 1000 keys Datastore allows
+MAX_MUTATIONS_PER_COMMIT = 450
+
+
+def split(legacy, limit=MAX_MUTATIONS_PER_COMMIT):
+    """
+    Splits a page of legacy entities into parts that fit in one commit,
+    as lists of (entity, order ids to convert). An entity holding more
+    orders than one commit can write is spread over several parts
+    """
+    parts = []
+    part, mutations = [], 0
+    for e in legacy:
+        orders = list(e["orders"])
+        while True:
+            # the entity itself is deleted or shrunk, plus one edge per order
+            if part and mutations + 1 + min(len(orders), 1) > limit:
+                parts.append(part)
+                part, mutations = [], 0
+            taken = orders[:limit - mutations - 1]
+            orders = orders[len(taken):]
+            part.append((e, taken))
+            mutations += 1 + len(taken)
+            if not orders:
+                break
+    if part:
+        parts.append(part)
+    return parts
+
+
+def migrate_batch(client, part, dry_run=False):
+    """
+    Converts a part made by split(). Returns (edges written, conflicts)
+    where conflicts lists (order_id, kept card_id, dropped card_id) for
+    orders that were on more than one credit_card
+    """
+    wanted = {}
+    conflicts = []
+    for e, order_ids in part:
+        for order_id in order_ids:
+            if order_id in wanted and wanted[order_id] != e["card_id"]:
+                conflicts.append((order_id, wanted[order_id], e["card_id"]))
+                continue
+            wanted[order_id] = e["card_id"]
+
+    if dry_run:
+        return len(wanted), conflicts
+
+    with client.transaction():
+        # the legacy entities are read again so orders the API took off
+        # them since the page was read are not brought back
+        legacy_keys = []
+        for e, _ in part:
+            if e.key not in legacy_keys:
+                legacy_keys.append(e.key)
+        existing = {}
+        current = {}
+        for e in client.get_multi([relationships.edge_key(client, o) for o in wanted] + legacy_keys):
+            if e.key.kind == constants.card_order_edges:
+                existing[e.key.id] = e["card_id"]
+            else:
+                current[e.key] = e
+
+        held = set()
+        for e in current.values():
+            held.update(e["orders"])
+
+        edges = []
+        for order_id, card_id in wanted.items():
+            if order_id not in held:
+                continue
+            if order_id in existing:
+                if existing[order_id] != card_id:
+                    conflicts.append((order_id, existing[order_id], card_id))
+                continue
+            edges.append(relationships.new_edge(client, card_id, order_id))
+        client.put_multi(edges)
+
+        shrunk = []
+        for e in current.values():
+            e["orders"] = [o for o in e["orders"] if o not in wanted]
+            if e["orders"]:
+                shrunk.append(e)
+        client.put_multi(shrunk)
+        client.delete_multi([key for key in legacy_keys
+                             if key not in current or not current[key]["orders"]])
+    return len(edges), conflicts
+
+
+def migrate(client, batch_size=MIGRATION_BATCH, dry_run=False, log=print):
+    migrated = 0
+    batches = 0
+    cursor = None
+    while True:
+        query = client.query(kind=constants.card_order)
+        # converted entities are deleted, so without --dry-run every page
+        # is simply the first page of what is left
+        iterator = query.fetch(limit=batch_size, start_cursor=cursor if dry_run else None)
+        legacy = list(next(iterator.pages))
+        if not legacy:
+            break
+
+        # nothing is written on a dry run, so the page is checked at once
+        parts = [[(e, e["orders"]) for e in legacy]] if dry_run else split(legacy)
+        for part in parts:
+            written, conflicts = migrate_batch(client, part, dry_run)
+            migrated += written
+            batches += 1
+            for order_id, kept, dropped in conflicts:
+                log("order %s is on credit_cards %s and %s, keeping %s" % (order_id, kept, dropped, kept))
+            log("batch %d: %d legacy entities, %d edges" % (batches, len(part), written))
+
+        cursor = iterator.next_page_token
+        if dry_run and cursor is None:
+            break
+
+    log("done: %d edges in %d batches" % (migrated, batches))
+    if not dry_run:
+        log("nothing left to migrate: set CARD_ORDER_LEGACY_READS=0 on every instance "
+            "of the API so it stops querying the legacy card_order entities")
+    return migrated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    migrate(datastore.Client(), args.batch_size, args.dry_run)
@@ -0,0 +1,75 @@
+"""
+Online migration of the order_total of orders stored as integers to
+doubles, the type every backend now stores (see filtering.py), so that
+order_total filters find them.
+
+Each batch is converted in its own transaction that reads the orders
+again, so concurrent writes are not overwritten. Versions are kept, since
+the outputs do not change. The tool can be stopped and re-run at any
+point.
+
+    python migrate_order_totals.py [--batch-size N] [--dry-run]
+"""
+import argparse
+
+from google.cloud import datastore
+
+import constants
+import filtering
+
+# orders read and converted per transaction, below the 500 mutations a
+# commit accepts
+MIGRATION_BATCH = 250
+
+
+def _integer_totals(orders):
+    return [e for e in orders
+            if isinstance(e.get("order_total"), int) and not isinstance(e["order_total"], bool)]
+
+
+def migrate_batch(client, keys, dry_run=False):
+    """
+    Converts the orders with the given keys. Returns the number converted
+    """
+    if dry_run:
+        return len(_integer_totals(client.get_multi(keys)))
+
+    with client.transaction():
+        orders = _integer_totals(client.get_multi(keys))
+        for e in orders:
+            filtering.store_numbers(constants.orders, e)
+        client.put_multi(orders)
+    return len(orders)
+
+
+def migrate(client, batch_size=MIGRATION_BATCH, dry_run=False, log=print):
+    converted = 0
+    batches = 0
+    cursor = None
+    while True:
+        query = client.query(kind=constants.orders)
+        query.keys_only()
+        iterator = query.fetch(limit=batch_size, start_cursor=cursor)
+        keys = [e.key for e in next(iterator.pages)]
+        if not keys:
+            break
+
+        count = migrate_batch(client, keys, dry_run)
+        converted += count
+        batches += 1
+        log("batch %d: %d orders, %d converted" % (batches, len(keys), count))
+
+        cursor = iterator.next_page_token
+        if cursor is None:
+            break
+
+    log("done: %d orders converted in %d batches" % (converted, batches))
+    return converted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    migrate(datastore.Client(), args.batch_size, args.dry_run)
@@ -1,9 +1,14 @@
 from flask import Blueprint, request, jsonify, make_response, render_template
-from google.cloud import datastore
 import json
+import batch
+import conditional
 import constants
-
-client = datastore.Client()
+import entity_cache
+import export
+import filtering
+import pagination
+import serialization
+import storage
 
 bp = Blueprint('order', __name__, url_prefix='/orders')
 
@@ -18,6 +23,48 @@ def handle_auth_error(ex):
     response.status_code = ex.status_code
     return response
 
+def validate_new_order(content):
+    """
+    Checks the attributes of an order to be created, raising a 400
+    AuthError if one is missing or not recognized
+    """
+    if not isinstance(content, dict):
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. "
+                        "The request object must be a JSON object"}, 400)
+
+    # do not create if an attribute is missing
+    if "date_created" not in content.keys() or "order_total" not in content.keys() \
+        or "status" not in content.keys():
+            raise AuthError({"code": "Bad Request",
+                            "description":
+                            "Missing attribute. "
+                            "The request object is missing at least one of the required attributes"}, 400)
+
+    # do not accept invalid attribute/s
+    for key in content.keys():
+        if key == "date_created" or key == "order_total" or key == "status":
+            continue
+        else:
+            raise AuthError({"code": "Bad Request",
+                            "description":
+                            "Invalid attribute. "
+                            "The request contains an invalid attribute"}, 400)
+
+def requested_fields():
+    """
+    Returns the order attributes named by the fields parameter, or None
+    for all of them
+    """
+    try:
+        return serialization.requested_fields(serialization.ORDER_FIELDS)
+    except ValueError:
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. "
+                        "The fields parameter names an invalid attribute"}, 400)
+
 @bp.route('', methods=['POST','GET','PUT','DELETE'])
 def orders_get_post():
     """
@@ -36,45 +83,21 @@ def orders_get_post():
 
         # get JSON data from the request body
         content = request.get_json()
+        validate_new_order(content)
 
-        # do not create if an attribute is missing
-        if "date_created" not in content.keys() or "order_total" not in content.keys() \
-            or "status" not in content.keys():
-                raise AuthError({"code": "Bad Request",
-                                "description":
-                                "Missing attribute. "
-                                "The request object is missing at least one of the required attributes"}, 400)
-
-        # do not accept invalid attribute/s
-        for key in content.keys():
-            if key == "date_created" or key == "order_total" or key == "status":
-                continue
-            else:
-                raise AuthError({"code": "Bad Request",
-                                "description":
-                                "Invalid attribute. "
-                                "The request contains an invalid attribute"}, 400)
-        
-        # do a query for all the orders in the orders collection
-        orders_query = client.query(kind=constants.orders)
-        results = list(orders_query.fetch())
-        
         # if valid, create a new order with the given attributes
         if request.accept_mimetypes['application/json']:
-            new_order = datastore.entity.Entity(key=client.key(constants.orders))
-            new_order.update({"date_created": content["date_created"], "order_total": content["order_total"],
-            "status": content["status"]})
-            client.put(new_order)
+            new_order = storage.current().orders.create({"date_created": content["date_created"],
+            "order_total": content["order_total"], "status": content["status"]})
+            entity_cache.current().invalidate_orders_list()
 
-            # add id and self attributes
-            new_order["id"] = new_order.key.id
-            new_order["self"] = "https://" + request.host + "/orders/" \
-                + str(new_order.key.id)
-            new_order["credit_card_id"] = None
+            etag = conditional.entity_etag("order", new_order)
 
-            res = make_response(json.dumps(new_order))
+            # add id and self attributes
+            res = make_response(serialization.dumps(serialization.order(new_order, None)))
             res.mimetype = 'application/json'
             res.status_code = 201
+            res.set_etag(etag)
 
             # return newly created order
             return res
@@ -90,51 +113,57 @@ def orders_get_post():
         # do a query for all the orders in the collection
         # also, implement pagination
         if request.accept_mimetypes['application/json']:
-            relationship_query = client.query(kind=constants.card_order)
-            relationship_results = list(relationship_query.fetch())
-
-            query = client.query(kind=constants.orders)
-            query_r = list(query.fetch())
-            count = 0
-
-            # set limit of orders per page to 5
-            q_limit = int(request.args.get('limit', '5'))
-            q_offset = int(request.args.get('offset', '0'))
-            g_iterator = query.fetch(limit= q_limit, offset=q_offset)
-            pages = g_iterator.pages
-            results = list(next(pages))
-            
-            # build next_url
-            if g_iterator.next_page_token:
-                next_offset = q_offset + q_limit
-                next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
-            else:
-                next_url = None
+            orders = storage.current().orders
+            fields = requested_fields()
+            properties = serialization.stored_properties(fields)
+
+            # filters and sort orders run in Datastore, and only if an
+            # index can answer them
+            try:
+                criteria = filtering.parse(request.args, constants.orders, serialization.ORDER_FIELDS)
+            except ValueError as e:
+                raise AuthError({"code": "Bad Request",
+                                "description":
+                                "Bad request. "
+                                "Unsupported filter or sort order: " + str(e)}, 400)
+
+            # set limit of orders per page to 5, walking pages with
+            # signed cursors (or offset for older clients). Sparse,
+            # filtered and sorted pages come from other queries, so their
+            # cursors are scoped apart
+            try:
+                results, next_url = pagination.fetch_page(
+                    lambda limit, **page: orders.page(limit, properties=properties,
+                                                      criteria=criteria, **page),
+                    request, criteria.label(serialization.fields_label(request.path, fields)))
+            except ValueError:
+                raise AuthError({"code": "Bad Request",
+                                "description":
+                                "Bad request. "
+                                "Invalid limit, offset or cursor"}, 400)
+
+            # look up the credit_card of every order on this page at once,
+            # unless it was left out
+            order_cards = {}
+            if fields is None or "credit_card_id" in fields:
+                order_cards = storage.current().relationships.cards_for_orders([e.key.id for e in results])
 
             # add an 'id' and 'self' attribute (not stored in Datastore)
             # to each order
-            for e in results:
-                e["id"] = e.key.id
-                e["self"] = "https://" + request.host + "/orders/" + str(e.key.id)
-                e["credit_card_id"] = None
-
-                for f in relationship_results:
-                    if e["id"] in f["orders"]:
-                        e["credit_card_id"] = f["card_id"]
-
-            for g in query_r:
-                count += 1
-            
-            output = {"orders": results}
+            output = {"orders": serialization.orders(results, order_cards, fields)}
 
 
             # if there are more orders to be viewed, output next_url
             if next_url:
                 output["next"] = next_url
-            output["items_in_collection"] = count
+
+            # count without reading every entity, unless the client does
+            # not need the total
+            if pagination.wants_count(request):
+                output["items_in_collection"] = orders.count(criteria)
 
             # return the list of orders and their attributes
-            res = make_response(json.dumps(output))             
+            res = make_response(serialization.dumps(output))             
             res.mimetype = 'application/json'
             res.status_code = 200
 
@@ -155,50 +184,119 @@ def orders_get_post():
     else:
         return 'Method not recognized'
 
+@bp.route('/batch', methods=['POST'])
+def orders_batch_post():
+    """
+    An API endpoint for adding up to batch.MAX_BATCH_SIZE orders in one
+    request. Each order is validated and reported on its own
+    """
+
+    if request.content_type != 'application/json':
+        raise AuthError({"code": "Unsupported Media Type",
+                        "description":
+                        "Unsupported media type. "
+                        "Please use application/json with your request"}, 415)
+
+    if not request.accept_mimetypes['application/json']:
+        raise AuthError({"code": "Not Acceptable",
+            "description":
+            "Not acceptable. "
+            "Only application/json content type supported"}, 406)
+
+    try:
+        items = batch.read_batch(request.get_json())
+    except ValueError as ex:
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. " + str(ex)}, 400)
+
+    # validate every order with the same rules as a single POST
+    results = [None] * len(items)
+    valid = []
+    for i, content in enumerate(items):
+        try:
+            validate_new_order(content)
+        except AuthError as ex:
+            results[i] = batch.item_error(i, ex.error, ex.status_code)
+            continue
+        valid.append(i)
+
+    # write the valid orders in chunks, letting storage assign the ids
+    new_orders = storage.current().orders.create_many([
+        {"date_created": items[i]["date_created"], "order_total": items[i]["order_total"],
+         "status": items[i]["status"]}
+        for i in valid])
+    if valid:
+        entity_cache.current().invalidate_orders_list()
+
+    for i, new_order in zip(valid, new_orders):
+        # add id and self attributes
+        results[i] = {"index": i, "status": 201, "order": serialization.order(new_order, None)}
+
+    res = make_response(serialization.dumps({"results": results, "created": len(new_orders)}))
+    res.mimetype = 'application/json'
+    res.status_code = 200
+    return res
+
+@bp.route('/export', methods=['GET'])
+def orders_export():
+    """
+    An API endpoint for streaming all the orders in the collection with
+    the ids of their credit_cards, as NDJSON
+    """
+
+    if not request.accept_mimetypes[export.MIMETYPE]:
+        raise AuthError({"code": "Not Acceptable",
+            "description":
+            "Not acceptable. "
+            "Only application/x-ndjson content type supported"}, 406)
+
+    orders = storage.current().orders
+    relationships = storage.current().relationships
+
+    # join the credit_cards of each batch with one lookup, past the
+    # entity cache
+    def build(results):
+        order_cards = relationships.cards_for_orders([e.key.id for e in results], fresh=True)
+        return serialization.orders(results, order_cards)
+
+    try:
+        return export.stream(lambda limit, cursor: orders.page(limit, cursor=cursor),
+                             build, request, request.path)
+    except ValueError:
+        raise AuthError({"code": "Bad Request",
+                        "description":
+                        "Bad request. "
+                        "Invalid cursor"}, 400)
+
 @bp.route('/<order_id>', methods=['DELETE','GET','PATCH','PUT'])
 def orders_put_delete(order_id):
     """
     An API endpoint for deleting an order or for getting a specific order
     """
 
-    order_found = False
-
-    relationship_query = client.query(kind=constants.card_order)
-    relationship_results = list(relationship_query.fetch())
+    # look the order up by its key instead of scanning the collection.
+    # Writes skip the entity cache so they never start from a stale copy
+    order = None
+    if order_id.isdigit():
+        order = storage.current().orders.get(order_id, fresh=request.method != 'GET')
 
-    # do a query for all the orders in the orders collection
-    orders_query = client.query(kind=constants.orders)
-    results = list(orders_query.fetch())
-
-    # add an 'id' attribute to each order
-    # check if the order exists in the collection
-    for e in results:
-        e["id"] = e.key.id
-        if order_id == json.dumps(e["id"]):
-            order_found = True
-    
     # if order not found, return 404 error
-    if order_found == False:
+    if order is None:
         raise AuthError({"code": "Not Found",
                         "description":
                         "Order not found. "
                         "No order with this order_id exists"}, 404)
 
-    order_key = client.key(constants.orders, int(order_id))
-    order = client.get(key=order_key)
-    
     # deletes an existing order
     if request.method == 'DELETE':
-        r_id = None
-        order["id"] = order.key.id
-
-        # delete order from orders collection
-        for e in relationship_results:
-            if order["id"] in e["orders"]:
-                r_id = e.key.id
-                relationship_key = client.key(constants.card_order, int(r_id))
-                client.delete(relationship_key)
-        client.delete(order_key)
+        # delete order from orders collection and take it off its credit
+        # card in the same transaction
+        card_id = storage.current().orders.delete(order)
+        entity_cache.current().invalidate_order(order.key.id)
+        entity_cache.current().invalidate_orders_list()
+        if card_id is not None:
+            entity_cache.current().invalidate_card(card_id)
         return ('',204)
 
     
@@ -241,21 +339,18 @@ def orders_put_delete(order_id):
             if "status" in content.keys():
                 order.update({"status": content["status"]})
 
-            client.put(order)
+            storage.current().orders.save(order)
+            entity_cache.current().invalidate_order(order.key.id)
+            entity_cache.current().invalidate_orders_list()
 
-            # add 'id' and 'self' attributes to the order
-            order["id"] = order.key.id
-            order["self"] = "https://" + request.host + "/orders/" \
-                + str(order.key.id)
-            order["credit_card_id"] = None
+            etag = conditional.entity_etag("order", order)
 
-            for e in relationship_results:
-                if order["id"] in e["orders"]:
-                    order["credit_card_id"] = e["card_id"]
-
-            res = make_response(json.dumps(order))
+            # add 'id' and 'self' attributes to the order
+            credit_card_id = storage.current().relationships.card_for_order(order.key.id)
+            res = make_response(serialization.dumps(serialization.order(order, credit_card_id)))
             res.mimetype = 'application/json'
             res.status_code = 200
+            res.set_etag(etag)
 
             # return modified order
             return res
@@ -299,21 +394,18 @@ def orders_put_delete(order_id):
         if request.accept_mimetypes['application/json']:
             order.update({"date_created": content["date_created"], "order_total": content["order_total"],
             "status": content["status"]})
-            client.put(order)
-
-            # add 'id' and 'self' attributes to the order
-            order["id"] = order.key.id
-            order["self"] = "https://" + request.host + "/orders/" \
-                + str(order.key.id)
-            order["credit_card_id"] = None
+            storage.current().orders.save(order)
+            entity_cache.current().invalidate_order(order.key.id)
+            entity_cache.current().invalidate_orders_list()
 
-            for e in relationship_results:
-                if order["id"] in e["orders"]:
-                    order["credit_card_id"] = e["card_id"]
+            etag = conditional.entity_etag("order", order)
 
-            res = make_response(json.dumps(order))
+            # add 'id' and 'self' attributes to the order
+            credit_card_id = storage.current().relationships.card_for_order(order.key.id)
+            res = make_response(serialization.dumps(serialization.order(order, credit_card_id)))
             res.mimetype = 'application/json'
             res.status_code = 200
+            res.set_etag(etag)
 
             # return modified order
             return res
@@ -327,20 +419,23 @@ def orders_put_delete(order_id):
     # gets a specific order with the given id, either as JSON or HTML
     elif request.method == 'GET':
         if request.accept_mimetypes['application/json']:
-            base_url = '/orders/' + order_id
-
-            # add 'id' and 'self' attributes to the order
-            order["id"] = order.key.id
-            order["self"] = "https://" + request.host + base_url
-            order["credit_card_id"] = None
+            fields = requested_fields()
 
-            for e in relationship_results:
-                if order["id"] in e["orders"]:
-                    order["credit_card_id"] = e["card_id"]
+            # the version of the order changes with its credit card, so a
+            # client with the current version needs no relationship lookup
+            etag = conditional.entity_etag(serialization.fields_label("order", fields), order)
+            res = conditional.not_modified(etag)
+            if res is not None:
+                return res
 
-            res = make_response(json.dumps(order))             
+            # add 'id' and 'self' attributes to the order
+            credit_card_id = None
+            if fields is None or "credit_card_id" in fields:
+                credit_card_id = storage.current().relationships.card_for_order(order.key.id)
+            res = make_response(serialization.dumps(serialization.order(order, credit_card_id, fields)))
             res.mimetype = 'application/json'
             res.status_code = 200
+            res.set_etag(etag)
 
             # return order and its attributes as JSON
             return res
@@ -0,0 +1,132 @@
+import base64
+import hashlib
+import hmac
+
+from six.moves.urllib.parse import urlencode
+
+# signs the cursors handed out in next links so clients cannot forge them.
+# Set by init_app from the CURSOR_SIGNING_KEY setting
+CURSOR_SIGNING_KEY = None
+
+# number of entities per page when the client does not pass a limit
+DEFAULT_LIMIT = 5
+
+# most entities per page; larger limits are lowered to it
+MAX_LIMIT = 100
+
+
+def init_app(app):
+    """
+    Signs the cursors of the app with its CURSOR_SIGNING_KEY setting.
+    Raises RuntimeError if it is not set, since cursors signed with a
+    known key could be forged
+    """
+    global CURSOR_SIGNING_KEY
+    key = app.config.get("CURSOR_SIGNING_KEY")
+    if not key:
+        raise RuntimeError("CURSOR_SIGNING_KEY must be set to sign pagination cursors")
+    CURSOR_SIGNING_KEY = key.encode('utf-8')
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(value):
+    value = value.encode('ascii')
+    return base64.urlsafe_b64decode(value + b'=' * (-len(value) % 4))
+
+
+def _signature(token, scope):
+    digest = hmac.new(CURSOR_SIGNING_KEY, scope.encode('utf-8') + b'\0' + token,
+                      hashlib.sha256).digest()
+    return _b64encode(digest[:16])
+
+
+def encode_cursor(token, scope):
+    """
+    Wraps a storage page token in an opaque, signed cursor. The scope
+    (the path and the owner of the collection) is part of the signature so
+    a cursor only works for the listing that produced it
+    """
+    if isinstance(token, str):
+        token = token.encode('ascii')
+    return _b64encode(token) + '.' + _signature(token, scope)
+
+
+def decode_cursor(cursor, scope):
+    """
+    Returns the storage page token inside a signed cursor. Raises
+    ValueError if the cursor was tampered with or belongs to another scope
+    """
+    try:
+        payload, signature = cursor.split('.')
+        token = _b64decode(payload)
+    except (ValueError, UnicodeError, TypeError):
+        raise ValueError('malformed cursor')
+    if not hmac.compare_digest(signature, _signature(token, scope)):
+        raise ValueError('invalid cursor signature')
+    return token
+
+
+def page_url(request, **params):
+    """
+    Returns the current URL with some query parameters replaced. Parameters
+    set to None are dropped
+    """
+    args = request.args.to_dict()
+    for name, value in params.items():
+        if value is None:
+            args.pop(name, None)
+        else:
+            args[name] = str(value)
+    return request.base_url + '?' + urlencode(args)
+
+
+def fetch_page(fetch, request, scope):
+    """
+    Fetches one page for a list endpoint and returns the entities with the
+    URL of the next page, or None on the last page. fetch is a storage
+    page function called as fetch(limit, offset=..., cursor=...) that
+    returns the entities and the next page token.
+
+    Pages are walked with signed cursors so page N costs the same as page
+    1. Passing offset keeps the old limit/offset behaviour for existing
+    clients. Limits above MAX_LIMIT are lowered to it. Raises ValueError
+    for a bad limit, offset or cursor
+    """
+    q_limit = int(request.args.get('limit', str(DEFAULT_LIMIT)))
+    if q_limit < 1:
+        raise ValueError('limit must be positive')
+    # so one request can not read a whole collection
+    q_limit = min(q_limit, MAX_LIMIT)
+
+    # legacy mode: Datastore still reads and skips every offset row
+    if 'offset' in request.args:
+        q_offset = int(request.args['offset'])
+        if q_offset < 0:
+            raise ValueError('offset must not be negative')
+        results, next_token = fetch(q_limit, offset=q_offset)
+        next_url = None
+        if next_token:
+            next_url = page_url(request, limit=q_limit, offset=q_offset + q_limit)
+        return results, next_url
+
+    start_cursor = None
+    if request.args.get('cursor'):
+        start_cursor = decode_cursor(request.args['cursor'], scope)
+
+    results, next_token = fetch(q_limit, cursor=start_cursor)
+    next_url = None
+    if next_token:
+        next_url = page_url(request, limit=q_limit,
+                            cursor=encode_cursor(next_token, scope))
+    return results, next_url
+
+
+def wants_count(request):
+    """
+    Returns False if the client opted out of items_in_collection with
+    count=false
+    """
+    return request.args.get('count', 'true').lower() != 'false'
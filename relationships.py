@@ -0,0 +1,311 @@
+from google.cloud import datastore
+
+from os import environ as env
+
+import conditional
+import constants
+
+# while the legacy card_order entities (one per card with an "orders"
+# array) are being migrated, reads fall back to them and writes clean
+# them up. On by default so an unmigrated Datastore loses nothing, but
+# every relationship read and write pays for the extra queries, so set
+# CARD_ORDER_LEGACY_READS=0 once migrate_card_order.py reports nothing
+# left to migrate. The Datastore backend logs a warning while it is on.
+LEGACY_READS = env.get("CARD_ORDER_LEGACY_READS", "1") == "1"
+
+# Datastore accepts at most 30 values in an IN filter
+IN_FILTER_LIMIT = 30
+
+
+def edge_key(client, order_id):
+    """
+    Returns the key of the relationship entity for an order. An order can
+    only be on one credit_card, so the order id is the key
+    """
+    return client.key(constants.card_order_edges, int(order_id))
+
+
+def new_edge(client, card_id, order_id):
+    edge = datastore.Entity(key=edge_key(client, order_id))
+    edge.update({"card_id": int(card_id)})
+    return edge
+
+
+def touch(client, keys):
+    """
+    Gives new versions to the credit_cards and orders with the given keys,
+    so their ETags change along with their relationships
+    """
+    if not keys:
+        return
+    entities = client.get_multi(keys)
+    for e in entities:
+        conditional.bump_version(e)
+    client.put_multi(entities)
+
+
+def card_for_order(client, order_id):
+    """
+    Returns the id of the credit_card holding an order, or None
+    """
+    edge = client.get(edge_key(client, order_id))
+    if edge is not None:
+        return edge["card_id"]
+    if LEGACY_READS:
+        return _legacy_card_for_order(client, int(order_id))
+    return None
+
+
+def cards_for_orders(client, order_ids):
+    """
+    Returns a dict mapping each of the given order ids to the id of the
+    credit_card holding it. Orders that are not on a card are left out
+    """
+    if not order_ids:
+        return {}
+    cards = {}
+    for edge in client.get_multi([edge_key(client, order_id) for order_id in order_ids]):
+        cards[edge.key.id] = edge["card_id"]
+    if LEGACY_READS:
+        missing = [order_id for order_id in order_ids if order_id not in cards]
+        cards.update(_legacy_cards_for_orders(client, missing))
+    return cards
+
+
+def orders_for_card(client, card_id):
+    """
+    Returns the ids of the orders on a credit_card
+    """
+    query = client.query(kind=constants.card_order_edges)
+    query.add_filter('card_id', '=', int(card_id))
+    query.keys_only()
+    orders = [e.key.id for e in query.fetch()]
+    if LEGACY_READS:
+        orders = _merge(orders, _legacy_orders_for_card(client, int(card_id)))
+    return orders
+
+
+def orders_for_cards(client, card_ids):
+    """
+    Returns a dict mapping each of the given credit_card ids to the ids of
+    its orders, using one IN query per IN_FILTER_LIMIT cards
+    """
+    orders = {}
+    for card_id in card_ids:
+        orders[card_id] = []
+    card_ids = list(orders)
+    for i in range(0, len(card_ids), IN_FILTER_LIMIT):
+        query = client.query(kind=constants.card_order_edges)
+        query.add_filter('card_id', 'IN', card_ids[i:i + IN_FILTER_LIMIT])
+        for edge in query.fetch():
+            orders[edge["card_id"]].append(edge.key.id)
+    if LEGACY_READS:
+        for e in _legacy_for_cards(client, card_ids):
+            orders[e["card_id"]] = _merge(orders[e["card_id"]], e["orders"])
+    return orders
+
+
+def attach(client, card_id, order_id):
+    """
+    Puts an order on a credit_card and bumps both their versions. Returns
+    False without changing anything if the order is already on a card,
+    which is checked in the same transaction. Run it in a transaction
+    """
+    # the relationship is read with the entities getting new versions
+    keys = [edge_key(client, order_id), client.key(constants.credit_cards, int(card_id)),
+            client.key(constants.orders, int(order_id))]
+    entities = client.get_multi(keys)
+    if any(e.key.kind == constants.card_order_edges for e in entities):
+        return False
+    if LEGACY_READS and _legacy_card_for_order(client, int(order_id)) is not None:
+        return False
+    for e in entities:
+        conditional.bump_version(e)
+    client.put_multi(entities + [new_edge(client, card_id, order_id)])
+    return True
+
+
+def detach(client, order_id, touch_order=True):
+    """
+    Takes an order off whatever credit_card holds it and bumps the
+    versions of both, or only of the card when the order is being deleted
+    in the same transaction. Returns the id of the card, or None. Run it
+    in a transaction
+    """
+    card_id = card_for_order(client, order_id)
+    client.delete(edge_key(client, order_id))
+    if LEGACY_READS:
+        _legacy_remove_order(client, int(order_id))
+
+    keys = []
+    if card_id is not None:
+        keys.append(client.key(constants.credit_cards, card_id))
+    if touch_order:
+        keys.append(client.key(constants.orders, int(order_id)))
+    if keys:
+        touch(client, keys)
+    return card_id
+
+
+def keys_for_card(client, card_id):
+    """
+    Returns the keys of every relationship entity of a credit_card, found
+    through the card_id index so they can be deleted with the card, and
+    the ids of the orders they hold
+    """
+    query = client.query(kind=constants.card_order_edges)
+    query.add_filter('card_id', '=', int(card_id))
+    query.keys_only()
+    keys = [e.key for e in query.fetch()]
+    # relationship entities are keyed by order id
+    order_ids = [k.id for k in keys]
+    if LEGACY_READS:
+        for e in _legacy_for_card(client, int(card_id)):
+            keys.append(e.key)
+            order_ids = _merge(order_ids, e["orders"])
+    return keys, order_ids
+
+
+def change_card_orders(client, card_id, attach_ids, detach_ids):
+    """
+    Attaches and detaches several orders of a credit_card in a single
+    transaction. The card, the orders and their relationships are read
+    with one get_multi. Nothing is changed unless every order can be
+    moved; in that case a dict listing the problems is returned:
+    "card_missing", "missing" (orders that do not exist), "taken" (orders
+    on another card) and "not_on_card" (orders to detach that are not on
+    this card). Returns None on success. The card and every moved order
+    get new versions
+    """
+    card_id = int(card_id)
+    order_ids = list(attach_ids) + list(detach_ids)
+    card_key = client.key(constants.credit_cards, card_id)
+    order_keys = [client.key(constants.orders, order_id) for order_id in order_ids]
+    edge_keys = [edge_key(client, order_id) for order_id in order_ids]
+
+    with client.transaction():
+        card = None
+        orders_found = {}
+        cards = {}
+        for e in client.get_multi([card_key] + order_keys + edge_keys):
+            if e.key.kind == constants.credit_cards:
+                card = e
+            elif e.key.kind == constants.orders:
+                orders_found[e.key.id] = e
+            else:
+                cards[e.key.id] = e["card_id"]
+
+        legacy = []
+        if LEGACY_READS:
+            # one batched query finds the legacy entities of every order,
+            # for the ownership checks and for the clean-up below
+            legacy = _legacy_for_orders(client, order_ids)
+            for order_id, legacy_card in _legacy_cards(legacy, order_ids).items():
+                cards.setdefault(order_id, legacy_card)
+
+        problems = {
+            "card_missing": card is None,
+            "missing": [o for o in order_ids if o not in orders_found],
+            "taken": [o for o in attach_ids if cards.get(o, card_id) != card_id],
+            "not_on_card": [o for o in detach_ids if cards.get(o) != card_id],
+        }
+        if any(problems.values()):
+            return problems
+
+        # the card and every moved order get new versions
+        attached = [o for o in attach_ids if o not in cards]
+        touched = [card] + [orders_found[o] for o in attached + list(detach_ids)]
+        for e in touched:
+            conditional.bump_version(e)
+        client.put_multi(touched + [new_edge(client, card_id, o) for o in attached])
+        client.delete_multi([edge_key(client, o) for o in detach_ids])
+        _legacy_remove_orders(client, legacy, detach_ids)
+    return None
+
+
+def _merge(orders, more):
+    for order_id in more:
+        if order_id not in orders:
+            orders.append(order_id)
+    return orders
+
+
+def _legacy_for_card(client, card_id):
+    query = client.query(kind=constants.card_order)
+    query.add_filter('card_id', '=', card_id)
+    return list(query.fetch())
+
+
+def _legacy_for_order(client, order_id):
+    query = client.query(kind=constants.card_order)
+    query.add_filter('orders', '=', order_id)
+    return list(query.fetch())
+
+
+def _legacy_card_for_order(client, order_id):
+    for e in _legacy_for_order(client, order_id):
+        return e["card_id"]
+    return None
+
+
+def _legacy_orders_for_card(client, card_id):
+    orders = []
+    for e in _legacy_for_card(client, card_id):
+        orders = _merge(orders, e["orders"])
+    return orders
+
+
+def _legacy_in(client, name, values):
+    """
+    Returns the legacy entities with any of the values in a property, using
+    one IN query per IN_FILTER_LIMIT values. An entity matching several
+    values is returned once
+    """
+    values = list(values)
+    found = {}
+    for i in range(0, len(values), IN_FILTER_LIMIT):
+        query = client.query(kind=constants.card_order)
+        query.add_filter(name, 'IN', values[i:i + IN_FILTER_LIMIT])
+        for e in query.fetch():
+            found.setdefault(e.key, e)
+    return list(found.values())
+
+
+def _legacy_for_cards(client, card_ids):
+    return _legacy_in(client, 'card_id', card_ids)
+
+
+def _legacy_for_orders(client, order_ids):
+    return _legacy_in(client, 'orders', order_ids)
+
+
+def _legacy_cards(entities, order_ids):
+    wanted = set(order_ids)
+    cards = {}
+    for e in entities:
+        for order_id in e["orders"]:
+            if order_id in wanted:
+                cards.setdefault(order_id, e["card_id"])
+    return cards
+
+
+def _legacy_cards_for_orders(client, order_ids):
+    if not order_ids:
+        return {}
+    return _legacy_cards(_legacy_for_orders(client, order_ids), order_ids)
+
+
+def _legacy_remove_order(client, order_id):
+    _legacy_remove_orders(client, _legacy_for_order(client, order_id), [order_id])
+
+
+def _legacy_remove_orders(client, entities, order_ids):
+    removed = set(order_ids)
+    for e in entities:
+        if not removed & set(e["orders"]):
+            continue
+        e["orders"] = [o for o in e["orders"] if o not in removed]
+        if e["orders"]:
+            client.put(e)
+        else:
+            client.delete(e.key)
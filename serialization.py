@@ -0,0 +1,193 @@
+"""
+Turns credit_cards, orders and card_order relationships into the JSON
+documents the API returns.
+
+The output functions build new dicts and never change the entities they
+are given, which may be shared with the entity cache, and leave out the
+version (see conditional.py). self URLs start with a prefix built once
+per request. Outputs can be limited to the attributes a client names in
+the fields parameter. Documents are encoded by orjson when it is installed and by
+the json module otherwise; the JSON_BACKEND environment variable or
+use_backend() picks one explicitly. Encoding is timed as the
+serialization phase of the request.
+"""
+import json
+
+from os import environ as env
+
+from flask import g, request
+
+import conditional
+import metrics
+
+
+def _json_dumps(data):
+    return json.dumps(data)
+
+
+# encoders by name, each returning str or bytes
+BACKENDS = {"json": _json_dumps}
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    BACKENDS["orjson"] = orjson.dumps
+
+JSON_BACKEND = env.get("JSON_BACKEND") or ("orjson" if "orjson" in BACKENDS else "json")
+
+_encode = BACKENDS[JSON_BACKEND]
+
+
+def use_backend(name):
+    """
+    Switches every response to the encoder registered under name
+    """
+    global _encode
+    _encode = BACKENDS[name]
+
+
+@metrics.timed("serialization")
+def dumps(data):
+    """
+    Encodes a response document with the current backend
+    """
+    return _encode(data)
+
+
+@metrics.timed("serialization")
+def dumps_lines(outputs):
+    """
+    Encodes outputs as newline-delimited JSON, one line each
+    """
+    lines = [_encode(output) for output in outputs]
+    if lines and isinstance(lines[0], bytes):
+        return b"\n".join(lines) + b"\n"
+    return "\n".join(lines) + "\n"
+
+
+def url_prefix():
+    """
+    Returns the scheme and host that self URLs of the current request
+    start with
+    """
+    prefix = g.get("url_prefix")
+    if prefix is None:
+        prefix = g.url_prefix = "https://" + request.host
+    return prefix
+
+
+# the attributes of each output, stored properties first
+CREDIT_CARD_FIELDS = ("card_number", "type", "expiration", "cvv_code", "owner",
+                      "id", "self", "orders")
+ORDER_FIELDS = ("date_created", "order_total", "status", "id", "self", "credit_card_id")
+
+# attributes that are not stored properties of the entity
+COMPUTED_FIELDS = ("id", "self", "orders", "credit_card_id")
+
+
+def requested_fields(allowed):
+    """
+    Returns the attributes named by the fields parameter of the current
+    request in the order of allowed, or None to output all of them.
+    Raises ValueError for attributes that are not in allowed
+    """
+    value = request.args.get("fields")
+    if value is None:
+        return None
+    names = set(name.strip() for name in value.split(","))
+    names.discard("")
+    if not names or not names <= set(allowed):
+        raise ValueError("unknown fields")
+    return tuple(name for name in allowed if name in names)
+
+
+def stored_properties(fields):
+    """
+    Returns the stored properties that outputs with these fields are built
+    from, or None if they need whole entities
+    """
+    if fields is None:
+        return None
+    return tuple(name for name in fields if name not in COMPUTED_FIELDS)
+
+
+def fields_label(name, fields):
+    """
+    Tags an ETag resource or a cursor scope with the selected fields, so
+    sparse representations are told apart from full ones
+    """
+    if fields is None:
+        return name
+    return name + ":" + ",".join(fields)
+
+
+def _outputs(entities, collection, name, values, default=None, fields=None):
+    # key.id is a property that walks the key path, so read it only once
+    prefix = url_prefix() + "/" + collection + "/"
+    if fields is None:
+        properties = None
+        with_id = with_self = with_related = True
+    else:
+        properties = stored_properties(fields)
+        with_id, with_self, with_related = "id" in fields, "self" in fields, name in fields
+    outputs = []
+    for entity in entities:
+        entity_id = entity.key.id
+        if properties is None:
+            output = dict(entity)
+            output.pop(conditional.VERSION, None)
+        else:
+            output = {p: entity[p] for p in properties if p in entity}
+        if with_id:
+            output["id"] = entity_id
+        if with_self:
+            output["self"] = prefix + str(entity_id)
+        if with_related:
+            output[name] = values.get(entity_id, default)
+        outputs.append(output)
+    return outputs
+
+
+def credit_cards(entities, orders_by_card, fields=None):
+    """
+    Returns the outputs of credit_cards, each holding the orders listed
+    for it in orders_by_card, either their ids or their outputs. fields
+    limits them to some attributes
+    """
+    return _outputs(entities, "credit_cards", "orders", orders_by_card, [], fields)
+
+
+def credit_card(entity, orders, fields=None):
+    return credit_cards([entity], {entity.key.id: orders}, fields)[0]
+
+
+def orders(entities, cards_by_order, fields=None):
+    """
+    Returns the outputs of orders, each naming the credit_card it is on
+    in cards_by_order, or none. fields limits them to some attributes
+    """
+    outputs = _outputs(entities, "orders", "credit_card_id", cards_by_order, None, fields)
+    # totals are stored as doubles (see filtering.py); whole ones are
+    # written as integers, as clients send them
+    for output in outputs:
+        total = output.get("order_total")
+        if isinstance(total, float) and total.is_integer():
+            output["order_total"] = int(total)
+    return outputs
+
+
+def order(entity, credit_card_id, fields=None):
+    return orders([entity], {entity.key.id: credit_card_id}, fields)[0]
+
+
+def relationship(card_id, orders, order_id=None):
+    """
+    Returns the output of the orders on a credit_card, pointing at one
+    relationship of it if order_id is given
+    """
+    path = "/credit_cards/" + str(card_id) + "/orders"
+    if order_id is not None:
+        path += "/" + str(order_id)
+    return {"card_id": int(card_id), "orders": orders, "self": url_prefix() + path}
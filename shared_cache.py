@@ -0,0 +1,340 @@
+"""
+Optional cache tier shared by every instance of the app, consulted by the
+per-process entity cache (entity_cache.py) before going to storage.
+
+Values are stored as JSON in a Redis-compatible server with a TTL of
+SHARED_CACHE_TTL seconds. Every cache key has a generation counter next
+to it. A write increments the counters of what it changed, and values
+stored under an older generation are ignored, so once a write has
+returned no instance reads what it replaced from this tier, even if a
+slow reader stores an old copy afterwards.
+
+The write also publishes the changed keys on INVALIDATION_CHANNEL, and
+every instance drops them from its own cache when the message arrives,
+usually within milliseconds. An instance that loses its subscription
+clears its cache when it reconnects; in every case ENTITY_CACHE_TTL
+bounds how long it can serve a stale copy.
+
+SHARED_CACHE_URL picks the server: a redis:// URL (needs the redis
+package), "local" or "local://<name>" for an in-process stand-in shared
+by the apps of one process, or nothing to run without this tier.
+"""
+import base64
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+
+import entity_cache
+
+logger = logging.getLogger("shared_cache")
+
+SHARED_CACHE_TTL = 300
+
+INVALIDATION_CHANNEL = "entity_cache_invalidations"
+
+# seconds to wait before subscribing again after losing the connection
+RECONNECT_DELAY = 1
+
+_local_servers = {}
+_local_servers_lock = threading.Lock()
+
+
+def create_client(url):
+    """
+    Returns a client for the server at the given SHARED_CACHE_URL
+    """
+    if url == "local" or url.startswith("local://"):
+        name = url[len("local://"):] or "default"
+        with _local_servers_lock:
+            if name not in _local_servers:
+                _local_servers[name] = LocalRedis()
+            return _local_servers[name]
+    import redis
+    return redis.Redis.from_url(url)
+
+
+class LocalRedis(object):
+    """
+    An in-process stand-in for the few Redis commands the shared tier
+    uses, for tests, benchmarks and local development
+    """
+
+    def __init__(self):
+        self._items = {}
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= now:
+            del self._items[key]
+            return None
+        return value
+
+    def mget(self, keys):
+        now = time.time()
+        with self._lock:
+            return [self._get(key, now) for key in keys]
+
+    def set(self, key, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        with self._lock:
+            self._items[key] = (value, time.time() + ex if ex else None)
+        return True
+
+    def incr(self, key):
+        now = time.time()
+        with self._lock:
+            value = int(self._get(key, now) or 0) + 1
+            expires_at = self._items[key][1] if key in self._items else None
+            self._items[key] = (str(value).encode("ascii"), expires_at)
+        return value
+
+    def expire(self, key, seconds):
+        now = time.time()
+        with self._lock:
+            value = self._get(key, now)
+            if value is None:
+                return False
+            self._items[key] = (value, now + seconds)
+        return True
+
+    def publish(self, channel, message):
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for messages in subscribers:
+            messages.put({"type": "message", "channel": channel, "data": message})
+        return len(subscribers)
+
+    def pipeline(self):
+        return LocalPipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return LocalPubSub(self)
+
+
+class LocalPipeline(object):
+
+    def __init__(self, server):
+        self._server = server
+        self._commands = []
+
+    def __getattr__(self, name):
+        def queue_command(*args, **kwargs):
+            self._commands.append((getattr(self._server, name), args, kwargs))
+            return self
+        return queue_command
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        return [f(*args, **kwargs) for f, args, kwargs in commands]
+
+
+class LocalPubSub(object):
+
+    def __init__(self, server):
+        self._server = server
+        self._messages = queue.Queue()
+
+    def subscribe(self, *channels):
+        with self._server._lock:
+            for channel in channels:
+                self._server._subscribers.setdefault(channel, []).append(self._messages)
+
+    def listen(self):
+        while True:
+            yield self._messages.get()
+
+
+def _shared_key(kind, key):
+    return "entity_cache:%s:%s" % (kind, json.dumps(key))
+
+
+def _generation_key(kind, key):
+    return "entity_cache_gen:%s:%s" % (kind, json.dumps(key))
+
+
+class SharedCache(object):
+    """
+    Reads and writes one app's cache entries in the shared server. Every
+    error talking to the server is logged and treated as a miss, so the
+    app keeps working from storage when the server is down
+    """
+
+    def __init__(self, client, make_entity, ttl=SHARED_CACHE_TTL):
+        self.client = client
+        self.make_entity = make_entity
+        self.ttl = ttl
+        self.instance_id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self.stats = {}
+        self.errors = 0
+
+    def _count(self, kind, hits, misses):
+        with self._lock:
+            stats = self.stats.setdefault(kind, {"hits": 0, "misses": 0})
+            stats["hits"] += hits
+            stats["misses"] += misses
+
+    def _error(self, action):
+        with self._lock:
+            self.errors += 1
+        logger.warning("shared cache %s failed", action, exc_info=True)
+
+    def encode(self, value):
+        """
+        Turns a cached value into JSON data, keeping entities, tuples and
+        page tokens apart from plain lists and strings
+        """
+        if isinstance(value, tuple):
+            return {"tuple": [self.encode(v) for v in value]}
+        if isinstance(value, list):
+            return [self.encode(v) for v in value]
+        if isinstance(value, bytes):
+            return {"bytes": base64.b64encode(value).decode("ascii")}
+        if hasattr(value, "key"):
+            return {"entity": [value.key.kind, value.key.id, dict(value)]}
+        return value
+
+    def decode(self, data):
+        if isinstance(data, list):
+            return [self.decode(v) for v in data]
+        if isinstance(data, dict):
+            if "tuple" in data:
+                return tuple(self.decode(v) for v in data["tuple"])
+            if "bytes" in data:
+                return base64.b64decode(data["bytes"])
+            kind, entity_id, properties = data["entity"]
+            return self.make_entity(kind, entity_id, properties)
+        return data
+
+    def _read(self, kind, keys):
+        """
+        Returns the current value of every key, or entity_cache.MISSING,
+        and the generation every key is at
+        """
+        names = [_shared_key(kind, key) for key in keys]
+        names += [_generation_key(kind, key) for key in keys]
+        try:
+            stored = self.client.mget(names)
+        except Exception:
+            self._error("read")
+            return [entity_cache.MISSING] * len(keys), None
+
+        values = []
+        generations = [int(g or 0) for g in stored[len(keys):]]
+        for data, generation in zip(stored[:len(keys)], generations):
+            value = entity_cache.MISSING
+            if data is not None:
+                data = json.loads(data)
+                if data["g"] == generation:
+                    value = self.decode(data["v"])
+            values.append(value)
+        return values, generations
+
+    def _write(self, kind, items):
+        pipeline = self.client.pipeline()
+        for key, value, generation in items:
+            pipeline.set(_shared_key(kind, key),
+                         json.dumps({"g": generation, "v": self.encode(value)}), ex=self.ttl)
+        try:
+            pipeline.execute()
+        except Exception:
+            self._error("write")
+
+    def lookup(self, kind, key, load, negative=False):
+        """
+        Returns the shared value of a key, or loads and shares it. None is
+        only shared if negative is set
+        """
+        (value,), generations = self._read(kind, [key])
+        if value is not entity_cache.MISSING:
+            self._count(kind, 1, 0)
+            return value
+        self._count(kind, 0, 1)
+        value = load()
+        if generations is not None and (value is not None or negative):
+            self._write(kind, [(key, value, generations[0])])
+        return value
+
+    def lookup_many(self, kind, keys, load_many, negative=False):
+        """
+        Like EntityCache.lookup_many, with one read for all the keys and
+        one write for the ones that had to be loaded
+        """
+        values, generations = self._read(kind, keys)
+        found = {}
+        missing = []
+        for key, value in zip(keys, values):
+            if value is entity_cache.MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        self._count(kind, len(found), len(missing))
+        if missing:
+            loaded = load_many(missing)
+            if generations is not None:
+                generation_of = dict(zip(keys, generations))
+                self._write(kind, [(key, loaded.get(key), generation_of[key]) for key in missing
+                                   if loaded.get(key) is not None or negative])
+            found.update(loaded)
+        return found
+
+    def invalidate(self, kind, keys):
+        """
+        Moves the keys to a new generation and tells the other instances
+        to drop them
+        """
+        pipeline = self.client.pipeline()
+        for key in keys:
+            # generations outlive every value stored under them
+            pipeline.incr(_generation_key(kind, key))
+            pipeline.expire(_generation_key(kind, key), 2 * self.ttl)
+        message = json.dumps({"origin": self.instance_id, "kind": kind, "keys": keys})
+        try:
+            pipeline.execute()
+            self.client.publish(INVALIDATION_CHANNEL, message)
+        except Exception:
+            self._error("invalidation")
+
+    def _receive(self, cache, data):
+        message = json.loads(data)
+        if message["origin"] == self.instance_id:
+            return
+        keys = [tuple(key) if isinstance(key, list) else key for key in message["keys"]]
+        cache.drop(message["kind"], keys)
+
+    def _listen(self, cache):
+        subscribed_before = False
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                if subscribed_before:
+                    # invalidations published while disconnected are lost
+                    cache.clear()
+                subscribed_before = True
+                for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._receive(cache, message["data"])
+            except Exception:
+                self._error("subscription")
+                time.sleep(RECONNECT_DELAY)
+
+    def start_listener(self, cache):
+        """
+        Drops the keys invalidated by other instances from cache, in a
+        background thread
+        """
+        thread = threading.Thread(target=self._listen, args=(cache,), name="shared-cache-listener")
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,406 @@
+"""
+Storage backends for credit cards, orders and their relationships.
+
+The blueprints never talk to Datastore directly; they get the backend of
+the current app with current() and use its three repositories:
+
+    storage.cards          credit_cards, including card number uniqueness
+    storage.orders         orders
+    storage.relationships  which orders are on which credit card
+
+Entities are returned as dict-like objects with a key.id and a version
+that every write bumps (see conditional.py), and every list method
+returns (entities, next_page_token) where the token is opaque and None on
+the last page. List methods take the properties the caller needs, and
+may then return partial entities without a version, and the filters and
+sort orders of the request (see filtering.py). create_app() picks the backend with the
+STORAGE_BACKEND setting: "datastore" (the default) or "memory".
+"""
+import logging
+
+from flask import current_app
+
+import batch
+import card_number_index
+import conditional
+import constants
+import datastore_usage
+import filtering
+import relationships
+
+logger = logging.getLogger("storage")
+
+# Datastore returns at most 1000 entities per lookup
+GET_MULTI_LIMIT = 1000
+
+# properties that list queries can project onto, by kind. index.yaml has a
+# composite index for each, after the equality filters of the query
+PROJECTIONS = {
+    constants.credit_cards: ("card_number", "type"),
+    constants.orders: ("order_total", "status"),
+}
+
+
+def current():
+    """
+    Returns the storage backend of the app handling the current request
+    """
+    return current_app.extensions["storage"]
+
+
+def create_storage(backend):
+    """
+    Creates the storage backend registered under the given name
+    """
+    if backend == DatastoreStorage.name:
+        from google.cloud import datastore
+        if relationships.LEGACY_READS:
+            logger.warning("CARD_ORDER_LEGACY_READS is on: relationship reads and writes also "
+                           "query the legacy card_order entities. Set it to 0 once "
+                           "migrate_card_order.py reports nothing left to migrate")
+        return DatastoreStorage(datastore_usage.CountingClient(datastore.Client()))
+    if backend == "memory":
+        from memory_storage import MemoryStorage
+        return MemoryStorage()
+    raise ValueError("Unknown storage backend: " + str(backend))
+
+
+def fetch_page(query, limit, offset=None, cursor=None):
+    """
+    Runs a Datastore query for one page, from an offset or a page token
+    """
+    if offset is not None:
+        g_iterator = query.fetch(limit=limit, offset=offset)
+    else:
+        g_iterator = query.fetch(limit=limit, start_cursor=cursor)
+    results = list(next(g_iterator.pages))
+    return results, g_iterator.next_page_token
+
+
+def select_properties(query, properties, filtered=(), project=True):
+    """
+    Makes a list query read no more than the given properties need: keys
+    only for none, a projection when PROJECTIONS covers them, or whole
+    entities otherwise. Properties in filtered are left to the caller,
+    since a projection can not include them. Set project to False for
+    queries with other filters or sort orders, whose indexes do not cover
+    the projections. Returns True if the results will be partial entities
+    """
+    if properties is None:
+        return False
+    needed = set(properties) - set(filtered)
+    if not needed:
+        query.keys_only()
+        return True
+    projection = PROJECTIONS.get(query.kind, ())
+    if project and needed <= set(projection):
+        query.projection = projection
+        return True
+    return False
+
+
+def commit_conflict():
+    """
+    Returns the exception raised when a transaction commit loses against
+    a concurrent one (Aborted is a Conflict)
+    """
+    from google.api_core.exceptions import Conflict
+    return Conflict
+
+
+def run_transaction(client, work):
+    """
+    Runs work() in a transaction and returns its result. A commit that
+    conflicts with a concurrent transaction is retried once, and a second
+    conflict is raised to the caller
+    """
+    conflict = commit_conflict()
+    try:
+        with client.transaction():
+            return work()
+    except conflict:
+        pass
+    with client.transaction():
+        return work()
+
+
+def count_entities(client, query):
+    """
+    Returns the number of entities matching a query using a Datastore count
+    aggregation, so the entities themselves are never read
+    """
+    aggregation_query = client.aggregation_query(query).count(alias="total")
+    for results in aggregation_query.fetch():
+        for result in results:
+            return result.value
+    return 0
+
+
+def get_multi(client, keys):
+    entities = []
+    for i in range(0, len(keys), GET_MULTI_LIMIT):
+        entities += client.get_multi(keys[i:i + GET_MULTI_LIMIT])
+    return entities
+
+
+class DatastoreCards(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def key(self, card_id):
+        return self.client.key(constants.credit_cards, int(card_id))
+
+    def get(self, card_id):
+        return self.client.get(key=self.key(card_id))
+
+    def _query(self, owner, criteria=None, sort=True):
+        query = self.client.query(kind=constants.credit_cards)
+        query.add_filter('owner', '=', owner)
+        if criteria:
+            criteria.apply(query, sort)
+        return query
+
+    def page(self, owner, limit, offset=None, cursor=None, properties=None, criteria=None):
+        query = self._query(owner, criteria)
+        partial = select_properties(query, properties, filtered=("owner",), project=not criteria)
+        results, next_token = fetch_page(query, limit, offset, cursor)
+        if partial:
+            # the owner is filtered on, so it is known without reading it
+            for credit_card in results:
+                credit_card["owner"] = owner
+        return results, next_token
+
+    def count(self, owner, criteria=None):
+        return count_entities(self.client, self._query(owner, criteria, sort=False))
+
+    def _new(self, key, properties):
+        from google.cloud import datastore
+
+        credit_card = datastore.Entity(key=key)
+        credit_card.update(properties)
+        conditional.bump_version(credit_card)
+        return credit_card
+
+    def create(self, properties):
+        """
+        Stores a new credit_card. Returns None if its card number already
+        belongs to another credit_card
+        """
+        return self.create_many([properties])[0]
+
+    def create_many(self, items):
+        """
+        Stores several new credit_cards, checking their card numbers with
+        one lookup per chunk. Returns the created entities in order, with
+        None for the ones whose number is already taken, or is being taken
+        by a concurrent write
+        """
+        client = self.client
+        if not items:
+            return []
+
+        # reserve the ids up front so the cards and their card number
+        # entries can be written in the same transaction
+        keys = client.allocate_ids(client.key(constants.credit_cards), len(items))
+        credit_cards = [self._new(key, properties) for key, properties in zip(keys, items)]
+
+        def create_chunk(chunk):
+            rejected = card_number_index.claim_many(
+                client, [(e["card_number"], e.key.id) for e in chunk])
+            client.put_multi([e for e in chunk if e.key.id not in rejected])
+            return rejected
+
+        created = []
+        for chunk in batch.chunks(credit_cards):
+            # a commit that conflicts twice lost a number to a concurrent
+            # claim, so the chunk is reported as not unique
+            try:
+                rejected = run_transaction(client, lambda: create_chunk(chunk))
+            except commit_conflict():
+                rejected = set(e.key.id for e in chunk)
+            created += [None if e.key.id in rejected else e for e in chunk]
+        return created
+
+    def save(self, credit_card):
+        """
+        Saves a modified credit_card, moving its card number entry in the
+        same transaction when the number changed. The number to release is
+        read from the stored card inside the transaction, so concurrent
+        changes can not leave an entry behind. Returns False if the new
+        number already belongs to another credit_card
+        """
+        client = self.client
+        card_id = credit_card.key.id
+
+        def save_card():
+            stored = client.get(credit_card.key)
+            old_card_number = stored["card_number"] if stored is not None else None
+            if old_card_number is None or card_number_index.normalize(credit_card["card_number"]) \
+                    != card_number_index.normalize(old_card_number):
+                if not card_number_index.claim(client, credit_card["card_number"], card_id):
+                    return False
+                if old_card_number is not None:
+                    card_number_index.release(client, old_card_number, card_id)
+            conditional.bump_version(credit_card)
+            client.put(credit_card)
+            return True
+
+        # a commit that conflicts twice lost the number to a concurrent
+        # claim, which is reported like any other taken number
+        try:
+            return run_transaction(client, save_card)
+        except commit_conflict():
+            return False
+
+    def delete(self, credit_card):
+        """
+        Deletes a credit_card together with its relationships and card
+        number entry in one transaction, so a failure can not leave
+        orphans behind. Its orders get new versions. Returns the ids of
+        those orders, or None without deleting anything if the card holds
+        more orders than one commit can change
+        """
+        client = self.client
+        card_id = credit_card.key.id
+        with client.transaction():
+            # the number to release is the stored one, which a concurrent
+            # change may have moved since the card was read
+            stored = client.get(credit_card.key)
+            keys, order_ids = relationships.keys_for_card(client, card_id)
+            # the relationships and the new version of each order, plus
+            # the card and its card number entry
+            if len(keys) + len(order_ids) + 2 > batch.MAX_MUTATIONS:
+                return None
+            client.delete_multi(keys + [credit_card.key])
+            if stored is not None:
+                card_number_index.release(client, stored["card_number"], card_id)
+            relationships.touch(client, [client.key(constants.orders, order_id)
+                                         for order_id in order_ids])
+        return order_ids
+
+
+class DatastoreOrders(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def key(self, order_id):
+        return self.client.key(constants.orders, int(order_id))
+
+    def get(self, order_id):
+        return self.client.get(key=self.key(order_id))
+
+    def get_multi(self, order_ids):
+        return get_multi(self.client, [self.key(order_id) for order_id in order_ids])
+
+    def _query(self, criteria=None, sort=True):
+        query = self.client.query(kind=constants.orders)
+        if criteria:
+            criteria.apply(query, sort)
+        return query
+
+    def page(self, limit, offset=None, cursor=None, properties=None, criteria=None):
+        query = self._query(criteria)
+        select_properties(query, properties, project=not criteria)
+        return fetch_page(query, limit, offset, cursor)
+
+    def count(self, criteria=None):
+        return count_entities(self.client, self._query(criteria, sort=False))
+
+    def create(self, properties):
+        return self.create_many([properties])[0]
+
+    def create_many(self, items):
+        """
+        Stores several new orders with one put_multi per chunk, letting
+        Datastore assign the ids
+        """
+        from google.cloud import datastore
+
+        new_orders = []
+        for properties in items:
+            new_order = datastore.Entity(key=self.client.key(constants.orders))
+            new_order.update(properties)
+            filtering.store_numbers(constants.orders, new_order)
+            conditional.bump_version(new_order)
+            new_orders.append(new_order)
+        for chunk in batch.chunks(new_orders):
+            self.client.put_multi(chunk)
+        return new_orders
+
+    def save(self, order):
+        filtering.store_numbers(constants.orders, order)
+        conditional.bump_version(order)
+        self.client.put(order)
+
+    def delete(self, order):
+        """
+        Deletes an order and takes it off its credit card in the same
+        transaction. Returns the id of that credit card, or None
+        """
+        with self.client.transaction():
+            card_id = relationships.detach(self.client, order.key.id, touch_order=False)
+            self.client.delete(order.key)
+        return card_id
+
+
+class DatastoreRelationships(object):
+
+    def __init__(self, client):
+        self.client = client
+
+    def card_for_order(self, order_id):
+        return relationships.card_for_order(self.client, order_id)
+
+    def cards_for_orders(self, order_ids):
+        return relationships.cards_for_orders(self.client, order_ids)
+
+    def orders_for_card(self, card_id):
+        return relationships.orders_for_card(self.client, card_id)
+
+    def orders_for_cards(self, card_ids):
+        return relationships.orders_for_cards(self.client, card_ids)
+
+    def attach(self, card_id, order_id):
+        """
+        Puts an order on a credit_card. Returns False if the order is
+        already on a card, or is being put on one by a concurrent write
+        """
+        try:
+            return run_transaction(self.client,
+                                   lambda: relationships.attach(self.client, card_id, order_id))
+        except commit_conflict():
+            return False
+
+    def detach(self, order_id):
+        with self.client.transaction():
+            return relationships.detach(self.client, order_id)
+
+    def change_card_orders(self, card_id, attach_ids, detach_ids):
+        return relationships.change_card_orders(self.client, card_id, attach_ids, detach_ids)
+
+
+class DatastoreStorage(object):
+    """
+    Stores everything in Cloud Datastore through one shared client
+    """
+
+    name = "datastore"
+
+    def __init__(self, client):
+        self.client = client
+        self.cards = DatastoreCards(client)
+        self.orders = DatastoreOrders(client)
+        self.relationships = DatastoreRelationships(client)
+
+    def entity(self, kind, entity_id, properties):
+        """
+        Rebuilds an entity from its kind, id and properties, e.g. after it
+        was cached outside the process
+        """
+        from google.cloud import datastore
+
+        entity = datastore.Entity(key=self.client.key(kind, entity_id))
+        entity.update(properties)
+        return entity
@@ -0,0 +1,75 @@
+import base64
+import os
+import time
+
+# main creates an app on import, which needs a cursor signing key and,
+# without Datastore credentials, the memory backend
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("CURSOR_SIGNING_KEY", "test-key")
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+import credit_card
+import jwks_cache
+import main
+import token_cache
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+class Issuer(object):
+    """
+    Signs access tokens the way Auth0 does, with a throwaway key
+    """
+
+    def __init__(self, kid="test"):
+        self.kid = kid
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.pem = private_key.private_bytes(serialization.Encoding.PEM,
+                                             serialization.PrivateFormat.PKCS8,
+                                             serialization.NoEncryption())
+        numbers = private_key.public_key().public_numbers()
+        self.jwks = {"keys": [{"kid": kid, "kty": "RSA", "use": "sig",
+                               "n": _b64(numbers.n), "e": _b64(numbers.e)}]}
+
+    def token(self, sub):
+        claims = {"sub": sub, "aud": credit_card.CLIENT_ID,
+                  "iss": "https://" + credit_card.DOMAIN + "/",
+                  "exp": int(time.time()) + 3600}
+        return jwt.encode(claims, self.pem, algorithm="RS256", headers={"kid": self.kid})
+
+
+@pytest.fixture(scope="session")
+def issuer():
+    return Issuer()
+
+
+@pytest.fixture
+def app(issuer, monkeypatch):
+    monkeypatch.setattr(credit_card, "jwks_store", jwks_cache.JWKSCache(
+        "jwks", fetch=lambda url: issuer.jwks, prepare_key=credit_card.verifier.prepare_key))
+    monkeypatch.setattr(credit_card, "token_store", token_cache.TokenCache())
+    return main.create_app({"STORAGE_BACKEND": "memory"})
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def auth(issuer):
+    """
+    Returns the headers of a JSON request made by the given user
+    """
+    def headers(sub="auth0|user", **more):
+        headers = {"Authorization": "Bearer " + issuer.token(sub), "Accept": "application/json"}
+        headers.update(more)
+        return headers
+    return headers
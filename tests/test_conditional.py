@@ -0,0 +1,80 @@
+import pytest
+
+from test_item_lookup import CARD, ORDER
+
+JSON = {"Accept": "application/json"}
+
+
+@pytest.fixture
+def card(client, auth):
+    return client.post("/credit_cards", json=CARD, headers=auth()).get_json()["id"]
+
+
+@pytest.fixture
+def order(client):
+    return client.post("/orders", json=ORDER, headers=JSON).get_json()["id"]
+
+
+def _get(client, url, headers, etag=None):
+    headers = dict(headers)
+    if etag is not None:
+        headers["If-None-Match"] = '"%s"' % etag
+    return client.get(url, headers=headers)
+
+
+def test_credit_card_not_modified(client, auth, card):
+    url = "/credit_cards/%d" % card
+    etag = _get(client, url, auth()).get_etag()[0]
+    res = _get(client, url, auth(), etag)
+    assert res.status_code == 304
+    assert res.get_etag()[0] == etag
+    assert res.data == b""
+
+
+def test_order_not_modified(client, order):
+    url = "/orders/%d" % order
+    etag = _get(client, url, JSON).get_etag()[0]
+    assert _get(client, url, JSON, etag).status_code == 304
+    assert _get(client, url, JSON, "other").status_code == 200
+
+
+def test_write_changes_the_etag(client, auth, card):
+    url = "/credit_cards/%d" % card
+    etag = _get(client, url, auth()).get_etag()[0]
+    res = client.patch(url, json={"type": "mastercard"}, headers=auth())
+    assert res.status_code == 200
+    assert res.get_etag()[0] != etag
+
+    res = _get(client, url, auth(), etag)
+    assert res.status_code == 200
+    assert res.get_json()["type"] == "mastercard"
+
+
+def test_relationships_change_both_etags(client, auth, card, order):
+    card_url = "/credit_cards/%d" % card
+    order_url = "/orders/%d" % order
+    card_etag = _get(client, card_url, auth()).get_etag()[0]
+    order_etag = _get(client, order_url, JSON).get_etag()[0]
+
+    res = client.put("/credit_cards/%d/orders/%d" % (card, order), headers=auth())
+    assert res.status_code == 200
+
+    res = _get(client, card_url, auth(), card_etag)
+    assert res.status_code == 200
+    assert res.get_json()["orders"] == [order]
+    assert _get(client, order_url, JSON, order_etag).status_code == 200
+
+
+def test_card_orders_not_modified(client, auth, card, order):
+    client.put("/credit_cards/%d/orders/%d" % (card, order), headers=auth())
+    url = "/credit_cards/%d/orders" % card
+    etag = _get(client, url, JSON).get_etag()[0]
+    assert _get(client, url, JSON, etag).status_code == 304
+
+
+def test_sparse_representations_have_their_own_etag(client, auth, card):
+    url = "/credit_cards/%d" % card
+    full = _get(client, url, auth()).get_etag()[0]
+    sparse = _get(client, url + "?fields=type", auth())
+    assert sparse.get_etag()[0] != full
+    assert _get(client, url + "?fields=type", auth(), full).status_code == 200
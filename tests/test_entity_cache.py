@@ -0,0 +1,111 @@
+import pytest
+
+import constants
+import entity_cache
+
+
+def test_get_and_set():
+    cache = entity_cache.LRUCache(max_size=10, ttl=60)
+    assert cache.get("a") is entity_cache.MISSING
+    cache.set("a", 1, cache.generation)
+    assert cache.get("a") == 1
+    assert cache.stats == {"hits": 1, "misses": 1}
+
+
+def test_least_recently_used_is_evicted():
+    cache = entity_cache.LRUCache(max_size=2, ttl=60)
+    cache.set("a", 1, cache.generation)
+    cache.set("b", 2, cache.generation)
+    cache.get("a")
+    cache.set("c", 3, cache.generation)
+    assert cache.get("b") is entity_cache.MISSING
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_expired_entries_are_misses():
+    cache = entity_cache.LRUCache(max_size=2, ttl=-1)
+    cache.set("a", 1, cache.generation)
+    assert cache.get("a") is entity_cache.MISSING
+    assert len(cache) == 0
+
+
+def test_values_loaded_before_an_invalidation_are_dropped():
+    cache = entity_cache.LRUCache(max_size=10, ttl=60)
+    generation = cache.generation
+    # a write invalidates the key while a read is still loading it
+    cache.invalidate(["a"])
+    cache.set("a", "stale", generation)
+    assert cache.get("a") is entity_cache.MISSING
+    cache.set("a", "fresh", cache.generation)
+    assert cache.get("a") == "fresh"
+
+
+def test_clear_starts_a_new_generation():
+    cache = entity_cache.LRUCache(max_size=10, ttl=60)
+    generation = cache.generation
+    cache.set("a", 1, generation)
+    cache.clear()
+    assert len(cache) == 0
+    cache.set("b", 2, generation)
+    assert cache.get("b") is entity_cache.MISSING
+
+
+def test_lookup_loads_once_and_copies():
+    cache = entity_cache.EntityCache()
+    loads = []
+
+    def load():
+        loads.append(1)
+        return {"status": "pending"}
+
+    value = cache.lookup(constants.orders, 1, load)
+    value["status"] = "changed"
+    assert cache.lookup(constants.orders, 1, load) == {"status": "pending"}
+    assert len(loads) == 1
+
+
+def test_none_is_only_cached_when_negative():
+    cache = entity_cache.EntityCache()
+    loads = []
+
+    def load():
+        loads.append(1)
+        return None
+
+    cache.lookup(constants.orders, 1, load)
+    cache.lookup(constants.orders, 1, load)
+    assert len(loads) == 2
+    cache.lookup(constants.card_order, ("order", 1), load, negative=True)
+    cache.lookup(constants.card_order, ("order", 1), load, negative=True)
+    assert len(loads) == 3
+
+
+def test_lookup_many_loads_only_the_missing_keys():
+    cache = entity_cache.EntityCache()
+    cache.lookup_many(constants.orders, [1, 2], lambda keys: {k: {"id": k} for k in keys})
+    asked = []
+
+    def load_many(keys):
+        asked.extend(keys)
+        return {k: {"id": k} for k in keys}
+
+    found = cache.lookup_many(constants.orders, [1, 2, 3], load_many)
+    assert asked == [3]
+    assert sorted(found) == [1, 2, 3]
+
+
+def test_invalidate_order_drops_the_order_and_its_card():
+    cache = entity_cache.EntityCache()
+    cache.lookup(constants.orders, 7, lambda: {"status": "old"})
+    cache.lookup(constants.card_order, ("order", 7), lambda: 3, negative=True)
+    cache.invalidate_order(7)
+    assert cache.lookup(constants.orders, 7, lambda: {"status": "new"}) == {"status": "new"}
+    assert cache.lookup(constants.card_order, ("order", 7), lambda: None, negative=True) is None
+
+
+def test_disabled_kinds_always_load():
+    cache = entity_cache.EntityCache(disabled=[constants.orders])
+    cache.lookup(constants.orders, 1, lambda: "a")
+    assert cache.lookup(constants.orders, 1, lambda: "b") == "b"
+    with pytest.raises(ValueError):
+        entity_cache.EntityCache(disabled=["cards"])
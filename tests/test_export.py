@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+import export
+from test_item_lookup import CARD, ORDER
+
+NDJSON = {"Accept": export.MIMETYPE}
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_BATCH_SIZE", 3)
+
+
+def _lines(client, url, headers=NDJSON):
+    res = client.get(url, headers=headers)
+    assert res.status_code == 200
+    assert res.mimetype == export.MIMETYPE
+    return [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+
+
+def _path(url):
+    return url.split("localhost", 1)[1]
+
+
+@pytest.fixture
+def orders(client):
+    return [client.post("/orders", json=dict(ORDER, order_total=i),
+                        headers={"Accept": "application/json"}).get_json()["id"]
+            for i in range(8)]
+
+
+def test_export_ends_with_a_summary(client, orders):
+    lines = _lines(client, "/orders/export")
+    records = [line for line in lines if "next" not in line]
+    checkpoints = [line for line in lines if "next" in line]
+    assert sorted(r["id"] for r in records) == sorted(orders)
+    # a checkpoint after each of the three batches but the last
+    assert len(checkpoints) == 3
+    assert lines[-1] == {"next": None, "exported": 8}
+
+
+def test_export_resumes_from_a_checkpoint(client, orders):
+    lines = _lines(client, "/orders/export")
+    records = [line for line in lines if "next" not in line]
+    checkpoint = [line for line in lines if "next" in line][0]
+
+    resumed = _lines(client, _path(checkpoint["next"]))
+    assert [line for line in resumed if "next" not in line] == records[3:]
+    assert resumed[-1] == {"next": None, "exported": 5}
+
+
+def test_cursors_are_scoped_to_the_collection(client, auth, orders):
+    checkpoint = _lines(client, "/orders/export")[3]
+    url = _path(checkpoint["next"]).replace("/orders/", "/credit_cards/")
+    assert client.get(url, headers=auth(Accept=export.MIMETYPE)).status_code == 400
+
+
+def test_bad_cursors_are_rejected(client, orders):
+    assert client.get("/orders/export?cursor=abc", headers=NDJSON).status_code == 400
+
+
+def test_credit_cards_export_only_the_owners_cards(client, auth):
+    for i in range(4):
+        client.post("/credit_cards", json=dict(CARD, card_number=str(i)), headers=auth())
+    client.post("/credit_cards", json=dict(CARD, card_number="x"), headers=auth("auth0|other"))
+
+    lines = _lines(client, "/credit_cards/export", auth(Accept=export.MIMETYPE))
+    records = [line for line in lines if "next" not in line]
+    assert len(records) == 4
+    assert all(r["owner"] == "auth0|user" for r in records)
+    assert lines[-1] == {"next": None, "exported": 4}
@@ -0,0 +1,129 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import constants
+import filtering
+
+ORDER_ATTRIBUTES = ("date_created", "order_total", "status")
+
+
+def parse_orders(**args):
+    return filtering.parse(MultiDict(args), constants.orders, ORDER_ATTRIBUTES)
+
+
+def test_no_parameters():
+    criteria = parse_orders()
+    assert not criteria
+    assert criteria.label("/orders") == "/orders"
+
+
+def test_equality_and_range_filters():
+    criteria = parse_orders(status="pending", **{"order_total[gte]": "10"})
+    assert criteria.filters == [("status", "=", "pending"), ("order_total", ">=", 10.0)]
+    # a range filter sorts on its property first
+    assert criteria.orders == [("order_total", False)]
+
+
+def test_numbers_are_doubles():
+    for text in ("10", "10.0", "1e1"):
+        value = parse_orders(**{"order_total[gt]": text}).filters[0][2]
+        assert value == 10 and isinstance(value, float)
+    with pytest.raises(ValueError):
+        parse_orders(**{"order_total[gt]": "ten"})
+
+
+def test_parameters_that_are_not_filters_are_ignored():
+    criteria = parse_orders(limit="5", cursor="x", fields="status", owner="me")
+    assert not criteria
+
+
+@pytest.mark.parametrize("args", [
+    {"order_total[between]": "1"},
+    {"id[gt]": "1"},
+    {"date_created[gt]": "a", "order_total[lt]": "1"},
+    {"status": "a", "status[gt]": "b"},
+    {"order_total[gt]": "1", "sort": "status"},
+    {"sort": "id"},
+    {"sort": "status,status"},
+])
+def test_invalid_parameters(args):
+    with pytest.raises(ValueError):
+        parse_orders(**args)
+
+
+def test_repeated_filter():
+    with pytest.raises(ValueError):
+        filtering.parse(MultiDict([("status", "a"), ("status", "b")]),
+                        constants.orders, ORDER_ATTRIBUTES)
+
+
+def test_built_in_indexes():
+    # equality filters alone, or one sort order alone
+    assert parse_orders(status="a", date_created="b")
+    assert parse_orders(sort="-order_total").orders == [("order_total", True)]
+    assert parse_orders(**{"date_created[lt]": "b"})
+
+
+def test_composite_indexes():
+    criteria = parse_orders(status="a", sort="-date_created")
+    assert criteria.orders == [("date_created", True)]
+    criteria = parse_orders(status="a", **{"order_total[lte]": "5"})
+    assert criteria.orders == [("order_total", False)]
+
+
+def test_queries_without_an_index():
+    with pytest.raises(ValueError):
+        parse_orders(sort="status,date_created")
+    with pytest.raises(ValueError):
+        parse_orders(date_created="a", sort="order_total")
+
+
+def test_sort_on_equality_property_is_dropped():
+    assert parse_orders(status="a", sort="status").orders == []
+
+
+def test_equality_passed_by_the_endpoint():
+    args = MultiDict({"sort": "type"})
+    criteria = filtering.parse(args, constants.credit_cards, ("type",), equality=("owner",))
+    assert criteria.orders == [("type", False)]
+    with pytest.raises(ValueError):
+        filtering.parse(args, constants.credit_cards, ("type",), equality=("owner", "type2"))
+
+
+def test_label_depends_on_the_criteria():
+    labels = set(parse_orders(**args).label("/orders") for args in
+                 [{"status": "a"}, {"status": "b"}, {"sort": "status"}, {"sort": "-status"}])
+    assert len(labels) == 4
+
+
+def test_numbers_are_stored_as_doubles():
+    properties = {"order_total": 10, "status": "pending", "date_created": "2026-01-01"}
+    filtering.store_numbers(constants.orders, properties)
+    assert properties["order_total"] == 10.0 and isinstance(properties["order_total"], float)
+    assert properties["status"] == "pending"
+    properties = {"order_total": "10"}
+    filtering.store_numbers(constants.orders, properties)
+    assert properties["order_total"] == "10"
+
+
+def test_filters_find_whole_and_fractional_totals():
+    rows = {}
+    for i, total in enumerate([10, 10.5, 9, "12"]):
+        rows[i] = {"order_total": total}
+        filtering.store_numbers(constants.orders, rows[i])
+    assert parse_orders(**{"order_total[gte]": "10"}).select(rows, list(rows)) == [0, 1]
+    assert parse_orders(order_total="10").select(rows, list(rows)) == [0]
+
+
+def test_integers_and_doubles_do_not_match():
+    # like Datastore, for totals stored before they were doubles
+    rows = {1: {"order_total": 10}, 2: {"order_total": 10.0}}
+    assert parse_orders(order_total="10").select(rows, [1, 2]) == [2]
+
+
+def test_select_sorts_like_datastore():
+    rows = {1: {"order_total": 2.5}, 2: {"order_total": "x"}, 3: {"order_total": 7},
+            4: {"order_total": 1}, 5: {"status": "a"}}
+    # integers, then strings, then doubles, without rows missing the property
+    assert parse_orders(sort="order_total").select(rows, [1, 2, 3, 4, 5]) == [4, 3, 2, 1]
+    assert parse_orders(sort="-order_total").select(rows, [1, 2, 3, 4, 5]) == [1, 2, 3, 4]
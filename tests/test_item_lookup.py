@@ -0,0 +1,78 @@
+import pytest
+from google.cloud import datastore
+
+import constants
+import memory_storage
+import storage
+
+CARD = {"card_number": "4111", "type": "visa", "expiration": "1/30", "cvv_code": "123"}
+ORDER = {"date_created": "1/1/2026", "order_total": 10, "status": "pending"}
+
+
+class KeyOnlyClient(object):
+    """
+    A Datastore client that only serves lookups by key, so any query
+    scanning a kind fails the test
+    """
+
+    def __init__(self, entities):
+        self.entities = {e.key: e for e in entities}
+        self.gets = []
+
+    def key(self, kind, id):
+        return datastore.Key(kind, id, project="test")
+
+    def get(self, key):
+        self.gets.append(key)
+        return self.entities.get(key)
+
+    def query(self, **kwargs):
+        raise AssertionError("unexpected query on " + kwargs.get("kind", "?"))
+
+
+def _entity(kind, id, properties):
+    entity = datastore.Entity(key=datastore.Key(kind, id, project="test"))
+    entity.update(properties)
+    return entity
+
+
+@pytest.mark.parametrize("repository, kind", [
+    (storage.DatastoreCards, constants.credit_cards),
+    (storage.DatastoreOrders, constants.orders),
+])
+def test_datastore_get_is_one_key_lookup(repository, kind):
+    client = KeyOnlyClient([_entity(kind, 5, {"owner": "auth0|user"})])
+    repo = repository(client)
+    assert repo.get("5")["owner"] == "auth0|user"
+    assert repo.get("6") is None
+    assert [key.id_or_name for key in client.gets] == [5, 6]
+    assert all(key.kind == kind for key in client.gets)
+
+
+@pytest.fixture
+def no_scans(monkeypatch):
+    def scan(*args, **kwargs):
+        raise AssertionError("the collection was scanned")
+    for repository in (memory_storage.MemoryCards, memory_storage.MemoryOrders):
+        monkeypatch.setattr(repository, "page", scan)
+        monkeypatch.setattr(repository, "count", scan)
+
+
+def test_get_credit_card(client, auth, no_scans):
+    card_id = client.post("/credit_cards", json=CARD, headers=auth()).get_json()["id"]
+    res = client.get("/credit_cards/%d" % card_id, headers=auth())
+    assert res.status_code == 200
+    assert res.get_json()["card_number"] == "4111"
+
+
+def test_get_order(client, no_scans):
+    order_id = client.post("/orders", json=ORDER, headers={"Accept": "application/json"}).get_json()["id"]
+    res = client.get("/orders/%d" % order_id, headers={"Accept": "application/json"})
+    assert res.status_code == 200
+    assert res.get_json()["status"] == "pending"
+
+
+@pytest.mark.parametrize("url", ["/credit_cards/999", "/credit_cards/abc",
+                                 "/orders/999", "/orders/abc"])
+def test_missing_items_are_not_found(client, auth, no_scans, url):
+    assert client.get(url, headers=auth()).status_code == 404
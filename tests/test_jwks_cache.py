@@ -0,0 +1,118 @@
+import threading
+
+import jwks_cache
+
+
+def _jwks(*kids):
+    return {"keys": [{"kty": "RSA", "kid": kid, "use": "sig", "n": "n-" + kid, "e": "AQAB"}
+                     for kid in kids]}
+
+
+class FakeFetch(object):
+    """
+    Serves the given JWKS documents in turn, repeating the last one. An
+    exception in the list is raised instead
+    """
+
+    def __init__(self, *documents):
+        self.documents = list(documents)
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, url):
+        self.release.wait(5)
+        document = self.documents[min(self.calls, len(self.documents) - 1)]
+        self.calls += 1
+        if isinstance(document, Exception):
+            raise document
+        return document
+
+
+def _wait_for_refresh():
+    for thread in threading.enumerate():
+        if thread.name == "jwks-refresh":
+            thread.join(5)
+
+
+def test_keys_are_loaded_once_and_served_from_memory():
+    fetch = FakeFetch(_jwks("a"))
+    cache = jwks_cache.JWKSCache("url", fetch=fetch)
+    assert cache.get_key("a")["n"] == "n-a"
+    assert cache.get_key("a")["n"] == "n-a"
+    assert fetch.calls == 1
+    assert cache.version == 1
+    assert cache.stats["hits"] == 2
+
+
+def test_stale_keys_are_served_while_refreshing():
+    fetch = FakeFetch(_jwks("a"), _jwks("a", "b"))
+    cache = jwks_cache.JWKSCache("url", ttl=-1, refetch_interval=0, fetch=fetch)
+    cache.get_key("a")
+
+    # the background refresh is held back, so the old keys are served
+    fetch.release.clear()
+    assert cache.get_key("a")["n"] == "n-a"
+    assert cache.stats["stale_served"] == 1
+    assert cache.version == 1
+
+    fetch.release.set()
+    _wait_for_refresh()
+    assert cache.version == 2
+    assert cache.stats["refreshes"] == 2
+
+
+def test_stale_keys_are_kept_when_the_refresh_fails():
+    fetch = FakeFetch(_jwks("a"), ValueError("down"))
+    cache = jwks_cache.JWKSCache("url", ttl=-1, refetch_interval=0, fetch=fetch)
+    cache.get_key("a")
+    cache.get_key("a")
+    _wait_for_refresh()
+
+    assert cache.stats["refresh_errors"] == 1
+    assert cache.version == 1
+    assert cache.get_key("a")["n"] == "n-a"
+
+
+def test_failed_refresh_waits_for_the_interval():
+    fetch = FakeFetch(_jwks("a"), ValueError("down"))
+    cache = jwks_cache.JWKSCache("url", ttl=-1, refetch_interval=60, fetch=fetch)
+    cache.get_key("a")
+    cache.get_key("a")
+    _wait_for_refresh()
+    assert fetch.calls == 1
+
+
+def test_unknown_kid_refetches_the_keys():
+    fetch = FakeFetch(_jwks("a"), _jwks("a", "b"))
+    cache = jwks_cache.JWKSCache("url", refetch_interval=0, fetch=fetch)
+    cache.get_key("a")
+    assert cache.get_key("b")["n"] == "n-b"
+    assert fetch.calls == 2
+    assert cache.stats["misses"] == 1
+
+
+def test_unknown_kids_refetch_at_most_once_per_interval():
+    fetch = FakeFetch(_jwks("a"))
+    cache = jwks_cache.JWKSCache("url", refetch_interval=60, fetch=fetch)
+    cache.get_key("a")
+    # as if the cold start happened a while ago
+    cache._last_attempt -= 60
+    assert cache.get_key("x") is None
+    assert cache.get_key("y") is None
+    assert cache.get_key("z") is None
+    # the cold start and a single forced refresh
+    assert fetch.calls == 2
+
+
+def test_prepare_key_runs_once_per_version():
+    prepared = []
+
+    def prepare_key(key):
+        prepared.append(key["kid"])
+        return key["kid"].upper()
+
+    cache = jwks_cache.JWKSCache("url", fetch=FakeFetch(_jwks("a", "b")), prepare_key=prepare_key)
+    assert cache.get_key("a") == "A"
+    assert cache.get_key("b") == "B"
+    assert sorted(prepared) == ["a", "b"]
@@ -0,0 +1,106 @@
+import base64
+import time
+
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+import jwt_verifier
+
+AUDIENCE = "test-audience"
+ISSUER = "https://test.example.com/"
+
+
+def _b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _signing_key():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(serialization.Encoding.PEM,
+                                    serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    numbers = private_key.public_key().public_numbers()
+    jwk = {"kty": "RSA", "kid": "test", "use": "sig", "n": _b64(numbers.n), "e": _b64(numbers.e)}
+    return pem, jwk
+
+
+PEM, JWK = _signing_key()
+OTHER_PEM, _ = _signing_key()
+
+
+def _token(pem=PEM, **overrides):
+    claims = {"sub": "auth0|user", "aud": AUDIENCE, "iss": ISSUER,
+              "exp": int(time.time()) + 3600}
+    claims.update(overrides)
+    claims = {name: value for name, value in claims.items() if value is not None}
+    return jwt.encode(claims, pem, algorithm="RS256", headers={"kid": "test"})
+
+
+def _outcome(name, token):
+    verifier = jwt_verifier.get_verifier(name)
+    key = verifier.prepare_key(JWK)
+    try:
+        return verifier.decode(token, key, audience=AUDIENCE, issuer=ISSUER)
+    except jwt.JWTError as ex:
+        return (type(ex), str(ex))
+
+
+TOKENS = {
+    "valid": _token(),
+    "audience list": _token(aud=["other", AUDIENCE]),
+    "no exp": _token(exp=None),
+    "other signer": _token(pem=OTHER_PEM),
+    "expired": _token(exp=int(time.time()) - 60),
+    "exp not a number": _token(exp="soon"),
+    "not yet valid": _token(nbf=int(time.time()) + 3600),
+    "wrong audience": _token(aud="other"),
+    "audience not strings": _token(aud=[1]),
+    "wrong issuer": _token(iss="https://evil.example.com/"),
+    "no issuer": _token(iss=None),
+    "subject not a string": _token(sub=1),
+}
+
+
+@pytest.mark.parametrize("case", sorted(TOKENS))
+def test_backends_agree(case):
+    assert _outcome("cryptography", TOKENS[case]) == _outcome("jose", TOKENS[case])
+
+
+@pytest.mark.parametrize("name", sorted(jwt_verifier.VERIFIERS))
+def test_valid_token_returns_claims(name):
+    claims = _outcome(name, TOKENS["valid"])
+    assert claims["sub"] == "auth0|user"
+
+
+@pytest.mark.parametrize("name, case, error", [
+    (name, case, error) for name in sorted(jwt_verifier.VERIFIERS) for case, error in [
+        ("other signer", jwt.JWTError),
+        ("expired", jwt.ExpiredSignatureError),
+        ("wrong audience", jwt.JWTClaimsError),
+        ("wrong issuer", jwt.JWTClaimsError),
+    ]
+])
+def test_rejections(name, case, error):
+    outcome = _outcome(name, TOKENS[case])
+    assert isinstance(outcome, tuple) and issubclass(outcome[0], error)
+
+
+def test_tampered_payload_is_rejected():
+    header, _, signature = TOKENS["valid"].split(".")
+    _, claims, _ = _token(sub="auth0|admin").split(".")
+    tampered = ".".join([header, claims, signature])
+    assert _outcome("cryptography", tampered)[0] is jwt.JWTError
+    assert _outcome("jose", tampered)[0] is jwt.JWTError
+
+
+def test_malformed_tokens_are_rejected():
+    for name in jwt_verifier.VERIFIERS:
+        assert issubclass(_outcome(name, "not-a-token")[0], jwt.JWTError)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        jwt_verifier.get_verifier("unknown")
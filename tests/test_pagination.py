@@ -0,0 +1,91 @@
+import flask
+import pytest
+
+import pagination
+
+
+@pytest.fixture(autouse=True)
+def signing_key():
+    app = flask.Flask(__name__)
+    app.config["CURSOR_SIGNING_KEY"] = "test-key"
+    pagination.init_app(app)
+
+
+def test_signing_key_is_required():
+    app = flask.Flask(__name__)
+    with pytest.raises(RuntimeError):
+        pagination.init_app(app)
+
+
+def test_cursor_round_trip():
+    cursor = pagination.encode_cursor(b"token\x00\xff", "/orders")
+    assert pagination.decode_cursor(cursor, "/orders") == b"token\x00\xff"
+    assert pagination.decode_cursor(pagination.encode_cursor("abc", "/orders"), "/orders") == b"abc"
+
+
+def test_cursor_of_another_scope():
+    cursor = pagination.encode_cursor(b"token", "/credit_cards|owner1")
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(cursor, "/credit_cards|owner2")
+
+
+def test_cursor_signed_with_another_key():
+    cursor = pagination.encode_cursor(b"token", "/orders")
+    app = flask.Flask(__name__)
+    app.config["CURSOR_SIGNING_KEY"] = "other-key"
+    pagination.init_app(app)
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(cursor, "/orders")
+
+
+@pytest.mark.parametrize("cursor", ["", "abc", "a.b.c", "!!!.x", "é.x"])
+def test_malformed_cursors(cursor):
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(cursor, "/orders")
+
+
+def test_tampered_cursor():
+    payload, signature = pagination.encode_cursor(b"token", "/orders").split(".")
+    forged = pagination.encode_cursor(b"other", "/orders").split(".")[0]
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(forged + "." + signature, "/orders")
+
+
+def fetch_page(query_string, total=500):
+    calls = []
+
+    def fetch(limit, offset=None, cursor=None):
+        calls.append((limit, offset, cursor))
+        start = offset or int(cursor or 0)
+        items = list(range(start, min(start + limit, total)))
+        return items, (str(start + limit).encode() if start + limit < total else None)
+
+    app = flask.Flask(__name__)
+    with app.test_request_context("/orders" + query_string):
+        items, next_url = pagination.fetch_page(fetch, flask.request, "/orders")
+    return items, next_url, calls
+
+
+def test_limit_is_clamped():
+    items, next_url, calls = fetch_page("?limit=100000")
+    assert calls == [(pagination.MAX_LIMIT, None, None)]
+    assert len(items) == pagination.MAX_LIMIT
+    assert "limit=%d" % pagination.MAX_LIMIT in next_url
+
+
+@pytest.mark.parametrize("query_string", ["?limit=0", "?limit=x", "?offset=-1"])
+def test_bad_limit_or_offset(query_string):
+    with pytest.raises(ValueError):
+        fetch_page(query_string)
+
+
+def test_next_cursor_resumes_after_the_page():
+    items, next_url, _ = fetch_page("?limit=2")
+    assert items == [0, 1]
+    items, next_url, calls = fetch_page(next_url[next_url.index("?"):])
+    assert items == [2, 3] and calls == [(2, None, b"2")]
+
+
+def test_last_page_has_no_next():
+    items, next_url, _ = fetch_page("?offset=498&limit=5")
+    assert items == [498, 499] and next_url is None
@@ -0,0 +1,163 @@
+import json
+import time
+
+import constants
+import entity_cache
+import memory_storage
+import shared_cache
+
+def _shared(server):
+    return shared_cache.SharedCache(server, memory_storage.MemoryStorage().entity)
+
+
+class Loader(object):
+
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+class BrokenServer(object):
+
+    def pipeline(self):
+        # like redis, commands only fail once the pipeline is executed
+        return shared_cache.LocalPipeline(self)
+
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise ConnectionError("down")
+        return fail
+
+
+def test_values_are_shared_between_instances():
+    server = shared_cache.LocalRedis()
+    load = Loader("value")
+    assert _shared(server).lookup("orders", 1, load) == "value"
+    assert _shared(server).lookup("orders", 1, load) == "value"
+    assert load.calls == 1
+
+
+def test_entities_round_trip():
+    cache = _shared(shared_cache.LocalRedis())
+    entity = cache.make_entity("orders", 7, {"status": "pending"})
+    value = (entity, [1, 2], b"token")
+    decoded = cache.decode(json.loads(json.dumps(cache.encode(value))))
+    assert decoded[0].key.kind == "orders" and decoded[0].key.id == 7
+    assert dict(decoded[0]) == {"status": "pending"}
+    assert decoded[1:] == ([1, 2], b"token")
+
+
+def test_invalidation_moves_to_a_new_generation():
+    server = shared_cache.LocalRedis()
+    cache = _shared(server)
+    cache.lookup("orders", 1, Loader("old"))
+    cache.invalidate("orders", [1])
+    assert server.mget([shared_cache._generation_key("orders", 1)]) == [b"1"]
+    assert _shared(server).lookup("orders", 1, Loader("new")) == "new"
+    assert _shared(server).lookup("orders", 1, Loader("newer")) == "new"
+
+
+def test_values_loaded_before_an_invalidation_are_ignored():
+    server = shared_cache.LocalRedis()
+    cache = _shared(server)
+
+    def slow_load():
+        # another instance writes while this one is still loading
+        _shared(server).invalidate("orders", [1])
+        return "stale"
+
+    assert cache.lookup("orders", 1, slow_load) == "stale"
+    assert cache.lookup("orders", 1, Loader("fresh")) == "fresh"
+
+
+def test_none_is_only_shared_when_negative():
+    server = shared_cache.LocalRedis()
+    load = Loader(None)
+    _shared(server).lookup("orders", 1, load)
+    _shared(server).lookup("orders", 1, load)
+    assert load.calls == 2
+
+    _shared(server).lookup("cards", 1, load, negative=True)
+    _shared(server).lookup("cards", 1, load, negative=True)
+    assert load.calls == 3
+
+
+def test_lookup_many_loads_only_the_missing_keys():
+    server = shared_cache.LocalRedis()
+    cache = _shared(server)
+    cache.lookup("orders", 1, Loader("one"))
+    loaded = []
+
+    def load_many(keys):
+        loaded.extend(keys)
+        return {key: "value %d" % key for key in keys}
+
+    assert cache.lookup_many("orders", [1, 2, 3], load_many) == \
+        {1: "one", 2: "value 2", 3: "value 3"}
+    assert loaded == [2, 3]
+    assert cache.stats["orders"] == {"hits": 1, "misses": 3}
+
+
+def test_server_errors_are_misses():
+    cache = _shared(BrokenServer())
+    load = Loader("value")
+    assert cache.lookup("orders", 1, load) == "value"
+    assert cache.lookup("orders", 1, load) == "value"
+    cache.invalidate("orders", [1])
+    assert load.calls == 2
+    assert cache.errors == 3
+
+
+class RecordingCache(object):
+
+    def __init__(self):
+        self.dropped = []
+
+    def drop(self, kind, keys):
+        self.dropped.append((kind, keys))
+
+
+def test_invalidations_reach_the_other_instances():
+    server = shared_cache.LocalRedis()
+    writer, reader = _shared(server), _shared(server)
+    pubsub = server.pubsub()
+    pubsub.subscribe(shared_cache.INVALIDATION_CHANNEL)
+
+    writer.invalidate("relationships", [("card", 1), 2])
+    message = next(pubsub.listen())
+
+    other, own = RecordingCache(), RecordingCache()
+    reader._receive(other, message["data"])
+    writer._receive(own, message["data"])
+    assert other.dropped == [("relationships", [("card", 1), 2])]
+    assert own.dropped == []
+
+
+def _instance(server):
+    cache = entity_cache.EntityCache(max_size=10, ttl=60)
+    cache.shared = _shared(server)
+    cache.shared.start_listener(cache)
+    return cache
+
+
+def test_writes_on_one_instance_reach_the_others():
+    server = shared_cache.LocalRedis()
+    writer, reader = _instance(server), _instance(server)
+    # wait for both listeners to subscribe
+    deadline = time.time() + 2
+    while len(server._subscribers.get(shared_cache.INVALIDATION_CHANNEL, ())) < 2:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    assert reader.lookup(constants.orders, 1, Loader("pending")) == "pending"
+    assert writer.lookup(constants.orders, 1, Loader("other")) == "pending"
+
+    writer.invalidate_order(1)
+    deadline = time.time() + 2
+    while reader.lookup(constants.orders, 1, Loader("shipped")) != "shipped":
+        assert time.time() < deadline, "the other instance kept its stale copy"
+        time.sleep(0.01)
@@ -0,0 +1,71 @@
+import time
+
+import token_cache
+
+
+def test_unknown_tokens_are_misses():
+    cache = token_cache.TokenCache()
+    assert cache.get("token") is None
+    assert cache.stats["misses"] == 1
+
+
+def test_verified_payloads_are_served_until_exp():
+    cache = token_cache.TokenCache()
+    payload = {"sub": "user", "exp": time.time() + 60}
+    cache.add_verified("token", payload)
+    assert cache.get("token") == ("ok", payload)
+    assert cache.stats["hits"] == 1
+
+
+def test_expired_payloads_are_not_served():
+    cache = token_cache.TokenCache()
+    cache.add_verified("token", {"sub": "user", "exp": time.time() - 1})
+    assert cache.get("token") is None
+
+
+def test_payloads_without_exp_are_not_cached():
+    cache = token_cache.TokenCache()
+    cache.add_verified("token", {"sub": "user"})
+    cache.add_verified("other", {"sub": "user", "exp": "never"})
+    assert cache.get("token") is None
+    assert cache.get("other") is None
+
+
+def test_rejected_tokens_are_remembered():
+    cache = token_cache.TokenCache()
+    error = {"code": "token_expired", "description": "token is expired"}
+    cache.add_rejected("token", error, 401)
+    assert cache.get("token") == ("rejected", (error, 401))
+    assert cache.stats["rejected_hits"] == 1
+
+
+def test_rejections_expire_after_the_ttl():
+    cache = token_cache.TokenCache(rejected_ttl=-1)
+    cache.add_rejected("token", {"code": "invalid_header"}, 401)
+    assert cache.get("token") is None
+
+
+def test_least_recently_used_tokens_are_evicted():
+    cache = token_cache.TokenCache(max_size=2)
+    exp = time.time() + 60
+    cache.add_verified("a", {"exp": exp})
+    cache.add_verified("b", {"exp": exp})
+    cache.get("a")
+    cache.add_verified("c", {"exp": exp})
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_tokens_are_kept_by_hash():
+    cache = token_cache.TokenCache()
+    cache.add_verified("secret-token", {"exp": time.time() + 60})
+    assert "secret-token" not in cache._verified._items
+    assert token_cache.token_hash("secret-token") in cache._verified._items
+
+
+def test_clear():
+    cache = token_cache.TokenCache()
+    cache.add_verified("a", {"exp": time.time() + 60})
+    cache.add_rejected("b", {}, 401)
+    cache.clear()
+    assert cache.get("a") is None and cache.get("b") is None
@@ -0,0 +1,69 @@
+import pytest
+import requests
+
+import auth0_client
+import main
+
+JSON = {"Accept": "application/json"}
+
+
+class StubToken(object):
+
+    def __init__(self):
+        self.invalidated = 0
+
+    def get_token(self):
+        return "token-%d" % self.invalidated
+
+    def invalidate(self):
+        self.invalidated += 1
+
+
+@pytest.fixture
+def token(monkeypatch):
+    token = StubToken()
+    monkeypatch.setattr(main, "management_token", token)
+    return token
+
+
+def _http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def test_users_page(client, token, monkeypatch):
+    def users_window(url, access_token, offset, limit, fields):
+        return 12, [{"name": "user %d" % i, "user_id": str(i)} for i in range(offset, offset + limit)]
+    monkeypatch.setattr(auth0_client, "users_window", users_window)
+
+    body = client.get("/users?limit=5&offset=5", headers=JSON).get_json()
+    assert [u["user_id"] for u in body["Users"]] == ["5", "6", "7", "8", "9"]
+    assert body["next"].endswith("/users?limit=5&offset=10")
+    assert body["items_in_collection"] == 12
+
+
+def test_revoked_token_is_refreshed_once(client, token, monkeypatch):
+    tokens = []
+
+    def users_window(url, access_token, offset, limit, fields):
+        tokens.append(access_token)
+        if access_token == "token-0":
+            raise _http_error(401)
+        return 0, []
+    monkeypatch.setattr(auth0_client, "users_window", users_window)
+
+    assert client.get("/users", headers=JSON).status_code == 200
+    assert tokens == ["token-0", "token-1"]
+
+
+@pytest.mark.parametrize("error", [_http_error(500), requests.ConnectionError(),
+                                   requests.Timeout()])
+def test_auth0_failures_are_bad_gateway(client, token, monkeypatch, error):
+    def users_window(*args):
+        raise error
+    monkeypatch.setattr(auth0_client, "users_window", users_window)
+
+    res = client.get("/users", headers=JSON)
+    assert res.status_code == 502
+    assert res.get_json()["code"] == "Bad Gateway"
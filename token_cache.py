@@ -0,0 +1,112 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# maximum number of verified tokens remembered by the process
+TOKEN_CACHE_SIZE = 10000
+
+# maximum number of rejected tokens remembered by the process
+REJECTED_CACHE_SIZE = 1000
+
+# how long a rejected token is remembered, in seconds
+REJECTED_TTL = 30
+
+
+def token_hash(token):
+    """
+    Returns the cache key for a raw bearer token so the token itself is
+    never kept in memory longer than the request
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class _LRU(object):
+    """
+    A small thread-safe LRU mapping whose values carry an expiry time
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= now:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class TokenCache(object):
+    """
+    Remembers the decoded payload of tokens that already passed signature
+    verification, until the token's own exp claim, and the error returned
+    for tokens that were recently rejected.
+    """
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE,
+                 rejected_size=REJECTED_CACHE_SIZE, rejected_ttl=REJECTED_TTL):
+        self.rejected_ttl = rejected_ttl
+        self._verified = _LRU(max_size)
+        self._rejected = _LRU(rejected_size)
+        self.stats = {"hits": 0, "misses": 0, "rejected_hits": 0}
+
+    def get(self, token):
+        """
+        Returns a ("ok", payload) or ("rejected", (error, status_code))
+        tuple for a token seen before, or None
+        """
+        key = token_hash(token)
+        now = time.time()
+
+        payload = self._verified.get(key, now)
+        if payload is not None:
+            self.stats["hits"] += 1
+            return ("ok", payload)
+
+        rejection = self._rejected.get(key, now)
+        if rejection is not None:
+            self.stats["rejected_hits"] += 1
+            return ("rejected", rejection)
+
+        self.stats["misses"] += 1
+        return None
+
+    def add_verified(self, token, payload):
+        """
+        Stores a verified payload until its exp claim. Payloads without
+        an exp are not cached since they could never be evicted on time
+        """
+        exp = payload.get("exp")
+        if not isinstance(exp, (int, float)):
+            return
+        self._verified.set(token_hash(token), payload, exp)
+
+    def add_rejected(self, token, error, status_code):
+        self._rejected.set(token_hash(token), (error, status_code),
+                           time.time() + self.rejected_ttl)
+
+    def clear(self):
+        self._verified.clear()
+        self._rejected.clear()